@@ -16,12 +16,48 @@
 #     EXTRACT,[all|non-empty] --> extracts all or only non-empty tables (default all)
 #     TIMEZONE,<country>/<city> --> changes localtime to use specified timezone (default UTC)
 #     POSTPROC,<file1> <file2> ... --> run postprocessing routines (default none)
-#     OUTPUTS,<ext1> <ext2> ... --> extensions to save (default "zip", "csv", "png", "glm", "json")
+#     OUTPUTS,<ext1> <ext2> ... --> extensions to save (default "zip", "csv", "png", "glm", "json", "sqlite" is also available)
+#     EXTRACT_WORKERS,<number> --> number of tables to extract concurrently (default 1)
+#     EXTRACT_BACKEND,[mdbtools|native] --> use mdb-export or the native MDB reader (default mdbtools)
+#     EXTRACT_MODE,[files|stream|pipeline] --> export tables to CSV files, stream them into memory, or stream them and convert the networks as their partitions are saved (default files)
+#     EXTRACT_QUEUE,<number> --> number of tables or networks waiting in pipeline mode (default 2)
+#     EXTRACT_CACHE,[none|default|<folder>] --> reuse tables already extracted from the same database (default none)
+#     EXTRACT_CACHE_SIZE,<megabytes> --> size limit of the extract cache (default 1024)
+#     EXTRACT_COLUMNS,[all|used] --> extract all columns or only those used by the postprocessors (default all)
+#     EXTRACT_SCOPE,[database|networks] --> extract all rows or only the rows of the selected networks (default database)
+#     EXTRACT_LAYOUT,[tables|networks] --> save whole tables or partition the tables by network (default tables)
+#     EXTRACT_COLUMNAR,[false|true] --> also save the tables in the memory-mapped columnar format (default false)
+#     EXTRACT_PLAN,[none|auto] --> choose the layout, workers and PNG detail from the table row counts (default none)
+#     EXTRACT_MEMORY,[auto|<megabytes>] --> memory budget of the plan (default auto)
+#     POSTPROC_CACHE,[none|default|<folder>] --> restore the outputs of postprocessors run before with the same inputs and settings (default none)
+#     POSTPROC_CACHE_SIZE,<megabytes> --> size limit of the postprocessor cache (default 1024)
+#     CONVERT_TIMEOUT,[none|<seconds>] --> convert each network in a supervised worker killed after this wall time (default none)
+#     CONVERT_CPU,[none|<seconds>] --> convert each network in a supervised worker killed after this CPU time (default none)
+#     CONVERT_MEMORY,[none|<megabytes>] --> convert each network in a supervised worker killed above this RSS (default none)
+#     SPOOL_FOLDER,[none|<folder>] --> convert the networks with workers claiming units from a shared spool folder (default none)
+#     SPOOL_WORKERS,<number> --> number of local spool workers (default 1)
+#     SPOOL_LEASE,<seconds> --> time after which the unit of a silent spool worker is claimed again (default 300)
+#     ARCHIVE_FORMAT,[zip|tar.zst] --> format of the tables archive (default zip)
+#     ARCHIVE_LEVEL,<0-9> --> compression level of the tables archive, 0 stores the files (default 6)
 #
 
-import os, shutil, subprocess, sys, getopt
+import os, shutil, subprocess, sys, getopt, json, re, time, shlex, functools
+import asyncio
+import concurrent.futures
 import pandas as pd
 
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"postproc"))
+from mdb_reader import MdbFile
+import table_store
+import extract_cache
+import archive_writer
+import spool
+import planner
+import run_report
+import glm_writer
+import postproc_cache
+import supervisor
+
 cache = "/usr/local/share/openfido" # additional path for downloaded modules
 apiurl = "https://api.github.com"
 rawurl = "https://raw.githubusercontent.com"
@@ -29,6 +65,446 @@ giturl = "https://github.com"
 traceback_file = "/dev/stderr"
 
 DEFAULT_OUTPUT=["zip", "csv", "png", "glm", "json"]
+DEFAULT_WORKERS=1
+DEFAULT_BACKEND="mdbtools"
+DEFAULT_MODE="files"
+DEFAULT_QUEUE=2
+DEFAULT_CACHE="none"
+DEFAULT_COLUMNS="all"
+DEFAULT_SCOPE="database"
+DEFAULT_LAYOUT="tables"
+DEFAULT_COLUMNAR="false"
+DEFAULT_SPOOL="none"
+DEFAULT_POSTPROC_CACHE="none"
+CHUNK_ROWS=100000 # rows parsed at a time when filtering mdb-export output
+CONFIG_SETTINGS = { # PROCCONFIG names of the optional config settings, with the setting and its default
+	"workers" : ("EXTRACT_WORKERS",DEFAULT_WORKERS),
+	"backend" : ("EXTRACT_BACKEND",DEFAULT_BACKEND),
+	"mode" : ("EXTRACT_MODE",DEFAULT_MODE),
+	"queue" : ("EXTRACT_QUEUE",DEFAULT_QUEUE),
+	"cache" : ("EXTRACT_CACHE",DEFAULT_CACHE),
+	"cache_size" : ("EXTRACT_CACHE_SIZE",extract_cache.DEFAULT_SIZE),
+	"columns" : ("EXTRACT_COLUMNS",DEFAULT_COLUMNS),
+	"scope" : ("EXTRACT_SCOPE",DEFAULT_SCOPE),
+	"layout" : ("EXTRACT_LAYOUT",DEFAULT_LAYOUT),
+	"columnar" : ("EXTRACT_COLUMNAR",DEFAULT_COLUMNAR),
+	"plan" : ("EXTRACT_PLAN",planner.DEFAULT_PLAN),
+	"memory" : ("EXTRACT_MEMORY",planner.DEFAULT_MEMORY),
+	"postproc_cache" : ("POSTPROC_CACHE",DEFAULT_POSTPROC_CACHE),
+	"postproc_cache_size" : ("POSTPROC_CACHE_SIZE",postproc_cache.DEFAULT_SIZE),
+	"convert_timeout" : ("CONVERT_TIMEOUT",supervisor.DEFAULT_LIMIT),
+	"convert_cpu" : ("CONVERT_CPU",supervisor.DEFAULT_LIMIT),
+	"convert_memory" : ("CONVERT_MEMORY",supervisor.DEFAULT_LIMIT),
+	"spool" : ("SPOOL_FOLDER",DEFAULT_SPOOL),
+	"spool_workers" : ("SPOOL_WORKERS",spool.DEFAULT_WORKERS),
+	"spool_lease" : ("SPOOL_LEASE",spool.DEFAULT_LEASE),
+	"archive_format" : ("ARCHIVE_FORMAT",archive_writer.DEFAULT_FORMAT),
+	"archive_level" : ("ARCHIVE_LEVEL",archive_writer.DEFAULT_LEVEL),
+	}
+
+def config_settings(settings):
+	"""Get the PROCCONFIG values of the optional config settings, the defaults of those that are not set"""
+	return {name:settings[setting] if setting in settings.keys() else default for name, (setting, default) in CONFIG_SETTINGS.items()}
+
+def table_columns(database,table,columns):
+	"""Get the columns of a table in the native database that are in the list given"""
+	return [column for column in database.table(table).column_names() if column in columns]
+
+def filter_rows(data,where):
+	"""Get the rows of a DataFrame matching the `where` filter (columns not in the table are ignored)"""
+	for column, values in where.items():
+		if column in data.columns:
+			data = data[data[column].isin(values)]
+	return data
+
+def export_table(database,table,csvdir,columns=None,where=None,report=None):
+	"""Export a table from the database into a CSV file, returns the CSV name and row count
+
+	If `columns` is given only these columns are exported.  If `where` is given,
+	it maps column names to the values accepted, and only the matching rows are
+	exported.  If `report` is given, the performance record of the export is
+	appended to it.
+	"""
+	csvname = table[3:].lower()
+	rows = -1 # don't count the header
+	measure = run_report.Measure("export",table)
+	if type(database) is MdbFile:
+		if table in database.tables():
+			if columns is not None:
+				columns = table_columns(database,table,columns)
+			rows = database.export_csv(table,f"{csvdir}/{csvname}.csv",columns,where)
+	else:
+		proc = subprocess.Popen(["mdb-export",database,table],stdout=subprocess.PIPE)
+		if columns is not None or where:
+			rows = 0
+			with open(f"{csvdir}/{csvname}.csv","w") as csv:
+				try:
+					for n, data in enumerate(pd.read_csv(proc.stdout,dtype=str,keep_default_na=False,chunksize=CHUNK_ROWS,
+							usecols=(lambda column: column in columns) if columns is not None else None)):
+						data = filter_rows(data,where) if where else data
+						data.to_csv(csv,index=False,header=(n==0))
+						rows += len(data)
+				except pd.errors.EmptyDataError:
+					pass
+		else:
+			with open(f"{csvdir}/{csvname}.csv","wb") as csv:
+				for block in iter(lambda: proc.stdout.read(1048576), b""):
+					csv.write(block)
+					rows += block.count(b"\n")
+		measure.wait(proc)
+	if report is not None:
+		report.append(measure.result(rows,csvname=csvname,
+			size=os.path.getsize(f"{csvdir}/{csvname}.csv") if os.path.exists(f"{csvdir}/{csvname}.csv") else None))
+	return csvname, rows
+
+def read_table(database,table,columns=None,where=None,report=None):
+	"""Stream a table from the database into a DataFrame of strings, returns the CSV name and data
+
+	If `columns` is given only these columns are read.  See `export_table()`
+	for the `where` filter and the `report`.
+	"""
+	csvname = table[3:].lower()
+	measure = run_report.Measure("read",table)
+	if type(database) is MdbFile:
+		data = None
+		if table in database.tables():
+			if columns is not None:
+				columns = table_columns(database,table,columns)
+			data = database.read_table(table,columns,dtype=str,where=where)
+	else:
+		proc = subprocess.Popen(["mdb-export",database,table],stdout=subprocess.PIPE)
+		try:
+			usecols = (lambda column: column in columns) if columns is not None else None
+			if where:
+				data = pd.concat([filter_rows(data,where)
+					for data in pd.read_csv(proc.stdout,dtype=str,usecols=usecols,chunksize=CHUNK_ROWS)])
+			else:
+				data = pd.read_csv(proc.stdout,dtype=str,usecols=usecols)
+		except pd.errors.EmptyDataError:
+			data = None
+		measure.wait(proc)
+	if report is not None:
+		report.append(measure.result(len(data) if data is not None else None,csvname=csvname))
+	return csvname, data
+
+def postproc_columns(postprocs):
+	"""Get the columns used by the postprocessors, returns None if one of them does not tell"""
+	columns = {}
+	for process in postprocs:
+		if process == "write_glm.py":
+			manifest = glm_writer.cyme_columns()
+		else:
+			result = os.popen(f"python3 {cache}/cyme-extract/postproc/{process} --cyme-columns 2>/dev/null").read()
+			try:
+				manifest = json.loads(result)
+			except json.JSONDecodeError:
+				return None
+		for table, names in manifest.items():
+			columns[table] = sorted(set(columns[table]) | set(names)) if table in columns else names
+	return columns
+
+def open_database(database,backend=DEFAULT_BACKEND):
+	if backend == "native":
+		return MdbFile(database)
+	elif backend != "mdbtools":
+		raise Exception(f"extract backend '{backend}' is not valid (must be 'mdbtools' or 'native')")
+	return database
+
+def select_networks(database,matches=".*",select=None,backend=DEFAULT_BACKEND):
+	"""Get the IDs of the networks in the database matching the pattern and in the selection (if any)"""
+	csvname, network = read_table(open_database(database,backend),"CYMNETWORK",["NetworkId"])
+	if network is None:
+		return []
+	return [network_id for network_id in network["NetworkId"]
+		if re.match(matches,network_id) and (select is None or network_id in select)]
+
+def network_option(flags):
+	"""Get the network IDs given with the -n|--network_ID postprocessor option, or None
+
+	The IDs are separated by spaces, as the postprocessors split them, e.g., `-n 'ID1 ID2'`.
+	"""
+	args = shlex.split(flags)
+	for n, arg in enumerate(args):
+		if arg in ["-n","--network_ID"] and n+1 < len(args):
+			return args[n+1].split()
+		elif arg.startswith("--network_ID="):
+			return arg[13:].split()
+		elif arg.startswith("-n") and len(arg) > 2:
+			return arg[2:].split()
+	return None
+
+def single_model(networks,flags=""):
+	"""Check whether the model of the networks converted separately keeps the name `<generated>.glm` it has when they are converted at once
+
+	This is the case when the networks were not selected with the -n option
+	and there is only one, otherwise each model is written to
+	`<generated>_<NetworkId>.glm`.
+	"""
+	return network_option(flags) is None and len(networks) == 1
+
+def network_flags(network_id,networks,flags=""):
+	"""Get the write_glm options converting one of the networks separately (see `single_model()`)"""
+	return ["-n",network_id] + (["-s"] if single_model(networks,flags) else [])
+
+def postproc_flags(process,flags="",networks=None,dependencies={}):
+	"""Get the options of a postprocessor run after the networks given were converted separately
+
+	A postprocessor that depends on write_glm.py reads the model of each
+	network, so it is given the networks with the -n option when
+	`network_flags()` named the models after them.
+	"""
+	if networks is None or single_model(networks,flags) or network_option(flags) is not None or "write_glm.py" not in dependencies.get(process,[]):
+		return flags
+	return f"{flags} -n {shlex.quote(' '.join(networks))}"
+
+def read_tables(database,tables,extract="all",workers=DEFAULT_WORKERS,backend=DEFAULT_BACKEND,columns=None,where=None,report=None):
+	"""Stream tables from the database using a pool of workers, returns a dict of DataFrames keyed by CSV name"""
+	database = open_database(database,backend)
+	columns = columns if columns else {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(int(workers),1)) as pool:
+		results = list(pool.map(lambda table: read_table(database,table,columns.get(table),where,report),tables))
+	data = {}
+	for csvname, table in results:
+		if table is None or (len(table) == 0 and extract != "all"):
+			continue
+		data[csvname] = table
+	return data
+
+def export_tables(database,tables,csvdir,extract="all",workers=DEFAULT_WORKERS,backend=DEFAULT_BACKEND,columns=None,where=None,report=None):
+	"""Export tables from the database using a pool of workers, returns the CSV names of the tables kept"""
+	database = open_database(database,backend)
+	columns = columns if columns else {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(int(workers),1)) as pool:
+		results = list(pool.map(lambda table: export_table(database,table,csvdir,columns.get(table),where,report),tables))
+	csvnames = []
+	for csvname, rows in results:
+		if not os.path.exists(f"{csvdir}/{csvname}.csv"):
+			continue
+		elif rows < 1 and extract != "all":
+			os.remove(f"{csvdir}/{csvname}.csv")
+		else:
+			csvnames.append(csvname)
+	return csvnames
+
+async def run_pipeline(database,tables,csvdir,networks,convert,extract="all",workers=DEFAULT_WORKERS,backend=DEFAULT_BACKEND,columns=None,where=None,queue_size=DEFAULT_QUEUE,report=None):
+	"""Stream tables from the database into the data folder partitioned by network and convert the networks as they are saved
+
+	Each table is split by network as soon as it is read, while the other
+	tables are still being read.  Once all the tables are read, the partitions
+	are saved one network at a time and the networks listed in `networks` are
+	put in a queue of at most `queue_size` networks, from which `workers`
+	tasks convert them with the `convert(network_id)` coroutine, which returns
+	an exit code.  Network N is thus converted while the partition of network
+	N+1 is saved, and the rows of each network are released when its partition
+	is saved.  Returns the exit code of the conversion of each network.  See
+	`export_table()` for the `report`, to which the wall time of each
+	conversion is also appended.
+	"""
+	database = open_database(database,backend)
+	columns = columns if columns else {}
+	workers = max(int(workers),1)
+	loop = asyncio.get_running_loop()
+	started = time.time()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+
+		# read the tables, at most queue_size tables waiting to be split
+		loaded = asyncio.Queue(int(queue_size))
+		async def reader(table):
+			await loaded.put(await loop.run_in_executor(pool,read_table,database,table,columns.get(table),where,report))
+		readers = [asyncio.create_task(reader(table)) for table in tables]
+		shared, groups, headers = {}, {}, {}
+		for n in range(len(tables)):
+			csvname, data = await loaded.get()
+			if data is None or (len(data) == 0 and extract != "all"):
+				continue
+			elif table_store.is_partitioned(csvname,data.columns):
+				groups[csvname] = await loop.run_in_executor(pool,lambda: dict(list(data.groupby(table_store.PARTITION_COLUMN,sort=False))))
+				headers[csvname] = data.iloc[0:0]
+			else:
+				shared[csvname] = data
+		await asyncio.gather(*readers)
+		network_ids = table_store.network_ids(dict(shared,**{name:pd.DataFrame({table_store.PARTITION_COLUMN:list(parts)}) for name, parts in groups.items()}))
+		table_store.save_tables(csvdir,shared)
+		table_store.save_index(csvdir,list(groups),network_ids)
+
+		# save the partitions and convert the networks, at most queue_size networks waiting
+		ready = asyncio.Queue(int(queue_size))
+		timings = []
+		async def converter():
+			while True:
+				network_id = await ready.get()
+				if network_id is None:
+					return
+				start = time.time()
+				code = await convert(network_id)
+				timings.append((network_id,code,time.time()-start,time.time()-started))
+				if report is not None:
+					report.append({"stage":"convert","name":network_id,"seconds":round(timings[-1][2],3),"status":"done" if code == 0 else "failed"})
+				print(f"  {'Converted' if code == 0 else 'Failed to convert'} network {network_id} in {timings[-1][2]:.1f} s ({timings[-1][3]:.1f} s after start)",flush=True)
+		converters = [asyncio.create_task(converter()) for n in range(workers)]
+		for network_id in network_ids:
+			folder = table_store.partition_folder(csvdir,network_id)
+			os.makedirs(folder,exist_ok=True)
+			partition = {name:parts.pop(network_id,headers[name]) for name, parts in groups.items()}
+			await loop.run_in_executor(pool,table_store.save_tables,folder,partition)
+			if network_id in networks:
+				await ready.put(network_id)
+		for task in converters:
+			await ready.put(None)
+		await asyncio.gather(*converters)
+	if timings:
+		print(f"  Pipeline converted {len(timings)} networks in {time.time()-started:.1f} s, first network done after {min(timing[3] for timing in timings):.1f} s",flush=True)
+	return {network_id:code for network_id, code, duration, elapsed in timings}
+
+def supervise_network(network_id,command,timeout=None,cpu=None,memory=None,report=None):
+	"""Convert a network in a supervised worker with the limits given (see `supervisor.supervise()`), returns its result
+
+	The status of the result is "done", "failed", or "killed" when the worker
+	exceeded a limit.  If `report` is given, the performance record of the
+	conversion is appended to it.
+	"""
+	result = supervisor.supervise(command(network_id),timeout,cpu,memory)
+	result["status"] = "killed" if result["exceeded"] else ("done" if result["code"] == 0 else "failed")
+	if report is not None:
+		report.append({"stage":"convert","name":network_id,"status":result["status"],
+			**{name:result[name] for name in ["seconds","cpu_seconds","peak_rss_kb"]}})
+	if result["exceeded"]:
+		print(f"  Killed the conversion of network {network_id} after {result['seconds']:.1f} s ({result['exceeded']} exceeded)",flush=True)
+	return result
+
+def convert_networks(networks,command,timeout=None,cpu=None,memory=None,workers=DEFAULT_WORKERS,report=None):
+	"""Convert each network in a supervised worker, at most `workers` at a time, returns the result of each network
+
+	The command converting a network is given by `command(network_id)`.  A
+	worker that exceeds a limit is killed and the other networks are converted
+	normally.
+	"""
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(int(workers),1)) as pool:
+		results = list(pool.map(lambda network_id: supervise_network(network_id,command,timeout,cpu,memory,report),networks))
+	return dict(zip(networks,results))
+
+def postproc_dependencies(makefile):
+	"""Get the postprocessors each postprocessor depends on from the rules of the postproc Makefile"""
+	dependencies = {}
+	with open(makefile,"r") as fh:
+		for line in fh:
+			if ":" in line and not line[0].isspace():
+				target, prerequisites = line.split(":",1)
+				if target.strip().endswith(".py"):
+					dependencies[target.strip()] = [name for name in prerequisites.split() if name.endswith(".py")]
+	return dependencies
+
+def run_postprocs(postprocs,command,dependencies={},status={},report=None,outputs=None):
+	"""Run the postprocessors concurrently in dependency order, returns the status and wall time of each
+
+	The shell command of a postprocessor is given by `command(process)`, or a
+	function returning the exit code when it runs in-process.  A
+	postprocessor starts as soon as the postprocessors it depends on (among those
+	listed) are done, and it is skipped if one of them failed or was skipped.
+	The `status` dict gives the status ("done" or "failed") of the
+	postprocessors that were already run.  If `report` is given, the
+	performance record of each run is appended to it.  If `outputs` is given,
+	it is the `postproc_cache.OutputCache` from which the outputs of a
+	postprocessor are restored instead of running it, and in which the outputs
+	of the postprocessors run are stored.
+	"""
+	status = dict(status)
+	timing = {}
+	pending = [process for process in postprocs if process not in status]
+	running = {}
+	def run(process):
+		measure = run_report.Measure("postproc",process)
+		if outputs is not None and outputs.restore(process):
+			print(f"  Restored the outputs of {process} from '{outputs.folder}/{outputs.keys[process]}'",flush=True)
+			code, state = 0, "cached"
+		else:
+			before = outputs.snapshot() if outputs is not None else None
+			call = command(process)
+			code = call() if callable(call) else measure.wait(subprocess.Popen(call,shell=True))
+			state = "done" if code == 0 else "failed"
+			if outputs is not None and code == 0:
+				outputs.store(process,before)
+		if report is not None:
+			report.append(measure.result(status=state))
+		return code, time.time()-measure.start
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(pending),1)) as pool:
+		while pending or running:
+			for process in list(pending):
+				needs = [name for name in dependencies.get(process,[]) if name in postprocs]
+				if [name for name in needs if status.get(name) in ["failed","skipped"]]:
+					status[process] = "skipped"
+					pending.remove(process)
+				elif not [name for name in needs if status.get(name) != "done"]:
+					running[pool.submit(run,process)] = process
+					pending.remove(process)
+			if not running: # the remaining postprocessors depend on each other
+				break
+			finished, unfinished = concurrent.futures.wait(running,return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in finished:
+				process = running.pop(future)
+				code, timing[process] = future.result()
+				status[process] = "done" if code == 0 else "failed"
+	for process in pending:
+		status[process] = "skipped"
+	return {process:(status[process],timing.get(process)) for process in postprocs}
+
+def run_spool(folder,csvdir,input_folder,output_folder,generated,flags="",networks=None,single=False,workers=spool.DEFAULT_WORKERS,lease=spool.DEFAULT_LEASE):
+	"""Convert the networks with workers claiming units from a shared spool folder, returns the exit code of each network
+
+	The job is converted by the local workers started here and by the workers
+	running on other hosts that share the spool folder.  While it waits, this
+	process also claims the units of workers that stopped renewing their lease.
+	See `spool.submit()` for `single`.
+	"""
+	os.makedirs(folder,exist_ok=True)
+	job = spool.submit(folder,csvdir,input_folder,generated,flags,networks,single)
+	print(f"  Spooled {len(os.listdir(f'{job}/units'))} networks in '{job}'",flush=True)
+	workers = [subprocess.Popen(["python3",f"{cache}/cyme-extract/postproc/spool.py","-l",str(lease),folder]) for n in range(int(workers))]
+	while not spool.complete(job):
+		time.sleep(spool.POLL_SECONDS)
+		spool.work(folder,lease,job)
+	for worker in workers:
+		worker.wait()
+	results = spool.merge(job,output_folder)
+	shutil.rmtree(job)
+	return results
+
+def in_memory(config,outputs,cachedir=None,limits=None):
+	"""Check whether the streamed tables can be kept in memory instead of being saved
+
+	This is only the case when the in-process `write_glm.py` is the only reader
+	of the tables, i.e., no other postprocessor, output, cache, spool or
+	supervised worker needs the files.
+	"""
+	return (not cachedir and not limits
+		and {process for process in config["postproc"] if process} == {"write_glm.py"}
+		and not [ext for ext in ["csv","zip","sqlite"] if ext in outputs]
+		and str(config["columnar"]).lower() != "true"
+		and config["spool"] in [None,"","none"]
+		and postproc_cache.cache_folder(config["postproc_cache"]) is None)
+
+def make_plan(database,tables,index=None,networks=None,memory=planner.DEFAULT_MEMORY):
+	"""Plan the extraction and conversion from the table row counts, returns None if the rows cannot be counted"""
+	counts = planner.table_counts(database,index)
+	if counts is None:
+		print(f"  Cannot count the rows of '{database}', extracting as configured",flush=True)
+		return None
+	plan = planner.make_plan(counts,tables,planner.network_shares(database,networks),planner.memory_budget(memory))
+	print(f"  Planned {plan['rows']} rows ({plan['memory']} MB, {plan['seconds']} s), largest network {plan['network']} with {plan['network_rows']} rows ({plan['network_memory']} MB, {plan['network_seconds']} s)",flush=True)
+	print(f"  Plan for a {plan['budget']} MB budget: EXTRACT_LAYOUT = {plan['layout']}, EXTRACT_WORKERS = {plan['workers']}, PNG_DETAIL = {plan['png_detail']}",flush=True)
+	return plan
+
+def save_sqlite(database,csvdir,filename):
+	"""Save the tables extracted in the data folder to a SQLite database, with an index like index.csv"""
+	tables = table_store.load_tables(csvdir)
+	index = pd.DataFrame({
+		"database" : [database] * len(tables),
+		"table" : [f"CYM{name.upper()}" for name in tables],
+		"csvname" : [f"{name}.csv" for name in tables],
+		"size" : pd.Series([os.path.getsize(f"{csvdir}/{name}.csv") if os.path.exists(f"{csvdir}/{name}.csv") else None for name in tables],dtype=object),
+		"rows" : [len(data) for data in tables.values()],
+		})
+	table_store.save_sqlite(filename,tables,index)
 
 def main(inputs,outputs,options={}):
 	INPUTNAME = inputs[0]
@@ -82,6 +558,8 @@ def main(inputs,outputs,options={}):
 		TIMEZONE = "UTC"
 		POSTPROCS = []
 		OUTPUTTYPE = OUTPUTNAME.split(".")[1]
+		settings = pd.Series(dtype=str)
+	OUTPUTS = settings["OUTPUTS"].replace(","," ").split() if "OUTPUTS" in settings.keys() else DEFAULT_OUTPUT
 
 	if "ERROR_OUTPUT" in settings.keys() and os.path.exists(settings["ERROR_OUTPUT"]):
 		os.remove(settings["ERROR_OUTPUT"])
@@ -103,6 +581,7 @@ def main(inputs,outputs,options={}):
 		"inputs": INPUTTYPE,
 		"tables": TABLES,
 	}
+	PROCCONFIG.update(config_settings(settings))
 	flags = []
 	change_postprocs = False
 	for option in options:
@@ -126,36 +605,205 @@ def main(inputs,outputs,options={}):
 	print(f"  FILES = *.{PROCCONFIG['inputs']}",flush=True)
 	print(f"  TABLES = {PROCCONFIG['tables']}",flush=True)
 	print(f"  EXTRACT = {PROCCONFIG['extract']}",flush=True)
+	for name, (setting, default) in CONFIG_SETTINGS.items():
+		print(f"  {setting} = {PROCCONFIG[name]}",flush=True)
 	print(f"  POSTPROC = {PROCCONFIG['postproc']}",flush=True)
 	print(f"  OUTPUTS = {PROCCONFIG['outputs']}",flush=True)
 	print(f"  output_folder = {PROCCONFIG['output_folder']}",flush=True)
 
-	result = os.popen(f"python3 {cache}/cyme-extract/postproc/write_glm.py --cyme-tables").read()
-	tables = result.split()
+	tables = glm_writer.cyme_tables()
 
-	for table in tables:
-		csvname = table[3:].lower()
-		os.system(f"mdb-export {PROCCONFIG['input_folder']}/{INPUTNAME} {table} > {CSVDIR}/{csvname}.csv")
-		row_count = os.popen(f"wc -l {CSVDIR}/{csvname}.csv").read()
-		if (int(row_count.strip().split(" ")[0]) == 1) and PROCCONFIG["extract"] != "all":
-			os.remove(f"{CSVDIR}/{csvname}.csv")
+	if PROCCONFIG["columns"] == "used":
+		columns = postproc_columns(PROCCONFIG["postproc"])
+		if columns is None:
+			print(f"  Not all postprocessors list the columns they use, extracting all columns",flush=True)
+	elif PROCCONFIG["columns"] == "all":
+		columns = None
+	else:
+		raise Exception(f"extract columns '{PROCCONFIG['columns']}' is not valid (must be 'all' or 'used')")
+
+	DATABASE = f"{PROCCONFIG['input_folder']}/{INPUTNAME}"
+	if PROCCONFIG["scope"] == "networks":
+		networks = select_networks(DATABASE,
+			matches=settings["GLM_NETWORK_MATCHES"] if "GLM_NETWORK_MATCHES" in settings.keys() else ".*",
+			select=network_option(flags),
+			backend=PROCCONFIG["backend"])
+		print(f"  Extracting networks {' '.join(networks)}",flush=True)
+		where = {"NetworkId":set(networks)}
+	elif PROCCONFIG["scope"] == "database":
+		where = None
+	else:
+		raise Exception(f"extract scope '{PROCCONFIG['scope']}' is not valid (must be 'database' or 'networks')")
+	if PROCCONFIG["plan"] == "auto":
+		plan = make_plan(DATABASE,tables,f"{PROCCONFIG['output_folder']}/index.csv",
+			networks=where["NetworkId"] if where else None,
+			memory=PROCCONFIG["memory"])
+		if plan:
+			if plan["layout"] == "networks":
+				PROCCONFIG["layout"] = "networks"
+			PROCCONFIG["workers"] = plan["workers"]
+	elif PROCCONFIG["plan"] == "none":
+		plan = None
+	else:
+		raise Exception(f"extract plan '{PROCCONFIG['plan']}' is not valid (must be 'none' or 'auto')")
+	CACHEDIR = extract_cache.cache_folder(PROCCONFIG["cache"])
+	if CACHEDIR:
+		CACHEKEY = extract_cache.cache_key(DATABASE,
+			tables=tables,
+			extract=PROCCONFIG["extract"],
+			backend=PROCCONFIG["backend"],
+			mode=PROCCONFIG["mode"],
+			columns=columns,
+			networks=sorted(where["NetworkId"]) if where else None,
+			layout=PROCCONFIG["layout"])
+	limits = [supervisor.limit(PROCCONFIG[name]) for name in ["convert_timeout","convert_cpu","convert_memory"]]
+	limits = limits if [value for value in limits if value is not None] else None
+	isolated = {} # results of the networks converted by supervised workers
+	def network_command(network_id):
+		return ["python3",f"{cache}/cyme-extract/postproc/write_glm.py","-i",PROCCONFIG['input_folder'],"-o",PROCCONFIG['output_folder'],
+			"-c","config.csv","-d",CSVDIR,"-g",OUTPUTNAME] + shlex.split(flags) + network_flags(network_id,separated,flags)
+	converted = None # networks converted by the pipeline
+	memory_tables = None # streamed tables not saved, see in_memory()
+	separated = None # networks converted separately, see network_flags()
+	report = [] # performance records
+	measure = run_report.Measure("stage","extract",scope="process")
+	if PROCCONFIG["mode"] not in ["files","stream","pipeline"]:
+		raise Exception(f"extract mode '{PROCCONFIG['mode']}' is not valid (must be 'files', 'stream' or 'pipeline')")
+	elif PROCCONFIG["layout"] not in ["tables","networks"]:
+		raise Exception(f"extract layout '{PROCCONFIG['layout']}' is not valid (must be 'tables' or 'networks')")
+	elif PROCCONFIG["archive_format"] not in ["zip","tar.zst"]:
+		raise Exception(f"archive format '{PROCCONFIG['archive_format']}' is not valid (must be 'zip' or 'tar.zst')")
+	elif CACHEDIR and extract_cache.fetch(CACHEDIR,CACHEKEY,CSVDIR):
+		print(f"Using tables cached in '{CACHEDIR}/{CACHEKEY}'",flush=True)
+		if PROCCONFIG["mode"] in ["stream","pipeline"] and ("csv" in OUTPUTS or "zip" in OUTPUTS) and table_store.partition_index(CSVDIR):
+			table_store.save_csv(CSVDIR,table_store.load_tables(CSVDIR)) # whole tables, as when they are streamed
+	elif PROCCONFIG["mode"] == "pipeline":
+		async def convert_network(network_id):
+			if limits:
+				isolated[network_id] = await asyncio.get_running_loop().run_in_executor(None,
+					functools.partial(supervise_network,network_id,network_command,*limits))
+				return isolated[network_id]["code"]
+			proc = await asyncio.create_subprocess_shell(f"python3 {cache}/cyme-extract/postproc/write_glm.py -i {PROCCONFIG['input_folder']} -o {PROCCONFIG['output_folder']} -c config.csv -d {CSVDIR} -g {OUTPUTNAME} {flags} {shlex.join(network_flags(network_id,networks,flags))}")
+			return await proc.wait()
+		if "write_glm.py" in PROCCONFIG["postproc"]:
+			networks = select_networks(DATABASE,
+				matches=settings["GLM_NETWORK_MATCHES"] if "GLM_NETWORK_MATCHES" in settings.keys() else ".*",
+				select=network_option(flags),
+				backend=PROCCONFIG["backend"])
+		else:
+			networks = []
+		separated = networks
+		converted = asyncio.run(run_pipeline(DATABASE,tables,CSVDIR,networks,convert_network,
+			extract=PROCCONFIG["extract"],
+			workers=PROCCONFIG["workers"],
+			backend=PROCCONFIG["backend"],
+			columns=columns,
+			where=where,
+			queue_size=PROCCONFIG["queue"],
+			report=report))
+		if CACHEDIR:
+			extract_cache.store(CACHEDIR,CACHEKEY,CSVDIR,os.listdir(CSVDIR),PROCCONFIG["cache_size"])
+		if "csv" in OUTPUTS or "zip" in OUTPUTS:
+			table_store.save_csv(CSVDIR,table_store.load_tables(CSVDIR))
+	elif PROCCONFIG["mode"] == "stream":
+		cyme_tables = read_tables(DATABASE,tables,
+			extract=PROCCONFIG["extract"],
+			workers=PROCCONFIG["workers"],
+			backend=PROCCONFIG["backend"],
+			columns=columns,
+			where=where,
+			report=report)
+		if PROCCONFIG["layout"] == "networks":
+			table_store.save_partitions(CSVDIR,cyme_tables)
+		elif in_memory(PROCCONFIG,OUTPUTS,CACHEDIR,limits):
+			memory_tables = table_store.MemoryTables(CSVDIR,cyme_tables) # only the in-process write_glm.py reads the tables
+		elif "csv" in OUTPUTS or "zip" in OUTPUTS:
+			table_store.save_csv(CSVDIR,cyme_tables) # the postprocessors read the CSV files instead of a pickle
+		else:
+			table_store.save_tables(CSVDIR,cyme_tables)
+		if CACHEDIR:
+			extract_cache.store(CACHEDIR,CACHEKEY,CSVDIR,os.listdir(CSVDIR),PROCCONFIG["cache_size"])
+		if PROCCONFIG["layout"] == "networks" and ("csv" in OUTPUTS or "zip" in OUTPUTS):
+			table_store.save_csv(CSVDIR,cyme_tables)
+	else:
+		csvnames = export_tables(DATABASE,tables,CSVDIR,
+			extract=PROCCONFIG["extract"],
+			workers=PROCCONFIG["workers"],
+			backend=PROCCONFIG["backend"],
+			columns=columns,
+			where=where,
+			report=report)
+		if PROCCONFIG["layout"] == "networks":
+			table_store.partition_csv(CSVDIR,csvnames)
+		if CACHEDIR:
+			extract_cache.store(CACHEDIR,CACHEKEY,CSVDIR,os.listdir(CSVDIR),PROCCONFIG["cache_size"])
+	if str(PROCCONFIG["columnar"]).lower() == "true":
+		table_store.convert_columnar(CSVDIR)
+	if plan:
+		planner.save_plan(CSVDIR,plan)
+	report.append(measure.result())
+	if PROCCONFIG["spool"] not in [None,"","none"] and "write_glm.py" in PROCCONFIG["postproc"] and converted is None:
+		measure = run_report.Measure("stage","spool",scope="process")
+		separated = select_networks(DATABASE,
+			matches=settings["GLM_NETWORK_MATCHES"] if "GLM_NETWORK_MATCHES" in settings.keys() else ".*",
+			select=network_option(flags),
+			backend=PROCCONFIG["backend"])
+		converted = run_spool(PROCCONFIG["spool"],CSVDIR,PROCCONFIG["input_folder"],PROCCONFIG["output_folder"],OUTPUTNAME,flags,
+			networks=separated,
+			single=single_model(separated,flags),
+			workers=PROCCONFIG["spool_workers"],
+			lease=PROCCONFIG["spool_lease"])
+		report.append(measure.result())
 
 	if not os.path.exists(PROCCONFIG['output_folder']):
 		os.system(f"mkdir -p {PROCCONFIG['output_folder']}")
 
-	if "voltage_profile.py" in PROCCONFIG['postproc'] and "write_glm.py" in PROCCONFIG['postproc']:
-		PROCCONFIG['postproc'].sort(key = 'voltage_profile.py'.__eq__)
-
-	for process in (PROCCONFIG['postproc']):
-		if process == process: 
-			try:
-				os.system(f"python3 {cache}/cyme-extract/postproc/{process} -i {PROCCONFIG['input_folder']} -o {PROCCONFIG['output_folder']} -c config.csv -d {CSVDIR} -g {OUTPUTNAME} {flags}")
-			except:
-				import traceback
-				print(f"ERROR [mdb-cyme2glm]: {traceback.print_exc()}")
-				sys.exit(15)
-		else:
-			print(f'cannot run postprocessing function "{process}"',flush=True)
+	postprocs = [process for n, process in enumerate(PROCCONFIG['postproc']) if process and process not in PROCCONFIG['postproc'][:n]]
+	if (limits or PROCCONFIG["mode"] == "pipeline") and "write_glm.py" in postprocs and converted is None: # e.g., pipeline tables restored from the extract cache
+		separated = select_networks(DATABASE,
+			matches=settings["GLM_NETWORK_MATCHES"] if "GLM_NETWORK_MATCHES" in settings.keys() else ".*",
+			select=network_option(flags),
+			backend=PROCCONFIG["backend"])
+	measure = run_report.Measure("stage","postproc",scope="process")
+	def postproc_command(process):
+		if process == "write_glm.py" and separated is not None: # each network converted by a worker, supervised when limits are set
+			def convert():
+				isolated.update(convert_networks(separated,
+					network_command,*(limits if limits else []),
+					workers=PROCCONFIG["workers"],
+					report=report))
+				return 0 if not [result for result in isolated.values() if result["status"] != "done"] else 1
+			return convert
+		elif process == "write_glm.py": # converted in-process
+			return lambda: glm_writer.convert(PROCCONFIG['input_folder'],PROCCONFIG['output_folder'],CSVDIR,
+				config_file="config.csv",generated=OUTPUTNAME,options=shlex.split(flags),tables=memory_tables)["code"]
+		return f"python3 {cache}/cyme-extract/postproc/{process} -i {PROCCONFIG['input_folder']} -o {PROCCONFIG['output_folder']} -c config.csv -d {CSVDIR} -g {OUTPUTNAME} {postproc_flags(process,flags,separated,dependencies)}"
+	dependencies = postproc_dependencies(f"{cache}/cyme-extract/postproc/Makefile")
+	POSTCACHEDIR = postproc_cache.cache_folder(PROCCONFIG["postproc_cache"])
+	if POSTCACHEDIR:
+		outputs = postproc_cache.OutputCache(POSTCACHEDIR,
+			postproc_cache.fingerprints(postprocs,f"{cache}/cyme-extract/postproc",CSVDIR,PROCCONFIG["input_folder"],dict(settings.items()),tables,
+				options=[OUTPUTNAME,flags],
+				dependencies=dependencies),
+			PROCCONFIG["output_folder"],
+			settings=dict(settings.items()),
+			generated=OUTPUTNAME.split(".")[0],
+			size=PROCCONFIG["postproc_cache_size"])
+	else:
+		outputs = None
+	results = run_postprocs(postprocs,postproc_command,
+		dependencies=dependencies,
+		status={"write_glm.py":"failed" if [code for code in converted.values() if code != 0] else "done"} if converted is not None else {}, # networks already converted by the pipeline
+		report=report,
+		outputs=outputs)
+	report.append(measure.result())
+	print(f"OpenFIDO CYME-extract postprocessing:",flush=True)
+	for process, (status, duration) in results.items():
+		print(f"  {process}: {status}" + (f" in {duration:.1f} s" if duration is not None else ""),flush=True)
+	for network_id, result in isolated.items():
+		if result["status"] != "done":
+			print(f"  write_glm.py network {network_id}: {result['status']}" + (f" ({result['exceeded']} exceeded)" if result["exceeded"] else ""),flush=True)
+	failed = [process for process, (status, duration) in results.items() if status != "done"]
 
 	print(f"OpenFIDO CYME-extract Done. Moving config fiels to {PROCCONFIG['output_folder']}",flush=True)
 	file_names = os.listdir(PROCCONFIG['input_folder'])
@@ -165,5 +813,17 @@ def main(inputs,outputs,options={}):
 				if not os.path.exists(f"{PROCCONFIG['output_folder']}/{file_name}"):
 					shutil.copy2(os.path.join(PROCCONFIG['input_folder'], file_name), PROCCONFIG['output_folder'])
 
-	os.system(f"cd {CSVDIR} ; zip -q -R {PROCCONFIG['output_folder']}/{CSVDIRNAME}_tables.zip *.csv ./*.csv")
+	if "sqlite" in OUTPUTS:
+		save_sqlite(INPUTNAME,CSVDIR,f"{PROCCONFIG['output_folder']}/{CSVDIRNAME}_tables.sqlite")
+
+	if [x for x in os.listdir(CSVDIR) if x.endswith(".csv")]:
+		measure = run_report.Measure("stage","archive",scope="process")
+		archive_writer.write_archive(f"{PROCCONFIG['output_folder']}/{CSVDIRNAME}_tables.{PROCCONFIG['archive_format']}",CSVDIR,
+			level=int(PROCCONFIG["archive_level"]))
+		report.append(measure.result())
+	run_report.save_report(f"{PROCCONFIG['output_folder']}/{CSVDIRNAME}_run_report.json",INPUTNAME,report)
 	os.system(f"rm -rf {CSVDIR}")
+
+	if failed:
+		print(f"ERROR [mdb-cyme2glm]: postprocessing failed or skipped: {' '.join(failed)}",flush=True)
+		sys.exit(15)
@@ -6,5 +6,11 @@ for OPENFIDO_INPUT in $(find $PWD/autotest -name 'input_*' -type d -print -prune
 	OPENFIDO_OUTPUT=$PWD/autotest/output_${OPENFIDO_INPUT##*_}
 	rm -rf $OPENFIDO_OUTPUT
 	mkdir $OPENFIDO_OUTPUT
-	sh openfido.sh </dev/null 2>/dev/stdout 1>$OPENFIDO_OUTPUT/stdout | tee $OPENFIDO_OUTPUT/stderr
-done
\ No newline at end of file
+	bash openfido.sh </dev/null 2>/dev/stdout 1>$OPENFIDO_OUTPUT/stdout | tee $OPENFIDO_OUTPUT/stderr
+done
+for INPUT in $(find $PWD/autotest -name 'main_*' -type d -print -prune); do
+	OUTPUT=$PWD/autotest/output_main_${INPUT##*main_}
+	rm -rf $OUTPUT
+	mkdir $OUTPUT
+	python3 autotest/run_main.py $INPUT $OUTPUT </dev/null 2>/dev/stdout 1>$OUTPUT/stdout | tee $OUTPUT/stderr
+done
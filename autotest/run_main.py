@@ -0,0 +1,27 @@
+"""Run `__init__.main` on the databases of an autotest folder, as openfido runs the pipeline from Python
+
+Syntax: python3 autotest/run_main.py INPUTDIR OUTPUTDIR [OPTION ...]
+
+The postprocessors are run from this checkout, which is linked as
+`cyme-extract` in a temporary module cache.  The exit code is that of the
+first database that failed.
+"""
+
+import os, sys, tempfile, importlib.util
+
+if len(sys.argv) < 3:
+	print(__doc__.split("\n")[2],file=sys.stderr)
+	exit(1)
+source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+input_folder, output_folder = [os.path.abspath(folder) for folder in sys.argv[1:3]]
+spec = importlib.util.spec_from_file_location("cyme_extract",f"{source}/__init__.py")
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+with tempfile.TemporaryDirectory() as cache:
+	os.symlink(source,f"{cache}/cyme-extract")
+	module.cache = cache
+	os.chdir(input_folder)
+	for name in sorted(os.listdir(input_folder)):
+		if name.endswith(".mdb"):
+			module.main([name],[f"{output_folder}/{name.split('.')[0]}.glm"],sys.argv[3:])
@@ -4,7 +4,7 @@
 #
 # Environment:
 #
-#   OPENFIDO_INPUT --> input folder when MDB files are placed
+#   OPENFIDO_INPUT --> input folder when MDB files are placed (MDB files may be compressed with gzip, zip, or zstd)
 #   OPENFIDO_OUTPUT --> output folder when CSV files are placed
 #
 # Special files:
@@ -16,7 +16,16 @@
 #     EXTRACT,[all|non-empty] --> extracts all or only non-empty tables (default all)
 #     TIMEZONE,<country>/<city> --> changes localtime to use specified timezone (default UTC)
 #     POSTPROC,<file1> <file2> ... --> run postprocessing routines (default none)
-#     OUTPUTS,<ext1> <ext2> ... --> extensions to save (default "zip csv json")
+#     OUTPUTS,<ext1> <ext2> ... --> extensions to save (default "zip csv json", "sqlite" also saves the tables to <name>_tables.sqlite)
+#     JOBS,<number> --> number of databases to process concurrently (default 1)
+#     ARCHIVE_FORMAT,[zip|tar.zst] --> format of the tables archive (default zip)
+#     ARCHIVE_LEVEL,<0-9> --> compression level of the tables archive, 0 stores the files (default 6)
+#     BATCH,[no|yes] --> skip the databases already converted with the same config and retry the failed ones (default no)
+#     BATCH_RETRIES,<number> --> number of times a failed database is retried in batch mode (default 2)
+#     BATCH_BACKOFF,<seconds> --> delay before the first retry, doubled for each retry (default 10)
+#
+# Batch mode keeps a ledger of the databases converted in $OPENFIDO_OUTPUT/batch_ledger.csv
+# and the status and GLM file sha256 of the networks of each database in $OPENFIDO_OUTPUT/.batch/<name>.networks.csv
 #
 
 # current version of pipeline (increment this when a major change in functionality is deployed)
@@ -73,14 +82,45 @@ rm -rf $TMP
 mkdir -p "$TMP"
 cd "$TMP"
 
-# copy input files to workdir
+# copy one input file to workdir, compressed files are decompressed as they are read
+ingest_file()
+{
+	FILE=$1
+	NAME=$(basename "$FILE")
+	case "${NAME##*.}" in
+	gz)
+		gzip -dc "$FILE" > "${NAME%.*}"
+		;;
+	zst)
+		zstd -q -dc "$FILE" > "${NAME%.*}"
+		;;
+	zip)
+		# extract to a folder of its own, so that archives holding files with the same name do not overwrite each other's files while they are extracted
+		UNZIPDIR=$(mktemp -d "$TMP/.unzip-XXXXXX")
+		unzip -q -o "$FILE" -d "$UNZIPDIR"
+		find "$UNZIPDIR" -mindepth 1 -maxdepth 1 -exec mv -f {} . \;
+		rm -rf "$UNZIPDIR"
+		;;
+	*)
+		cp -R "$FILE" .
+		;;
+	esac
+}
+
+# copy input files to workdir, decompressing at most $JOBS archives at a time (read before the config file is copied)
 echo "Copying files from $OPENFIDO_INPUT..."
+JOBS=$(grep ^JOBS, $OPENFIDO_INPUT/config.csv 2>/dev/null | cut -f2- -d, | tr ',' ' ')
+PIDS=""
 for FILE in $(ls -1 $OPENFIDO_INPUT/*); do
 	echo "  $FILE ($(wc -c $FILE | awk '{print $1}') bytes)"
-	cp -R "$FILE" .
-	if [ "${FILE##*.}" == "gz" ]; then
-		gunzip ${FILE%.*}
-	fi
+	while [ $(jobs -rp | wc -l) -ge ${JOBS:-1} ]; do
+		wait -n
+	done
+	ingest_file "$FILE" &
+	PIDS="$PIDS $!"
+done
+for PID in $PIDS; do
+	wait $PID
 done
 
 # process config file
@@ -91,6 +131,12 @@ if [ -f "config.csv" ]; then
 	TIMEZONE=$(grep ^TIMEZONE, config.csv | cut -f2- -d, | tr ',' ' ')
 	POSTPROC=$(grep ^POSTPROC, config.csv | cut -f2- -d, | tr ',' ' ')
 	OUTPUTS=$(grep ^OUTPUTS, config.csv | cut -f2- -d, | tr ',' ' ')
+	JOBS=$(grep ^JOBS, config.csv | cut -f2- -d, | tr ',' ' ')
+	ARCHIVE_FORMAT=$(grep ^ARCHIVE_FORMAT, config.csv | cut -f2- -d, | tr ',' ' ')
+	ARCHIVE_LEVEL=$(grep ^ARCHIVE_LEVEL, config.csv | cut -f2- -d, | tr ',' ' ')
+	BATCH=$(grep ^BATCH, config.csv | cut -f2- -d, | tr ',' ' ')
+	BATCH_RETRIES=$(grep ^BATCH_RETRIES, config.csv | cut -f2- -d, | tr ',' ' ')
+	BATCH_BACKOFF=$(grep ^BATCH_BACKOFF, config.csv | cut -f2- -d, | tr ',' ' ')
 	echo "Config settings:"
 	echo "  FILES = ${FILES:-*.mdb}"
 	echo "  TABLES = ${TABLES:-*}"
@@ -98,6 +144,12 @@ if [ -f "config.csv" ]; then
 	echo "  TIMEZONE = ${TIMEZONE:-UTC}"
 	echo "  POSTPROC = ${POSTPROC:-}"
 	echo "  OUTPUTS = ${OUTPUTS:-${DEFAULT_OUTPUT}}"
+	echo "  JOBS = ${JOBS:-1}"
+	echo "  ARCHIVE_FORMAT = ${ARCHIVE_FORMAT:-zip}"
+	echo "  ARCHIVE_LEVEL = ${ARCHIVE_LEVEL:-6}"
+	echo "  BATCH = ${BATCH:-no}"
+	echo "  BATCH_RETRIES = ${BATCH_RETRIES:-2}"
+	echo "  BATCH_BACKOFF = ${BATCH_BACKOFF:-10}"
 else
 	echo "No 'config.csv', using default settings:"
 	echo "  FILES = *.mdb"
@@ -106,39 +158,232 @@ else
 	echo "  TIMEZONE = UTC"
 	echo "  POSTPROC = "
 	echo "  OUTPUTS = ${DEFAULT_OUTPUT}"
+	echo "  JOBS = 1"
+	echo "  ARCHIVE_FORMAT = zip"
+	echo "  ARCHIVE_LEVEL = 6"
+	echo "  BATCH = no"
+	echo "  BATCH_RETRIES = 2"
+	echo "  BATCH_BACKOFF = 10"
 fi
 
 # get list of required tables
 if [ "$TABLES" = "glm" ]; then
 	TABLES=$($SRCDIR/postproc/write_glm.py --cyme-tables)
 elif [ "$TABLES" = "all" ]; then
-	TABLES=$(mdb-tables "$DATABASE")
+	TABLES="" # use mdb-tables on each database
 fi
 
-# process the input files
-INDEX=index.csv
-echo "database,table,csvname,size,rows" > "$INDEX"
-for DATABASE in $(ls -1 *.mdb | grep ${FILES:-.\*}); do
+# run a command and save its wall time, CPU time and peak RSS (KB, when GNU time is installed) in the file given
+measure()
+{
+	OUTPUT=$1
+	shift
+	if [ -x /usr/bin/time ]; then
+		/usr/bin/time -f "%e %U %S %M" -o "$OUTPUT" "$@"
+	else
+		TIMEFORMAT="%R %U %S"
+		{ time "$@" 2>&3 ; } 3>&2 2>"$OUTPUT"
+	fi
+}
+
+# get the seconds,cpu_seconds,peak_rss_kb fields of a measure
+measured()
+{
+	tail -1 "$1" | awk '{printf "%s,%.3f,%s", $1, $2+$3, $4}'
+}
+
+# process one input file (index rows are written to $DATABASE.idx and performance records to $DATABASE.timing)
+process_database()
+{
+	DATABASE=$1
 	CSVDIR=$PWD/${DATABASE%.*}
+	TIMING=${DATABASE%.*}.timing
 	mkdir -p "$CSVDIR"
+	rm -f "${DATABASE%.*}.idx" "$TIMING"
 	for TABLE in ${TABLES:-$(mdb-tables "$DATABASE")}; do
 		CSV=$(echo $TABLE | cut -c4- | tr A-Z a-z).csv
-		mdb-export "$DATABASE" "$TABLE" > "$CSVDIR/$CSV"
+		measure "$CSVDIR.time" mdb-export "$DATABASE" "$TABLE" > "$CSVDIR/$CSV"
 		SIZE=$(wc -c $CSVDIR/$CSV | awk '{print $1}' )
 		ROWS=$(wc -l $CSVDIR/$CSV | awk '{print $1}' )
+		echo "export,$TABLE,$(measured "$CSVDIR.time"),$(($ROWS-1))" >> "$TIMING"
+		if [ "$TABLE" = "CYMNETWORK" ]; then
+			echo "$(($ROWS-1))" > "${DATABASE%.*}.networks"
+		fi
 		if [ "$ROWS" -gt 1 -o "${EXTRACT:-all}" = "all" ]; then
-			echo "$DATABASE,$TABLE,$CSV,$SIZE,$(($ROWS-1))" >> "$INDEX"
+			echo "$DATABASE,$TABLE,$CSV,$SIZE,$(($ROWS-1))" >> "${DATABASE%.*}.idx"
 		else
 			rm "$CSVDIR/$CSV"
 		fi
 	done
 	if [ "${POSTPROC:-}" != "" ]; then
 		for PROC in $(make -s -f $SRCDIR/postproc/Makefile $POSTPROC | tr '\n' ' '); do
-			( $SRCDIR/postproc/$PROC -i${OPENFIDO_INPUT} -o${OPENFIDO_OUTPUT} -c${OPENFIDO_INPUT}/config.csv -d${CSVDIR} </dev/null )
+			if [ "$PROC" = "write_glm.py" -a "${BATCH:-no}" = "yes" ]; then
+				batch_networks "$DATABASE" "$CSVDIR"
+				continue
+			elif [ "${BATCH:-no}" = "yes" -a -s "$CSVDIR.ids" ] && grep -q "^$PROC:.*write_glm.py" $SRCDIR/postproc/Makefile; then
+				# read the model of each network converted by batch_networks
+				( measure "$CSVDIR.time" $SRCDIR/postproc/$PROC -i${OPENFIDO_INPUT} -o${OPENFIDO_OUTPUT} -c${OPENFIDO_INPUT}/config.csv -d${CSVDIR} -g "${DATABASE%.*}" -n "$(paste -sd' ' "$CSVDIR.ids")" </dev/null )
+			else
+				( measure "$CSVDIR.time" $SRCDIR/postproc/$PROC -i${OPENFIDO_INPUT} -o${OPENFIDO_OUTPUT} -c${OPENFIDO_INPUT}/config.csv -d${CSVDIR} -g "${DATABASE%.*}" </dev/null )
+			fi
+			echo "postproc,$PROC,$(measured "$CSVDIR.time")," >> "$TIMING"
 		done
 	fi
-	(cd "$CSVDIR" ; zip -q "${OPENFIDO_OUTPUT}/${DATABASE%.*}.zip" *.csv )
-	rm -rf "$CSVDIR"
+	measure "$CSVDIR.time" python3 $SRCDIR/postproc/archive_writer.py -l ${ARCHIVE_LEVEL:-6} "${OPENFIDO_OUTPUT}/${DATABASE%.*}.${ARCHIVE_FORMAT:-zip}" "$CSVDIR" $(cd "$CSVDIR" ; ls -1 *.csv)
+	echo "stage,archive,$(measured "$CSVDIR.time")," >> "$TIMING"
+	if echo " ${OUTPUTS:-} " | grep -q " sqlite "; then
+		# save the tables and their index rows to SQLite
+		( echo "database,table,csvname,size,rows" ; cat "${DATABASE%.*}.idx" ) > "$CSVDIR.index"
+		python3 $SRCDIR/postproc/table_store.py -i "$CSVDIR.index" "${OPENFIDO_OUTPUT}/${DATABASE%.*}_tables.sqlite" "$CSVDIR"
+	fi
+	python3 $SRCDIR/postproc/run_report.py "$DATABASE" "$TIMING" "${OPENFIDO_OUTPUT}/${DATABASE%.*}_run_report.json" || echo "WARNING: unable to save the run report of $DATABASE" >/dev/stderr
+	rm -rf "$CSVDIR" "$CSVDIR.time" "$CSVDIR.ids" "$CSVDIR.index" "$TIMING"
+}
+
+# convert the networks of a database one at a time in batch mode
+#
+# The status of each network is kept in $BATCHDIR/<name>.networks.csv with the
+# sha256 of its GLM file, and the networks already converted from the same
+# database and config are skipped while their GLM file is unchanged.
+# A database with a single network is still converted into <name>.glm,
+# otherwise each network is converted into <name>_<NetworkId>.glm and the
+# networks are listed in $CSVDIR.ids for the postprocessors that depend on
+# write_glm.py.  Fails when the conversion of a network failed.
+batch_networks()
+{
+	DATABASE=$1
+	CSVDIR=$2
+	NETWORKS="$BATCHDIR/${DATABASE%.*}.networks.csv"
+	if ! head -1 "$NETWORKS" 2>/dev/null | grep -q ",glm_hash$"; then
+		echo "network,hash,status,attempt,started,finished,seconds,glm_hash" > "$NETWORKS"
+	fi
+	if [ -f "$CSVDIR/network.csv" ]; then
+		python3 -c "import sys, pandas; print('\n'.join(pandas.read_csv(sys.argv[1],dtype=str)['NetworkId'].dropna()))" "$CSVDIR/network.csv" > "$CSVDIR.ids"
+	fi
+	SINGLE=""
+	if [ $(cat "$CSVDIR.ids" 2>/dev/null | wc -l) -eq 1 ]; then
+		SINGLE="-s"
+	fi
+	FAILED_NETWORKS=0
+	for NETWORK in $(cat "$CSVDIR.ids" 2>/dev/null); do
+		if [ -n "$SINGLE" ]; then
+			GLMFILE="${OPENFIDO_OUTPUT}/${DATABASE%.*}.glm"
+		else
+			GLMFILE="${OPENFIDO_OUTPUT}/${DATABASE%.*}_$NETWORK.glm"
+		fi
+		GLM_HASH=$(sha256sum "$GLMFILE" 2>/dev/null | cut -c1-64 || true)
+		if [ -n "$GLM_HASH" ] && awk -F, -v network="$NETWORK" -v hash="$HASH" -v glm="$GLM_HASH" '$1 == network && $2 == hash && $3 == "done" && $8 == glm { found = 1 } END { exit !found }' "$NETWORKS"; then
+			echo "  $DATABASE network $NETWORK already converted, skipping"
+			continue
+		fi
+		STARTED=$(date +%s)
+		if measure "$CSVDIR.time" $SRCDIR/postproc/write_glm.py -i${OPENFIDO_INPUT} -o${OPENFIDO_OUTPUT} -c${OPENFIDO_INPUT}/config.csv -d${CSVDIR} -g "${DATABASE%.*}" -n "$NETWORK" $SINGLE </dev/null; then
+			STATUS=done
+		else
+			STATUS=failed
+			FAILED_NETWORKS=$(($FAILED_NETWORKS+1))
+		fi
+		FINISHED=$(date +%s)
+		GLM_HASH=$(sha256sum "$GLMFILE" 2>/dev/null | cut -c1-64 || true)
+		echo "convert,$NETWORK,$(measured "$CSVDIR.time")," >> "$TIMING"
+		echo "$NETWORK,$HASH,$STATUS,$ATTEMPT,$STARTED,$FINISHED,$(($FINISHED-$STARTED)),$GLM_HASH" >> "$NETWORKS"
+	done
+	if [ -n "$SINGLE" ]; then
+		rm "$CSVDIR.ids" # the postprocessors read <name>.glm
+	fi
+	[ $FAILED_NETWORKS -eq 0 ]
+}
+
+# batch mode ledger (one row per conversion attempt, kept in the output folder)
+LEDGER="$OPENFIDO_OUTPUT/batch_ledger.csv"
+BATCHDIR="$OPENFIDO_OUTPUT/.batch"
+BATCH_START=$(date +%s)
+if [ "${BATCH:-no}" = "yes" ]; then
+	mkdir -p "$BATCHDIR"
+	if [ ! -f "$LEDGER" ]; then
+		echo "database,hash,status,attempt,started,finished,seconds,networks,output_hash" > "$LEDGER"
+	fi
+fi
+
+# print the batch throughput since the job started
+batch_summary()
+{
+	awk -F, -v start=$BATCH_START -v now=$(date +%s) -v total=$1 '
+		$3 == "done" && $5 >= start { databases++; networks += $8 }
+		END {
+			hours = (now > start ? now - start : 1) / 3600
+			printf "  Batch progress: %d of %d databases converted, %.1f databases/hour, %.1f networks/hour\n", databases, total, databases/hours, networks/hours
+		}' "$LEDGER"
+}
+
+# process one input file in batch mode, unless it was already converted with the same config
+batch_database()
+{
+	DATABASE=$1
+	HASH=$(cat "$DATABASE" config.csv 2>/dev/null | sha256sum | cut -c1-64)
+	if awk -F, -v database="$DATABASE" -v hash="$HASH" '$1 == database && $2 == hash && $3 == "done" { found = 1 } END { exit !found }' "$LEDGER"; then
+		echo "  $DATABASE already converted, skipping"
+		if [ -f "$BATCHDIR/${DATABASE%.*}.idx" ]; then
+			cp "$BATCHDIR/${DATABASE%.*}.idx" .
+		fi
+		return 0
+	fi
+	RETRIES=${BATCH_RETRIES:-2}
+	for ATTEMPT in $(seq 1 $(($RETRIES+1))); do
+		STARTED=$(date +%s)
+		rm -f "${DATABASE%.*}.networks"
+		process_database "$DATABASE" &
+		if wait $!; then
+			STATUS=done
+		else
+			STATUS=failed
+		fi
+		FINISHED=$(date +%s)
+		NETWORKS=$(cat "${DATABASE%.*}.networks" 2>/dev/null || echo 0)
+		OUTPUT_HASH=$(sha256sum "${OPENFIDO_OUTPUT}/${DATABASE%.*}.${ARCHIVE_FORMAT:-zip}" 2>/dev/null | cut -c1-64 || true)
+		echo "$DATABASE,$HASH,$STATUS,$ATTEMPT,$STARTED,$FINISHED,$(($FINISHED-$STARTED)),$NETWORKS,$OUTPUT_HASH" >> "$LEDGER"
+		if [ "$STATUS" = "done" ]; then
+			if [ -f "${DATABASE%.*}.idx" ]; then
+				cp "${DATABASE%.*}.idx" "$BATCHDIR"
+			fi
+			batch_summary $(echo $DATABASES | wc -w)
+			return 0
+		elif [ $ATTEMPT -le $RETRIES ]; then
+			DELAY=$((${BATCH_BACKOFF:-10} * 2**($ATTEMPT-1)))
+			echo "  $DATABASE failed (attempt $ATTEMPT), retrying in $DELAY seconds"
+			sleep $DELAY
+		fi
+	done
+	echo "  $DATABASE failed after $ATTEMPT attempts"
+	touch "${DATABASE%.*}.failed"
+}
+
+# process the input files, at most $JOBS at a time
+DATABASES=$(ls -1 *.mdb | grep ${FILES:-.\*})
+PIDS=""
+for DATABASE in $DATABASES; do
+	while [ $(jobs -rp | wc -l) -ge ${JOBS:-1} ]; do
+		wait -n
+	done
+	if [ "${BATCH:-no}" = "yes" ]; then
+		batch_database "$DATABASE" &
+	else
+		process_database "$DATABASE" &
+	fi
+	PIDS="$PIDS $!"
+done
+for PID in $PIDS; do
+	wait $PID
+done
+
+# collect the index in database order
+INDEX=index.csv
+echo "database,table,csvname,size,rows" > "$INDEX"
+for DATABASE in $DATABASES; do
+	if [ -f "${DATABASE%.*}.idx" ]; then
+		cat "${DATABASE%.*}.idx" >> "$INDEX"
+		rm "${DATABASE%.*}.idx"
+	fi
 done
 
 # output version info
@@ -152,3 +397,10 @@ for EXT in ${OUTPUTS:-${DEFAULT_OUTPUT}}; do
 		mv $FILE "$OPENFIDO_OUTPUT"
 	done
 done
+
+# report the databases that could not be converted in batch mode
+FAILED=$(ls -1 *.failed 2>/dev/null | sed 's/\.failed$//' | tr '\n' ' ')
+if [ -n "$FAILED" ]; then
+	echo "Batch conversion failed for $FAILED(see $LEDGER)"
+	exit 1
+fi
@@ -0,0 +1,174 @@
+"""Parallel archive writer for the extracted tables
+
+The files of a data folder are compressed concurrently, one file per worker
+thread (zlib releases the GIL), and the compressed members are streamed into
+the zip file in order as soon as they are ready.  Compression level 0 stores
+the files without compressing them, which is the fastest option when the
+archive is only used to move the tables around.  Zip64 records are used when
+the files or the archive are too large for the classic zip format.
+
+Archives named `*.tar.zst` are written as a tar stream compressed by the
+multi-threaded `zstd` command instead, which is faster and smaller for very
+large extracts.
+
+Config settings:
+
+	ARCHIVE_FORMAT,[zip|tar.zst] --> format of the tables archive (default zip)
+	ARCHIVE_LEVEL,<0-9> --> compression level, 0 stores the files (default 6)
+
+Command line:
+
+	python3 archive_writer.py [-l|--level N] [-j|--jobs N] ARCHIVE FOLDER [NAME ...]
+
+archives the named files of the folder, or all its CSV files (including those
+in sub-folders) if no names are given.
+"""
+
+import os, sys, getopt, glob, struct, time, zlib, shutil, tempfile, subprocess, tarfile, collections, itertools
+import concurrent.futures
+
+DEFAULT_FORMAT = "zip"
+DEFAULT_LEVEL = 6
+BLOCK_SIZE = 1048576 # bytes read at a time
+ZIP64_LIMIT = 0xFFFFFFFF # sizes and offsets from which zip64 records are needed
+ZIP64_COUNT = 0xFFFF # number of members from which a zip64 end record is needed
+
+def archive_names(folder,pattern="*.csv"):
+	"""Get the paths relative to the folder of the files matching the pattern, including those in sub-folders"""
+	return sorted(os.path.relpath(name,folder) for name in glob.glob(f"{folder}/**/{pattern}",recursive=True))
+
+def compress_member(filename,level,tmpdir):
+	"""Compress one file, returns the member info and the temporary file holding the compressed data"""
+	crc, size = 0, 0
+	if level > 0:
+		compressor = zlib.compressobj(level,zlib.DEFLATED,-15)
+		data = tempfile.TemporaryFile(dir=tmpdir)
+	else:
+		data = None
+	with open(filename,"rb") as fh:
+		for block in iter(lambda: fh.read(BLOCK_SIZE), b""):
+			crc = zlib.crc32(block,crc)
+			size += len(block)
+			if data:
+				data.write(compressor.compress(block))
+	if data:
+		data.write(compressor.flush())
+		csize = data.tell()
+		data.seek(0)
+	else:
+		csize = size
+	return {"crc":crc,"size":size,"csize":csize,"method":8 if data else 0,"mtime":os.path.getmtime(filename)}, data
+
+def dos_time(mtime):
+	"""Get the MS-DOS time and date of a file modification time"""
+	t = time.localtime(mtime)
+	if t.tm_year < 1980:
+		return 0, (1<<5)|1
+	return (t.tm_hour<<11)|(t.tm_min<<5)|(t.tm_sec//2), ((t.tm_year-1980)<<9)|(t.tm_mon<<5)|t.tm_mday
+
+def local_header(name,member):
+	"""Get the local file header of a zip member"""
+	size, csize, extra = member["size"], member["csize"], b""
+	if size >= ZIP64_LIMIT or csize >= ZIP64_LIMIT:
+		extra = struct.pack("<HHQQ",1,16,size,csize)
+		size = csize = 0xFFFFFFFF
+	mtime, mdate = dos_time(member["mtime"])
+	return struct.pack("<IHHHHHIIIHH",0x04034b50,45 if extra else 20,0x800,member["method"],mtime,mdate,
+		member["crc"],csize,size,len(name),len(extra)) + name + extra
+
+def central_header(name,member,offset):
+	"""Get the central directory header of a zip member"""
+	size, csize, fields = member["size"], member["csize"], []
+	if size >= ZIP64_LIMIT:
+		fields.append(size)
+		size = 0xFFFFFFFF
+	if csize >= ZIP64_LIMIT:
+		fields.append(csize)
+		csize = 0xFFFFFFFF
+	if offset >= ZIP64_LIMIT:
+		fields.append(offset)
+		offset = 0xFFFFFFFF
+	extra = struct.pack(f"<HH{len(fields)}Q",1,8*len(fields),*fields) if fields else b""
+	mtime, mdate = dos_time(member["mtime"])
+	return struct.pack("<IHHHHHHIIIHHHHHII",0x02014b50,0x0314,45 if fields else 20,0x800,member["method"],mtime,mdate,
+		member["crc"],csize,size,len(name),len(extra),0,0,0,0o100644<<16,offset) + name + extra
+
+def end_records(count,offset,size):
+	"""Get the end of central directory records"""
+	records = b""
+	if count >= ZIP64_COUNT or offset >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+		records += struct.pack("<IQHHIIQQQQ",0x06064b50,44,45,45,0,0,count,count,size,offset)
+		records += struct.pack("<IIQI",0x07064b50,0,offset+size,1)
+	return records + struct.pack("<IHHHHIIH",0x06054b50,0,0,min(count,0xFFFF),min(count,0xFFFF),
+		min(size,0xFFFFFFFF),min(offset,0xFFFFFFFF),0)
+
+def write_zip(filename,folder,names,level=DEFAULT_LEVEL,workers=None):
+	"""Write the named files of the folder to a zip file, compressing them concurrently"""
+	workers = int(workers) if workers else os.cpu_count()
+	tmpdir = os.path.dirname(os.path.abspath(filename))
+	central = []
+	with open(filename,"wb") as fh, concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		names = iter(names)
+		submit = lambda name: (name,pool.submit(compress_member,f"{folder}/{name}",int(level),tmpdir))
+		pending = collections.deque(submit(name) for name in itertools.islice(names,2*workers)) # limits the compressed data waiting
+		while pending:
+			name, future = pending.popleft()
+			pending.extend(submit(name) for name in itertools.islice(names,1))
+			member, data = future.result()
+			arcname = name.replace(os.sep,"/").encode()
+			offset = fh.tell()
+			fh.write(local_header(arcname,member))
+			if data:
+				with data:
+					shutil.copyfileobj(data,fh,BLOCK_SIZE)
+			else:
+				with open(f"{folder}/{name}","rb") as src:
+					shutil.copyfileobj(src,fh,BLOCK_SIZE)
+			central.append(central_header(arcname,member,offset))
+		offset = fh.tell()
+		for header in central:
+			fh.write(header)
+		fh.write(end_records(len(central),offset,fh.tell()-offset))
+
+def write_tar_zst(filename,folder,names,level=DEFAULT_LEVEL,workers=None):
+	"""Write the named files of the folder to a tar file compressed by zstd"""
+	workers = int(workers) if workers else os.cpu_count()
+	level = f"-{level}" if int(level) > 0 else "--fast"
+	with open(filename,"wb") as fh:
+		zstd = subprocess.Popen(["zstd","-q",level,f"-T{workers}","-c"],stdin=subprocess.PIPE,stdout=fh)
+		with tarfile.open(fileobj=zstd.stdin,mode="w|") as tar:
+			for name in names:
+				tar.add(f"{folder}/{name}",arcname=name)
+		zstd.stdin.close()
+		if zstd.wait() != 0:
+			raise RuntimeError(f"zstd failed to write '{filename}' (exit code {zstd.returncode})")
+
+def write_archive(filename,folder,names=None,level=DEFAULT_LEVEL,workers=None):
+	"""Write the named files of the folder, or all its CSV files, to a zip or tar.zst archive"""
+	if names is None:
+		names = archive_names(folder)
+	try:
+		if filename.endswith(".tar.zst"):
+			write_tar_zst(filename,folder,names,level,workers)
+		else:
+			write_zip(filename,folder,names,level,workers)
+	except:
+		if os.path.exists(filename):
+			os.remove(filename)
+		raise
+
+if __name__ == "__main__":
+	opts, args = getopt.getopt(sys.argv[1:],"hl:j:",["help","level=","jobs="])
+	level, workers = DEFAULT_LEVEL, None
+	for opt, arg in opts:
+		if opt in ("-h","--help"):
+			print(__doc__)
+			exit(0)
+		elif opt in ("-l","--level"):
+			level = int(arg)
+		elif opt in ("-j","--jobs"):
+			workers = int(arg)
+	if len(args) < 2:
+		print("Syntax: python3 archive_writer.py [-l|--level N] [-j|--jobs N] ARCHIVE FOLDER [NAME ...]",file=sys.stderr)
+		exit(1)
+	write_archive(args[0],args[1],args[2:] if len(args) > 2 else None,level,workers)
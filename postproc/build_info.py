@@ -0,0 +1,86 @@
+"""Build information of the installed postprocessors
+
+The git project URL, commit and branch of the installation are read from the
+`.git` folder directly, without running `git` each time a postprocessor
+starts.  Installations without a `.git` folder (e.g., copied into a container
+image) save the information in `build_info.json` in the postproc folder when
+they are installed, which is used in preference when it exists.
+
+Command line:
+
+	python3 build_info.py
+
+saves `build_info.json` (run it again after updating the installation, or
+remove it to read the `.git` folder again).
+"""
+
+import os, sys, json, configparser, functools
+
+BUILD_INFO = "build_info.json"
+
+def git_folder(path):
+	"""Get the .git folder of the repository holding the path, or None"""
+	path = os.path.abspath(path)
+	while True:
+		if os.path.isdir(f"{path}/.git"):
+			return f"{path}/.git"
+		elif os.path.isfile(f"{path}/.git"): # worktree or submodule
+			with open(f"{path}/.git","r") as fh:
+				gitdir = fh.read().strip()
+			if gitdir.startswith("gitdir:"):
+				return os.path.join(path,gitdir[7:].strip())
+		if os.path.dirname(path) == path:
+			return None
+		path = os.path.dirname(path)
+
+def read_ref(folder,ref):
+	"""Get the commit of a ref from the loose refs or the packed refs"""
+	if os.path.exists(f"{folder}/{ref}"):
+		with open(f"{folder}/{ref}","r") as fh:
+			return fh.read().strip()
+	if os.path.exists(f"{folder}/packed-refs"):
+		with open(f"{folder}/packed-refs","r") as fh:
+			for line in fh:
+				fields = line.split()
+				if len(fields) == 2 and fields[1] == ref:
+					return fields[0]
+	return ""
+
+def git_info(path):
+	"""Get the project URL, commit and branch of the repository holding the path, like `git config` and `git rev-parse` do"""
+	folder = git_folder(path)
+	if not folder:
+		return {"project":"","commit":"","branch":""}
+	with open(f"{folder}/HEAD","r") as fh:
+		head = fh.read().strip()
+	if head.startswith("ref:"):
+		ref = head[4:].strip()
+		commit, branch = read_ref(folder,ref), ref.split("/",2)[-1]
+	else: # detached head
+		commit, branch = head, "HEAD"
+	config = configparser.ConfigParser(strict=False,interpolation=None)
+	try:
+		config.read(f"{folder}/config")
+		project = config.get('remote "origin"',"url",fallback="")
+	except configparser.Error:
+		project = ""
+	return {"project":project,"commit":commit,"branch":branch}
+
+def save_build_info(path=os.path.dirname(os.path.abspath(__file__))):
+	"""Save the build information of the installation in the folder, returns it"""
+	info = git_info(path)
+	with open(f"{path}/{BUILD_INFO}","w") as fh:
+		json.dump(info,fh,indent=1)
+	return info
+
+@functools.lru_cache()
+def build_info(path=os.path.dirname(os.path.abspath(__file__))):
+	"""Get the build information saved at install time, or else that of the .git folder (read once per process)"""
+	if os.path.exists(f"{path}/{BUILD_INFO}"):
+		with open(f"{path}/{BUILD_INFO}","r") as fh:
+			return json.load(fh)
+	return git_info(path)
+
+if __name__ == "__main__":
+	info = save_build_info()
+	print(" ".join(f"{name}={value}" for name, value in info.items()))
@@ -0,0 +1,118 @@
+"""Content-addressed cache of extracted CYME tables
+
+Extracted tables are stored in a cache folder under a key computed from the
+SHA-256 hash of the MDB file content and the extraction options (the table
+list, the extract condition, etc.), so that converting the same database
+again, e.g., with different GLM settings, does not need to run `mdb-export`.
+
+Each entry is a sub-folder named after its key holding the files that were
+extracted (and the sub-folders of partitioned tables).  Tables streamed into
+a `tables.pickle` file are stored as CSV files instead, so that the cache
+never holds files that are unpickled when they are used, and an entry that
+holds one (e.g., stored by an older version) is removed when it is found.
+Entries are touched when they are used, and the least recently used entries
+are removed when the total size of the cache exceeds its limit.
+
+Config settings:
+
+	EXTRACT_CACHE,[none|default|<folder>] --> cache folder (default none)
+	EXTRACT_CACHE_SIZE,<megabytes> --> cache size limit (default 1024)
+"""
+
+import os, shutil, hashlib, json
+import table_store
+
+DEFAULT_FOLDER = "/usr/local/share/openfido/cyme-extract-cache"
+DEFAULT_SIZE = 1024 # MB
+
+def cache_folder(name):
+	"""Get the cache folder from the EXTRACT_CACHE setting, or None if caching is disabled"""
+	if name in [None,"","none"]:
+		return None
+	elif name == "default":
+		return DEFAULT_FOLDER
+	return name
+
+def file_hash(filename,blocksize=1048576):
+	"""Get the SHA-256 hash of a file content"""
+	sha = hashlib.sha256()
+	with open(filename,"rb") as fh:
+		for block in iter(lambda: fh.read(blocksize), b""):
+			sha.update(block)
+	return sha.hexdigest()
+
+def cache_key(filename,**options):
+	"""Get the cache key of the tables extracted from a database with the options given"""
+	sha = hashlib.sha256(file_hash(filename).encode())
+	sha.update(json.dumps(options,sort_keys=True,default=str).encode())
+	return sha.hexdigest()
+
+def entry(folder,key):
+	"""Get the folder of a cached entry and mark it as used, or None if the key is not cached"""
+	path = f"{folder}/{key}"
+	if not os.path.isdir(path):
+		return None
+	elif [files for name, folders, files in os.walk(path) if table_store.PICKLE_NAME in files]:
+		shutil.rmtree(path,ignore_errors=True) # pickled tables are not loaded from the cache
+		return None
+	os.utime(path)
+	return path
+
+def fetch(folder,key,target):
+	"""Copy the cached files into the target folder, returns False if the key is not cached"""
+	path = entry(folder,key)
+	if not path:
+		return False
+	os.makedirs(target,exist_ok=True)
+	for name in os.listdir(path):
+		copy(f"{path}/{name}",f"{target}/{name}")
+	return True
+
+def copy(source,target):
+	"""Copy a file or a folder"""
+	if os.path.isdir(source):
+		shutil.copytree(source,target,dirs_exist_ok=True)
+	else:
+		shutil.copy(source,target)
+
+def store(folder,key,source,names,maxsize=DEFAULT_SIZE):
+	"""Copy the named files or folders from the source folder into the cache and evict old entries"""
+	entry = f"{folder}/{key}"
+	if os.path.isdir(entry):
+		os.utime(entry)
+		return
+	tmpdir = f"{folder}/.{key}-{os.getpid()}"
+	os.makedirs(tmpdir,exist_ok=True)
+	for name in names:
+		if name == table_store.PICKLE_NAME:
+			table_store.save_csv(tmpdir,table_store.load_shared(source))
+		elif os.path.isdir(f"{source}/{name}"):
+			table_store.copy_csv(f"{source}/{name}",f"{tmpdir}/{name}")
+		else:
+			shutil.copy(f"{source}/{name}",f"{tmpdir}/{name}")
+	try:
+		os.rename(tmpdir,entry)
+	except OSError:
+		shutil.rmtree(tmpdir,ignore_errors=True) # another process stored the same entry
+	evict(folder,maxsize,keep=key)
+
+def entry_size(entry):
+	"""Get the size of a cache entry in bytes"""
+	return sum(os.path.getsize(f"{path}/{name}") for path, folders, files in os.walk(entry) for name in files)
+
+def evict(folder,maxsize=DEFAULT_SIZE,keep=None):
+	"""Remove the least recently used entries until the cache fits in maxsize MB"""
+	entries = []
+	for key in os.listdir(folder):
+		entry = f"{folder}/{key}"
+		if key.startswith(".") or not os.path.isdir(entry):
+			continue
+		entries.append((os.path.getmtime(entry),key,entry_size(entry)))
+	total = sum(size for mtime, key, size in entries)
+	for mtime, key, size in sorted(entries):
+		if total <= float(maxsize)*1048576:
+			break
+		if key == keep:
+			continue
+		shutil.rmtree(f"{folder}/{key}",ignore_errors=True)
+		total -= size
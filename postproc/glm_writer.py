@@ -0,0 +1,161 @@
+"""Importable interface of the write_glm converter
+
+`convert()` runs `write_glm.py` in the calling process, so that the modules it
+imports (pandas, numpy) are only loaded once per process and the script is
+only compiled once, instead of starting a new interpreter for each conversion.
+The script reads its arguments and settings from the globals set by
+`convert()` instead of `sys.argv` and `config.csv`, so conversions may run in
+several threads.
+
+`cyme_tables()` and `cyme_columns()` get the tables and columns the converter
+needs from the source of `write_glm.py` without running it.
+
+A `TableCache` given to `convert()` keeps the table sets loaded by the last
+conversions, so that converting the same data folder again does not load the
+tables again unless their files changed.  `run_script()` runs the other
+postprocessors in-process the same way.
+
+Example:
+
+	import glm_writer
+	result = glm_writer.convert("input","output","/tmp/openfido/IEEE13",
+		generated="IEEE13.glm",settings={"GLM_NOMINAL_VOLTAGE":"2.40178 kV"})
+	if result["code"] == 0:
+		print(result["files"])
+"""
+
+import os, sys, ast, functools, traceback, collections
+import table_store
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),"write_glm.py")
+DEFAULT_TABLE_SETS = 8
+
+@functools.lru_cache()
+def compiled(filename):
+	"""Get the compiled code of a postprocessor script"""
+	with open(filename,"r") as fh:
+		return compile(fh.read(),filename,"exec")
+
+def run_script(filename,argv,**variables):
+	"""Run a postprocessor script in-process with the arguments given, returns its exit code and globals
+
+	The script reads its arguments from `script_argv` instead of `sys.argv`,
+	and the other `variables` are set in its globals before it runs.
+	"""
+	namespace = dict(variables,__name__="__main__",__file__=filename,script_argv=[filename]+list(argv))
+	try:
+		exec(compiled(filename),namespace)
+		code = 0
+	except SystemExit as err:
+		code = err.code if type(err.code) is int else (0 if err.code is None else 1)
+	except Exception:
+		traceback.print_exc()
+		code = 1
+	finally:
+		for name in ["output_file","error_file","warning_file"]:
+			if name in namespace and hasattr(namespace[name],"close") and namespace[name] not in [sys.stdout,sys.stderr]:
+				namespace[name].close()
+	return code, namespace
+
+def folder_signature(folder,partitions=False):
+	"""Get the names, sizes and modification times of the table files in a data folder"""
+	signature = []
+	for path, folders, files in os.walk(folder):
+		if not partitions and table_store.PARTITION_FOLDER in folders and os.path.samefile(path,folder):
+			folders.remove(table_store.PARTITION_FOLDER)
+		for name in files:
+			stat = os.stat(f"{path}/{name}")
+			signature.append((path,name,stat.st_size,stat.st_mtime_ns))
+	return sorted(signature)
+
+class TableCache:
+	"""LRU cache of the table sets loaded by write_glm.py
+
+	A table set is reused only if the files it was loaded from did not change.
+	The tables asked for by name are loaded the first time they are asked for
+	and added to their set.  At most `size` table sets are kept.
+	"""
+	def __init__(self,size=DEFAULT_TABLE_SETS):
+		self.size = int(size)
+		self.sets = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self,function,folder,signature,args,names,**kwargs):
+		key = (function.__name__,os.path.abspath(folder),repr(args),repr(sorted(kwargs.items())))
+		if key not in self.sets or self.sets[key]["signature"] != signature:
+			self.sets[key] = {"signature":signature,"tables":{},"names":set(),"all":False}
+		tables = self.sets[key]
+		self.sets.move_to_end(key)
+		missing = [] if tables["all"] else ([None] if names is None else [name for name in names if name not in tables["names"]])
+		if missing == [None]:
+			tables.update(tables=function(folder,*args,**kwargs),all=True)
+		elif missing:
+			tables["tables"].update(function(folder,*args,missing,**kwargs))
+			tables["names"].update(missing)
+		if missing:
+			self.misses += 1
+			while len(self.sets) > self.size:
+				self.sets.popitem(last=False)
+		else:
+			self.hits += 1
+		return {name:data for name, data in tables["tables"].items() if names is None or name in names}
+
+	def load_tables(self,folder,names=None,**kwargs):
+		return self.get(table_store.load_tables,folder,folder_signature(folder,partitions=True),(),names,**kwargs)
+
+	def load_shared(self,folder,names=None,**kwargs):
+		return self.get(table_store.load_shared,folder,folder_signature(folder),(),names,**kwargs)
+
+	def load_partition(self,folder,network_id,names=None,**kwargs):
+		return self.get(table_store.load_partition,folder,folder_signature(table_store.partition_folder(folder,network_id)),(network_id,),names,**kwargs)
+
+@functools.lru_cache()
+def script_constants(filename=SCRIPT):
+	"""Get the constants assigned at the top level of a postprocessor script (default write_glm.py)"""
+	with open(filename,"r") as fh:
+		tree = ast.parse(fh.read(),filename)
+	constants = {}
+	for node in tree.body:
+		if isinstance(node,ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0],ast.Name):
+			try:
+				constants[node.targets[0].id] = ast.literal_eval(node.value)
+			except ValueError:
+				pass
+	return constants
+
+def cyme_tables():
+	"""Get the CYME tables required by write_glm.py, like `write_glm.py --cyme-tables`"""
+	return list(script_constants()["cyme_tables_required"])
+
+def cyme_columns():
+	"""Get the columns used in the required tables, like `write_glm.py --cyme-columns`"""
+	return dict(script_constants()["cyme_columns_required"])
+
+def convert(input_folder,output_folder,data_folder,config_file=None,generated=None,networks=None,settings=None,options=[],tables=None):
+	"""Convert the networks of the tables in the data folder to GLM files
+
+	The settings of `config_file` (default `{input_folder}/config.csv`) are
+	overridden by the `settings` dict, `networks` lists the network IDs to
+	convert (default all), and `options` are additional write_glm.py command
+	line options.  The tables are loaded through the `tables` TableCache if
+	given.  Returns a dict with the exit `code` of the conversion, the GLM
+	`files` written, and the number of `warnings` and `errors`.
+	"""
+	argv = ["-i",input_folder,"-o",output_folder,"-d",data_folder]
+	if config_file:
+		argv.extend(["-c",config_file])
+	if generated:
+		argv.extend(["-g",generated])
+	if networks:
+		argv.extend(["-n"," ".join(networks)])
+	variables = {"script_settings":dict(settings) if settings else {}}
+	if tables is not None:
+		variables["script_loader"] = tables
+	code, namespace = run_script(SCRIPT,argv+list(options),**variables)
+	return {
+		"code" : code,
+		"files" : namespace.get("glm_files",[]),
+		"warnings" : namespace.get("warning_count",0),
+		"errors" : namespace.get("error_count",0),
+		}
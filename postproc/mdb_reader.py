@@ -0,0 +1,495 @@
+"""Native reader for Jet 4 (Access 2000+) MDB databases
+
+This module reads CYME MDB files without the mdbtools command line tools.  Only
+the parts of the Jet 4 page format needed to extract the user tables are
+supported (no indexes, no writing, no encrypted databases).
+
+Example:
+
+	from mdb_reader import MdbFile
+	mdb = MdbFile("IEEE13.mdb")
+	for table in mdb.tables():
+		data = mdb.read_table(table,dtype=str)
+
+The `dtype=str` option returns the values formatted the same way `mdb-export`
+formats them, which is what the postprocessors expect when they load the CSV
+files with `pd.read_csv(...,dtype=str)`.
+"""
+
+import os, mmap, struct, datetime
+import numpy as np
+import pandas as pd
+
+PAGE_SIZE = 4096
+OFFSET_MASK = 0x1fff
+MSYSOBJECTS_PAGE = 2
+
+# page types
+PAGE_DATA = 0x01
+PAGE_TDEF = 0x02
+PAGE_USAGE = 0x05
+
+# column types
+MDB_BOOL = 0x01
+MDB_BYTE = 0x02
+MDB_INT = 0x03
+MDB_LONGINT = 0x04
+MDB_MONEY = 0x05
+MDB_FLOAT = 0x06
+MDB_DOUBLE = 0x07
+MDB_DATETIME = 0x08
+MDB_BINARY = 0x09
+MDB_TEXT = 0x0a
+MDB_OLE = 0x0b
+MDB_MEMO = 0x0c
+MDB_REPID = 0x0f
+MDB_NUMERIC = 0x10
+MDB_COMPLEX = 0x12
+
+# column types quoted by mdb-export
+quoted_types = [MDB_TEXT,MDB_OLE,MDB_MEMO,MDB_DATETIME,MDB_BINARY,MDB_REPID,MDB_NUMERIC]
+
+# numpy types for typed columns without nulls
+numpy_types = {
+	MDB_BOOL : np.bool_,
+	MDB_BYTE : np.uint8,
+	MDB_INT : np.int16,
+	MDB_LONGINT : np.int32,
+	MDB_COMPLEX : np.int32,
+	MDB_MONEY : np.float64,
+	MDB_FLOAT : np.float32,
+	MDB_DOUBLE : np.float64,
+	MDB_DATETIME : "datetime64[us]",
+}
+
+epoch = datetime.datetime(1899,12,30)
+
+class MdbError(Exception):
+	pass
+
+class MdbColumn:
+	"""Column definition read from a table definition page"""
+
+	def __init__(self,name,col_type,col_num,var_num,fixed,fixed_offset,size,prec,scale):
+		self.name = name
+		self.type = col_type
+		self.num = col_num
+		self.var_num = var_num
+		self.fixed = fixed
+		self.fixed_offset = fixed_offset
+		self.size = size
+		self.prec = prec
+		self.scale = scale
+
+	def __repr__(self):
+		return f"MdbColumn({self.name},type={self.type},size={self.size})"
+
+class MdbTable:
+	"""Table definition read from a table definition page"""
+
+	def __init__(self,name,page,num_rows,num_var_cols,columns,usage_map):
+		self.name = name
+		self.page = page
+		self.num_rows = num_rows
+		self.num_var_cols = num_var_cols
+		self.columns = columns
+		self.usage_map = usage_map
+
+	def column_names(self):
+		return [column.name for column in self.columns]
+
+class MdbFile:
+	"""Jet 4 MDB file reader"""
+
+	def __init__(self,filename):
+		self.filename = filename
+		self.fh = open(filename,"rb")
+		self.data = mmap.mmap(self.fh.fileno(),0,access=mmap.ACCESS_READ)
+		if self.data[0:4] != b"\x00\x01\x00\x00" or self.data[4:19] != b"Standard Jet DB":
+			raise MdbError(f"{filename} is not an MDB file")
+		if self.data[0x14] == 0:
+			raise MdbError(f"{filename} is a Jet 3 database, only Jet 4 or later is supported")
+		self.num_pages = len(self.data) // PAGE_SIZE
+		self.catalog = None
+		self.tdefs = {}
+
+	def close(self):
+		self.data.close()
+		self.fh.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+	#
+	# Page access
+	#
+	def page(self,number):
+		if number < 0 or number >= self.num_pages:
+			raise MdbError(f"{self.filename}: page {number} is out of range")
+		return self.data[number*PAGE_SIZE:(number+1)*PAGE_SIZE]
+
+	def row_bounds(self,page,row):
+		"""Get the start, end and flags of a row on a data page"""
+		offset = struct.unpack_from("<H",page,14+row*2)[0]
+		if row == 0:
+			end = PAGE_SIZE
+		else:
+			end = struct.unpack_from("<H",page,12+row*2)[0] & OFFSET_MASK
+		return offset & OFFSET_MASK, end, offset & ~OFFSET_MASK
+
+	def row_pointer(self,pointer):
+		"""Get the row data from a page/row pointer"""
+		page = self.page(pointer >> 8)
+		start, end, flags = self.row_bounds(page,pointer & 0xff)
+		return page[start:end]
+
+	#
+	# Table definitions
+	#
+	def read_tdef(self,number):
+		"""Read a table definition, including the continuation pages"""
+		page = self.page(number)
+		if page[0] != PAGE_TDEF:
+			raise MdbError(f"{self.filename}: page {number} is not a table definition")
+		buffer = bytearray(page)
+		next_page = struct.unpack_from("<I",page,4)[0]
+		while next_page:
+			page = self.page(next_page)
+			buffer.extend(page[8:])
+			next_page = struct.unpack_from("<I",page,4)[0]
+		return bytes(buffer)
+
+	def table_definition(self,name,page):
+		if page in self.tdefs:
+			return self.tdefs[page]
+		tdef = self.read_tdef(page)
+		num_rows = struct.unpack_from("<I",tdef,16)[0]
+		num_var_cols, num_cols = struct.unpack_from("<HH",tdef,43)
+		num_real_idx = struct.unpack_from("<I",tdef,51)[0]
+		usage_map = struct.unpack_from("<I",tdef,55)[0]
+		pos = 63 + num_real_idx*12
+		entries = []
+		for n in range(num_cols):
+			entry = tdef[pos+n*25:pos+(n+1)*25]
+			entries.append(entry)
+		pos += num_cols*25
+		columns = []
+		for entry in entries:
+			length = struct.unpack_from("<H",tdef,pos)[0]
+			name_ = tdef[pos+2:pos+2+length].decode("utf-16-le")
+			pos += 2 + length
+			col_type = entry[0]
+			col_num, var_num = struct.unpack_from("<HH",entry,5)
+			fixed = (entry[15] & 0x01) != 0
+			fixed_offset, size = struct.unpack_from("<HH",entry,21)
+			columns.append(MdbColumn(name_,col_type,col_num,var_num,fixed,fixed_offset,size,entry[11],entry[12]))
+		columns.sort(key=lambda column: column.num)
+		table = MdbTable(name,page,num_rows,num_var_cols,columns,usage_map)
+		self.tdefs[page] = table
+		return table
+
+	def data_pages(self,table):
+		"""Get the list of data pages used by a table from its usage map"""
+		usage = self.row_pointer(table.usage_map)
+		pages = []
+		if usage[0] == 0: # inline bitmap
+			start = struct.unpack_from("<I",usage,1)[0]
+			bitmap = np.unpackbits(np.frombuffer(usage[5:],dtype=np.uint8),bitorder="little")
+			pages = (np.flatnonzero(bitmap) + start).tolist()
+		elif usage[0] == 1: # bitmaps stored on usage pages
+			bits_per_page = (PAGE_SIZE-4)*8
+			for n in range((len(usage)-1)//4):
+				map_page = struct.unpack_from("<I",usage,1+n*4)[0]
+				if map_page == 0:
+					continue
+				page = self.page(map_page)
+				if page[0] != PAGE_USAGE:
+					raise MdbError(f"{self.filename}: page {map_page} is not a usage map page")
+				bitmap = np.unpackbits(np.frombuffer(page[4:],dtype=np.uint8),bitorder="little")
+				pages.extend((np.flatnonzero(bitmap) + n*bits_per_page).tolist())
+		else:
+			raise MdbError(f"{self.filename}: usage map type {usage[0]} of table '{table.name}' is not supported")
+		return [number for number in pages if 0 < number < self.num_pages]
+
+	#
+	# Catalog
+	#
+	def read_catalog(self):
+		"""Read the objects listed in MSysObjects"""
+		if self.catalog is None:
+			msysobjects = self.table_definition("MSysObjects",MSYSOBJECTS_PAGE)
+			catalog = {}
+			for row in self.rows(msysobjects,["Id","Name","Type","Flags"]):
+				catalog[row[1]] = {"id":row[0] & 0x00ffffff,"type":row[2],"flags":row[3] or 0}
+			self.catalog = catalog
+		return self.catalog
+
+	def tables(self,system=False):
+		"""List the tables in the database (user tables only unless system is True)"""
+		result = []
+		for name, entry in self.read_catalog().items():
+			if entry["type"] == 1 and (system or (entry["flags"] & 0x80000002) == 0):
+				result.append(name)
+		return result
+
+	def table(self,name):
+		"""Get the table definition of a table"""
+		catalog = self.read_catalog()
+		if name not in catalog or catalog[name]["type"] != 1:
+			raise MdbError(f"{self.filename}: table '{name}' not found")
+		return self.table_definition(name,catalog[name]["id"])
+
+	#
+	# Row decoding
+	#
+	def rows(self,table,columns=None,raw=False,where=None):
+		"""Iterate over the rows of a table, yields tuples of column values
+
+		If `columns` is given only these columns are decoded (in that order).
+		If `raw` is True the field bytes are returned instead of the values.
+		If `where` is given, it maps column names to the collections of values
+		accepted, and only the rows matching all of them are returned.  These
+		columns are decoded first, so that the other fields of the rows that
+		do not match are never decoded.  Columns that are not in the table are
+		ignored.
+		"""
+		if type(table) is str:
+			table = self.table(table)
+		names = {column.name:column for column in table.columns}
+		if columns is None:
+			selected = table.columns
+		else:
+			try:
+				selected = [names[name] for name in columns]
+			except KeyError as err:
+				raise MdbError(f"{self.filename}: table '{table.name}' has no column {err}")
+		filters = [(names[name],values) for name, values in where.items() if name in names] if where else []
+		keys = [column for column, values in filters]
+		for number in self.data_pages(table):
+			page = self.page(number)
+			if page[0] != PAGE_DATA or struct.unpack_from("<I",page,4)[0] != table.page:
+				continue
+			for row in range(struct.unpack_from("<H",page,12)[0]):
+				start, end, flags = self.row_bounds(page,row)
+				if flags & 0x4000 or end <= start: # deleted row
+					continue
+				if filters:
+					fields = self.crack_row(table,page,start,end,keys)
+					if not all(self.value(column,field) in values for (column,values), field in zip(filters,fields)):
+						continue
+				fields = self.crack_row(table,page,start,end,selected)
+				if raw:
+					yield tuple(fields)
+				else:
+					yield tuple(self.value(column,field) for column, field in zip(selected,fields))
+
+	def crack_row(self,table,page,start,end,columns):
+		"""Split a row into the raw field bytes (None for null fields)"""
+		row_cols = struct.unpack_from("<H",page,start)[0]
+		mask_size = (row_cols+7)//8
+		mask = page[end-mask_size:end]
+		row_var_cols = 0
+		offsets = []
+		if table.num_var_cols > 0:
+			row_var_cols = struct.unpack_from("<H",page,end-mask_size-2)[0]
+			base = end-mask_size-4
+			offsets = [struct.unpack_from("<H",page,base-n*2)[0] for n in range(row_var_cols+1)]
+		fixed_found = row_cols - row_var_cols
+		fields = []
+		for column in columns:
+			byte, bit = divmod(column.num,8)
+			notnull = byte < len(mask) and (mask[byte] & (1 << bit)) != 0
+			if column.type == MDB_BOOL:
+				fields.append(b"\x01" if notnull else b"\x00")
+			elif not notnull:
+				fields.append(None)
+			elif column.fixed and column.fixed_offset + column.size <= end - start:
+				pos = start + 2 + column.fixed_offset
+				fields.append(page[pos:pos+column.size])
+			elif not column.fixed and column.var_num < row_var_cols:
+				fields.append(page[start+offsets[column.var_num]:start+offsets[column.var_num+1]])
+			else:
+				fields.append(None)
+		return fields
+
+	def value(self,column,field):
+		"""Convert the raw field bytes to a Python value"""
+		if field is None:
+			return None
+		col_type = column.type
+		if col_type == MDB_BOOL:
+			return field == b"\x01"
+		elif col_type == MDB_BYTE:
+			return field[0]
+		elif col_type == MDB_INT:
+			return struct.unpack("<h",field)[0]
+		elif col_type in (MDB_LONGINT,MDB_COMPLEX):
+			return struct.unpack("<i",field)[0]
+		elif col_type == MDB_MONEY:
+			return struct.unpack("<q",field)[0] / 10000.0
+		elif col_type == MDB_FLOAT:
+			return struct.unpack("<f",field)[0]
+		elif col_type == MDB_DOUBLE:
+			return struct.unpack("<d",field)[0]
+		elif col_type == MDB_DATETIME:
+			return epoch + datetime.timedelta(days=struct.unpack("<d",field)[0])
+		elif col_type == MDB_TEXT:
+			return decode_text(field)
+		elif col_type == MDB_MEMO:
+			return decode_text(self.memo(field))
+		elif col_type == MDB_OLE:
+			return self.memo(field)
+		elif col_type == MDB_REPID:
+			a, b, c = struct.unpack_from("<IHH",field)
+			return "{%08X-%04X-%04X-%s-%s}" % (a,b,c,field[8:10].hex().upper(),field[10:16].hex().upper())
+		elif col_type == MDB_NUMERIC:
+			words = struct.unpack_from("<IIII",field,1)
+			unscaled = (words[0] << 96) | (words[1] << 64) | (words[2] << 32) | words[3]
+			return (-unscaled if field[0] & 0x80 else unscaled) / 10**column.scale
+		else:
+			return bytes(field)
+
+	def memo(self,field):
+		"""Read the data of a memo or OLE field"""
+		if len(field) < 12:
+			return b""
+		length, pointer = struct.unpack_from("<II",field)
+		flags = length & 0xc0000000
+		length &= 0x3fffffff
+		if flags == 0x80000000: # inline
+			return bytes(field[12:12+length])
+		elif flags == 0x40000000: # single LVAL page
+			return bytes(self.row_pointer(pointer)[:length])
+		else: # chain of LVAL pages
+			data = bytearray()
+			while pointer and len(data) < length:
+				chunk = self.row_pointer(pointer)
+				pointer = struct.unpack_from("<I",chunk)[0]
+				data.extend(chunk[4:])
+			return bytes(data[:length])
+
+	#
+	# Table extraction
+	#
+	def read_columns(self,table,columns=None,where=None):
+		"""Read the columns of a table as numpy arrays
+
+		Integer columns with nulls are returned as float arrays, text columns
+		as object arrays.
+		"""
+		if type(table) is str:
+			table = self.table(table)
+		if columns is None:
+			columns = table.column_names()
+		selected = [column for name in columns for column in table.columns if column.name == name]
+		values = list(zip(*self.rows(table,columns,where=where)))
+		if not values:
+			values = [()] * len(selected)
+		result = {}
+		for column, data in zip(selected,values):
+			dtype = numpy_types.get(column.type,object)
+			if dtype is not object and None in data:
+				if column.type == MDB_DATETIME:
+					result[column.name] = np.array([np.datetime64("NaT") if x is None else x for x in data],dtype=dtype)
+				elif column.type == MDB_BOOL:
+					result[column.name] = np.array(data,dtype=object)
+				else:
+					result[column.name] = np.array([np.nan if x is None else x for x in data],dtype=np.float64)
+			else:
+				result[column.name] = np.array(data,dtype=dtype)
+		return result
+
+	def read_table(self,table,columns=None,dtype=None,where=None):
+		"""Read a table into a DataFrame
+
+		With `dtype=str` the values are formatted like `mdb-export` does and
+		nulls are NaN, which matches `pd.read_csv(...,dtype=str)` on an exported
+		table.  Otherwise the columns are typed numpy arrays.  See `rows()` for
+		the `where` filter.
+		"""
+		if type(table) is str:
+			table = self.table(table)
+		if columns is None:
+			columns = table.column_names()
+		if dtype is str:
+			selected = [column for name in columns for column in table.columns if column.name == name]
+			rows = [[format_value(column,self.value(column,field)) for column, field in zip(selected,fields)]
+				for fields in self.rows(table,columns,raw=True,where=where)]
+			return pd.DataFrame(rows,columns=[column.name for column in selected],dtype=object)
+		return pd.DataFrame(self.read_columns(table,columns,where))
+
+	def export_csv(self,table,csvname,columns=None,where=None):
+		"""Write a table to a CSV file formatted like `mdb-export`, returns the number of rows"""
+		if type(table) is str:
+			table = self.table(table)
+		if columns is None:
+			columns = table.column_names()
+		selected = [column for name in columns for column in table.columns if column.name == name]
+		count = 0
+		with open(csvname,"w",newline="") as fh:
+			fh.write(",".join(column.name for column in selected) + "\n")
+			for fields in self.rows(table,columns,raw=True,where=where):
+				fh.write(",".join(format_csv(column,self.value(column,field)) for column, field in zip(selected,fields)) + "\n")
+				count += 1
+		return count
+
+def decode_text(data):
+	"""Decode a Jet 4 text value (UCS-2 with optional compression)"""
+	if data[0:2] == b"\xff\xfe": # compressed unicode
+		text = []
+		compressed = True
+		pos = 2
+		while pos < len(data):
+			if data[pos] == 0:
+				compressed = not compressed
+				pos += 1
+			elif compressed:
+				text.append(chr(data[pos]))
+				pos += 1
+			else:
+				text.append(bytes(data[pos:pos+2]).decode("utf-16-le",errors="replace"))
+				pos += 2
+		return "".join(text)
+	return bytes(data).decode("utf-16-le",errors="replace")
+
+def format_value(column,value):
+	"""Format a value the way `mdb-export` does (None for nulls)"""
+	if value is None:
+		return None
+	col_type = column.type
+	if col_type == MDB_BOOL:
+		return "1" if value else "0"
+	elif col_type == MDB_FLOAT:
+		return "%.7g" % value
+	elif col_type == MDB_DOUBLE:
+		return "%.15g" % value
+	elif col_type == MDB_MONEY:
+		return "%.4f" % value
+	elif col_type == MDB_DATETIME:
+		return value.strftime("%m/%d/%y %H:%M:%S")
+	elif col_type == MDB_NUMERIC:
+		return "%.*f" % (column.scale,value)
+	elif type(value) is bytes:
+		return value.hex()
+	else:
+		return str(value)
+
+def format_csv(column,value):
+	"""Format a value as a CSV field the way `mdb-export` does"""
+	text = format_value(column,value)
+	if text is None:
+		return ""
+	if column.type in quoted_types:
+		return '"' + text.replace('"','""') + '"'
+	return text
+
+def read_tables(filename,tables=None,dtype=str,where=None):
+	"""Read tables from an MDB file into a dict of DataFrames keyed by table name"""
+	with MdbFile(filename) as mdb:
+		if tables is None:
+			tables = mdb.tables()
+		available = mdb.tables()
+		return {table: mdb.read_table(table,dtype=dtype,where=where) for table in tables if table in available}
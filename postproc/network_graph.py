@@ -4,13 +4,14 @@
 Configuration settings (config.csv):
 
   - PNG_POSTPROC   must be set to "network_graph.py"
-  - PNG_FIGNAME    name of figure (default "network_graph.png")
+  - PNG_FIGNAME    name of figure (default "network_graph.png"), prefixed with the name given with -g
   - PNG_FIGSIZE    PNG image dimensions (default "9x6")
   - PNG_NODESIZE   size of nodes (default "10")
   - PNG_NODECOLOR  color nodes (default "byphase")
   - PNG_FONTSIZE   size of label font (default "8")
   - PNG_ROOTNODE   root node (required for multipartite and shell graphs)
   - PNG_LAYOUT     graph layout (default "nodexy")
+  - PNG_DETAIL     draw node labels ("full"), not ("reduced"), or as planned by EXTRACT_PLAN ("auto", default)
 
 Supported layouts:
 
@@ -26,15 +27,22 @@ Supported layouts:
 	multipartite   layers by distance from root node
 """
 
-import sys, getopt
+import sys, getopt, json
 import pandas as pd
 import networkx as nx
 import matplotlib.pyplot as plt
+from table_store import load_table
+from planner import load_plan
 
 #
 # Required tables to operate properly
 #
 cyme_tables = ["CYMNETWORK","CYMNODE","CYMSECTION"]
+cyme_columns = {
+	"CYMNETWORK" : ["NetworkId"],
+	"CYMNODE" : ["NetworkId","NodeId","X","Y"],
+	"CYMSECTION" : ["NetworkId","Phase","FromNodeId","ToNodeId"],
+	}
 
 #
 # Argument parsing
@@ -53,13 +61,14 @@ DEBUG = False
 QUIET = False
 VERBOSE = False
 
-opts, args = getopt.getopt(sys.argv[1:],"hc:i:o:d:tn:e:g:",["help","config=","input=","output=","data=","cyme-tables","network_ID=","equipment_file=","generated="])
+script_argv = globals().get("script_argv",sys.argv) # set when run in-process by glm_writer.run_script()
+opts, args = getopt.getopt(script_argv[1:],"hc:i:o:d:tn:e:g:",["help","config=","input=","output=","data=","cyme-tables","cyme-columns","network_ID=","equipment_file=","generated="])
 
 #
 # Warning/error/help handling
 #
 def help(exit_code=None,details=False):
-	print("Syntax: python3 -m network_graph.py -i|--input DIR -o|--output DIR -d|--data DIR [-h|--help] [-g|--generated 'file name'][-t|--cyme-tables] [-c|--config CSV] [-e|--equipment 'file name'] [-n|--network_ID 'ID1 ID2 ..']")
+	print("Syntax: python3 -m network_graph.py -i|--input DIR -o|--output DIR -d|--data DIR [-h|--help] [-g|--generated 'file name'][-t|--cyme-tables] [--cyme-columns] [-c|--config CSV] [-e|--equipment 'file name'] [-n|--network_ID 'ID1 ID2 ..']")
 	if details:
 		print(globals()[__name__].__doc__)
 	if type(exit_code) is int:
@@ -120,7 +129,10 @@ for opt, arg in opts:
 		else:
 			print(config)
 	elif opt in ("-t","--cyme-tables"):
-		print(" ".join(cyme_tables_required))
+		print(" ".join(cyme_tables))
+		sys.exit(0)
+	elif opt == "--cyme-columns":
+		print(json.dumps(cyme_columns))
 		sys.exit(0)
 	elif opt in ("-i", "--input"):
 		input_folder = arg.strip()
@@ -157,6 +169,7 @@ config = pd.DataFrame({
 	"PNG_NODECOLOR" : ["byphase"],
 	"PNG_LAYOUT" : ["nodexy"],
 	"PNG_ROOTNODE" : [""],
+	"PNG_DETAIL" : ["auto"],
 	"PNG_OUTPUT" : "/dev/stdout",
 	"ERROR_OUTPUT" : "/dev/stderr",
 	"WARNING_OUTPUT" : "/dev/stderr",
@@ -181,11 +194,18 @@ print(f"*** Running network_graph.py ***")
 for name, data in config.iterrows():
 	print(f"  {name} = {data['value']}")
 del config
+if settings["PNG_DETAIL"] == "auto":
+	plan = load_plan(data_folder)
+	png_detail = plan["png_detail"] if plan else "full"
+elif settings["PNG_DETAIL"] in ["full","reduced"]:
+	png_detail = settings["PNG_DETAIL"]
+else:
+	error(f"PNG_DETAIL={settings['PNG_DETAIL']} is invalid", 10)
 
 # load the model
-network = pd.read_csv(f"{data_folder}/network.csv")
-nodes = pd.read_csv(f"{data_folder}/node.csv")
-section = pd.read_csv(f"{data_folder}/section.csv")
+network = load_table(data_folder,"network",dtype=None,columns=cyme_columns["CYMNETWORK"])
+nodes = load_table(data_folder,"node",dtype=None,columns=cyme_columns["CYMNODE"])
+section = load_table(data_folder,"section",dtype=None,columns=cyme_columns["CYMSECTION"])
 
 # generate the graph
 if network_select is None:
@@ -265,7 +285,7 @@ for network_id in network_list:
 		error("LAYOUT={settings['LAYOUT']} is invalid", 10)
 	try:
 		nx.draw(graph, pos,
-			with_labels = True,
+			with_labels = (png_detail == "full"),
 			edge_color = colors,
 			width = weights,
 			labels = labels,
@@ -273,10 +293,11 @@ for network_id in network_list:
 			node_color = node_colors,
 			font_size = int(settings["PNG_FONTSIZE"]),
 			)
+		prefix = f"{generated_file.split('.')[0]}_" if generated_file else "" # the figures of several databases written to the same folder
 		if network_select:
-			plt.savefig(f"{output_folder}/{network_id}_{settings['PNG_FIGNAME']}")
+			plt.savefig(f"{output_folder}/{prefix}{network_id}_{settings['PNG_FIGNAME']}")
 		else:
-			plt.savefig(f"{output_folder}/{settings['PNG_FIGNAME']}")
+			plt.savefig(f"{output_folder}/{prefix}{settings['PNG_FIGNAME']}")
 	except nx.NetworkXError as err:
 		warning(f"Cannot generate the network plot because {err}")
 
@@ -0,0 +1,144 @@
+"""Execution planner based on the table row counts
+
+Before the tables are extracted, the planner gets the number of rows of each
+table from the table definitions of the MDB file, which does not read any row,
+or else from the `index.csv` saved by a previous run, and estimates the memory
+and the time needed to convert the whole database and its largest network
+(from the share of the sections of each network).  It then chooses:
+
+  * the layout: the tables are partitioned by network when the whole tables
+    would not fit in the memory budget, so that each network is loaded alone;
+  * the number of workers: one for small databases, otherwise as many as the
+    processors, the tables and the memory budget allow;
+  * the PNG detail: the network graph is drawn without node labels when the
+    largest network has too many nodes for the labels to be readable.
+
+The plan is saved as `plan.json` in the data folder, where `network_graph.py`
+reads the PNG detail.
+
+Config settings:
+
+	EXTRACT_PLAN,[none|auto] --> choose the layout, workers and PNG detail from the table row counts (default none)
+	EXTRACT_MEMORY,[auto|<megabytes>] --> memory budget of the plan (default auto, half of the available memory)
+"""
+
+import os, json
+import pandas as pd
+from mdb_reader import MdbFile
+import table_store
+
+DEFAULT_PLAN = "none"
+DEFAULT_MEMORY = "auto"
+PLAN_NAME = "plan.json"
+CELL_BYTES = 80 # memory used by a string cell of a DataFrame
+DEFAULT_COLUMNS = 20 # columns assumed when the index does not tell
+LOAD_FACTOR = 4 # memory used by a conversion per byte of the tables it loads
+ROW_SECONDS = 0.0005 # conversion time of a row
+SMALL_ROWS = 100000 # databases with fewer rows are extracted by a single worker
+DETAIL_NODES = 5000 # networks with more nodes are drawn without labels
+
+def available_memory():
+	"""Get the memory available in MB"""
+	try:
+		with open("/proc/meminfo","r") as fh:
+			for line in fh:
+				if line.startswith("MemAvailable:"):
+					return int(line.split()[1]) / 1024
+	except OSError:
+		pass
+	return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1048576
+
+def memory_budget(setting=DEFAULT_MEMORY):
+	"""Get the memory budget in MB from the EXTRACT_MEMORY setting"""
+	if setting in [None,"","auto"]:
+		return available_memory() / 2
+	return float(setting)
+
+def mdb_counts(filename):
+	"""Get the rows and the columns of each table from the table definitions of the database"""
+	with MdbFile(filename) as database:
+		counts = {}
+		for name in database.tables():
+			table = database.table(name)
+			counts[name] = {"rows":table.num_rows,"columns":table.column_names()}
+		return counts
+
+def index_counts(filename,database):
+	"""Get the rows of each table of a database from an index.csv, the columns are not known"""
+	index = pd.read_csv(filename,dtype=str)
+	index = index[index["database"] == database]
+	return {table:{"rows":int(float(rows)),"columns":None} for table, rows in zip(index["table"],index["rows"]) if rows == rows}
+
+def table_counts(filename,index=None):
+	"""Get the rows of each table from the database or, if it cannot be read, from the index given, returns None if neither is available"""
+	try:
+		return mdb_counts(filename)
+	except Exception:
+		if index and os.path.exists(index):
+			return index_counts(index,os.path.basename(filename)) or None
+	return None
+
+def network_shares(filename,networks=None):
+	"""Get the share of the sections of each network (among those given), returns None if the database cannot be read"""
+	try:
+		with MdbFile(filename) as database:
+			sections = pd.Series(database.read_columns("CYMSECTION",[table_store.PARTITION_COLUMN])[table_store.PARTITION_COLUMN])
+	except Exception:
+		return None
+	counts = sections.value_counts()
+	if networks is not None:
+		counts = counts[counts.index.isin(list(networks))]
+	return {network_id:count/len(sections) for network_id, count in counts.items()} if len(sections) else {}
+
+def is_partitioned(table,columns):
+	"""Check whether a table will be partitioned by network, equipment tables are assumed shared when the columns are not known"""
+	if columns is None:
+		return table != "CYMNETWORK" and not table.startswith("CYMEQ")
+	return table_store.is_partitioned(table_store.table_name(table),columns)
+
+def make_plan(counts,tables,shares=None,budget=None,cpus=None):
+	"""Estimate the memory (MB) and time (s) needed and choose the layout, the workers and the PNG detail"""
+	budget = budget if budget else memory_budget()
+	cpus = cpus if cpus else os.cpu_count()
+	sizes = {table:counts[table]["rows"]*len(counts[table]["columns"] or range(DEFAULT_COLUMNS))*CELL_BYTES/1048576
+		for table in tables if table in counts}
+	partitioned = [table for table in sizes if is_partitioned(table,counts[table]["columns"])]
+	network_id, share = max(shares.items(),key=lambda item: item[1]) if shares else (None,1.0)
+	rows = sum(counts[table]["rows"] for table in sizes)
+	memory = sum(sizes.values())
+	shared = sum(size for table, size in sizes.items() if table not in partitioned)
+	network_rows = int(sum(counts[table]["rows"] for table in partitioned)*share)
+	network_memory = shared + sum(sizes[table] for table in partitioned)*share
+	layout = "networks" if memory*LOAD_FACTOR > budget else "tables"
+	if rows < SMALL_ROWS:
+		workers = 1
+	else:
+		loaded = network_memory if layout == "networks" else memory
+		workers = min(cpus,len([size for size in sizes.values() if size > 0]),
+			int(budget/max(max(sizes.values()),loaded*LOAD_FACTOR,1e-3)))
+	nodes = int(counts["CYMNODE"]["rows"]*share) if "CYMNODE" in counts else 0
+	return {
+		"rows" : rows,
+		"memory" : round(memory*LOAD_FACTOR,1),
+		"seconds" : round(rows*ROW_SECONDS,1),
+		"network" : network_id,
+		"network_rows" : network_rows,
+		"network_memory" : round(network_memory*LOAD_FACTOR,1),
+		"network_seconds" : round(network_rows*ROW_SECONDS,1),
+		"budget" : round(budget,1),
+		"layout" : layout,
+		"workers" : max(workers,1),
+		"png_detail" : "reduced" if nodes > DETAIL_NODES else "full",
+		}
+
+def save_plan(folder,plan):
+	"""Save the plan in the data folder"""
+	with open(f"{folder}/{PLAN_NAME}","w") as fh:
+		json.dump(plan,fh,indent=1)
+
+def load_plan(folder):
+	"""Load the plan saved in the data folder, or None"""
+	if not os.path.exists(f"{folder}/{PLAN_NAME}"):
+		return None
+	with open(f"{folder}/{PLAN_NAME}","r") as fh:
+		return json.load(fh)
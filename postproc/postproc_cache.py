@@ -0,0 +1,159 @@
+"""Memoized outputs of the postprocessors
+
+Each postprocessor run gets a fingerprint computed from the SHA-256 hashes of
+the script, the config settings it consumes (`GLM_*` for write_glm.py, `PNG_*`
+for network_graph.py, `VOL_*` for voltage_profile.py, all the settings for the
+other scripts), the input files named by these settings (e.g., `GLM_MODIFY`),
+the files of the tables it reads in the data folder, the generated name and
+the options, and the fingerprints of the postprocessors it depends on.  When
+a postprocessor succeeds, the output files it wrote are stored in the cache
+under its fingerprint, and the next run with the same fingerprint restores
+them instead of running the postprocessor, so that changing only the PNG
+settings does not convert the networks again, and vice versa.
+
+The output files of a run are the files of the output folder that changed
+while it ran and match the names the postprocessor writes, listed in
+`OUTPUTS`.  The other scripts are always run and their outputs are not
+cached, since the files written by the postprocessors running at the same
+time could not be told apart.  The cache folder is managed like the extract
+cache (see `extract_cache.py`).
+
+Config settings:
+
+	POSTPROC_CACHE,[none|default|<folder>] --> cache folder (default none)
+	POSTPROC_CACHE_SIZE,<megabytes> --> cache size limit (default 1024)
+"""
+
+import os, fnmatch, hashlib, json
+import extract_cache
+import glm_writer
+import table_store
+from build_info import build_info
+
+DEFAULT_FOLDER = "/usr/local/share/openfido/cyme-postproc-cache"
+DEFAULT_SIZE = 1024 # MB
+SETTINGS = { # prefixes of the settings consumed by each postprocessor
+	"write_glm.py" : ["GLM_"],
+	"network_graph.py" : ["PNG_"],
+	"voltage_profile.py" : ["VOL_"],
+	}
+OUTPUTS = { # names of the files written by each postprocessor
+	"write_glm.py" : ["*.glm","*_assumptions.csv"],
+	"network_graph.py" : ["{PNG_FIGNAME}","*_{PNG_FIGNAME}"],
+	"voltage_profile.py" : ["{generated}.json","{generated}.png","{generated}_*.json","{generated}_*.png"],
+	}
+OUTPUT_DEFAULTS = {
+	"PNG_FIGNAME" : "network_graph.png",
+	}
+
+def cache_folder(name):
+	"""Get the cache folder from the POSTPROC_CACHE setting, or None if caching is disabled"""
+	if name == "default":
+		return DEFAULT_FOLDER
+	return extract_cache.cache_folder(name)
+
+def script_tables(filename):
+	"""Get the CYME tables read by a postprocessor script, or None if it does not tell"""
+	constants = glm_writer.script_constants(filename)
+	for name in ["cyme_tables_required","cyme_tables"]:
+		if name in constants:
+			return list(constants[name])
+	return None
+
+def script_settings(process,settings):
+	"""Get the config settings consumed by a postprocessor"""
+	prefixes = SETTINGS.get(process)
+	return {name:str(value) for name, value in settings.items()
+		if prefixes is None or [prefix for prefix in prefixes if name.startswith(prefix)]}
+
+def data_files(folder):
+	"""Get the paths of the files in a data folder relative to it"""
+	return sorted(os.path.relpath(f"{path}/{name}",folder) for path, folders, files in os.walk(folder) for name in files)
+
+def table_files(files,skip):
+	"""Get the files that do not belong to the tables listed in skip (by CSV name, or folder name in the columnar format)"""
+	return [name for name in files
+		if not set([os.path.splitext(os.path.basename(name))[0]] + name.split(os.sep)[:-1]) & set(skip)]
+
+def fingerprint(filename,settings,input_folder,tables={},options=[],parents=[]):
+	"""Get the fingerprint of a postprocessor run from its script, settings, input files, table file hashes, options and parent fingerprints"""
+	sha = hashlib.sha256(extract_cache.file_hash(filename).encode())
+	inputs = {token:extract_cache.file_hash(f"{input_folder}/{token}")
+		for value in settings.values() for token in value.split() if os.path.isfile(f"{input_folder}/{token}")}
+	sha.update(json.dumps({
+		"commit" : build_info(os.path.dirname(os.path.abspath(filename))).get("commit",""),
+		"settings" : settings,
+		"inputs" : inputs,
+		"tables" : tables,
+		"options" : options,
+		"parents" : parents,
+		},sort_keys=True).encode())
+	return sha.hexdigest()
+
+def fingerprints(postprocs,folder,data_folder,input_folder,settings,tables,options=[],dependencies={}):
+	"""Get the fingerprint of each postprocessor in the folder given, None for the scripts that cannot be found
+
+	The `tables` are the CYME tables extracted in the data folder, of which only
+	those the script reads are part of its fingerprint.
+	"""
+	files = data_files(data_folder)
+	hashes = {name:extract_cache.file_hash(f"{data_folder}/{name}") for name in files}
+	keys = {}
+	def key(process):
+		if process in keys:
+			return keys[process]
+		keys[process] = None # dependency loops are not cached
+		filename = f"{folder}/{process}"
+		if not os.path.exists(filename):
+			return None
+		reads = script_tables(filename)
+		skip = [table_store.table_name(table) for table in tables if reads is not None and table not in reads]
+		parents = [key(name) for name in dependencies.get(process,[]) if name in postprocs]
+		if None not in parents:
+			keys[process] = fingerprint(filename,script_settings(process,settings),input_folder,
+				tables={name:hashes[name] for name in table_files(files,skip)},
+				options=options,
+				parents=parents)
+		return keys[process]
+	return {process:key(process) for process in postprocs}
+
+class OutputCache:
+	"""Restore or store the output files of the postprocessors keyed by their fingerprints"""
+	def __init__(self,folder,keys,output_folder,settings={},generated="",size=DEFAULT_SIZE):
+		self.folder = folder
+		self.keys = keys
+		self.output_folder = output_folder
+		self.names = dict(OUTPUT_DEFAULTS,**{name:str(value) for name, value in settings.items()},generated=generated)
+		self.size = size
+
+	def patterns(self,process):
+		"""Get the names of the files written by a postprocessor, or None if it does not tell"""
+		if process not in OUTPUTS:
+			return None
+		return [pattern.format(**self.names) for pattern in OUTPUTS[process]]
+
+	def snapshot(self):
+		"""Get the size and modification time of the files in the output folder"""
+		snapshot = {}
+		for name in os.listdir(self.output_folder):
+			if os.path.isfile(f"{self.output_folder}/{name}"):
+				stat = os.stat(f"{self.output_folder}/{name}")
+				snapshot[name] = (stat.st_size,stat.st_mtime_ns)
+		return snapshot
+
+	def restore(self,process):
+		"""Copy the cached outputs of a postprocessor into the output folder, returns False if they are not cached"""
+		key = self.keys.get(process)
+		return key is not None and self.patterns(process) is not None and extract_cache.fetch(self.folder,key,self.output_folder)
+
+	def store(self,process,before):
+		"""Store the files a postprocessor wrote since the snapshot given, returns their names (none if it does not list them in `OUTPUTS`)"""
+		key = self.keys.get(process)
+		patterns = self.patterns(process)
+		if key is None or patterns is None:
+			return []
+		names = [name for name, stat in self.snapshot().items() if before.get(name) != stat
+			and [pattern for pattern in patterns if fnmatch.fnmatch(name,pattern)]]
+		os.makedirs(self.folder,exist_ok=True)
+		extract_cache.store(self.folder,key,self.output_folder,names,self.size)
+		return names
@@ -0,0 +1,101 @@
+"""Performance report of the table exports and postprocessor runs
+
+Each table export, postprocessor run and conversion stage is recorded with
+its wall time, its CPU time, its peak resident set size and, for the table
+exports, its rows per second.  The CPU time and peak RSS of a subprocess
+(e.g., `mdb-export` or a postprocessor) are its own, taken when it is reaped.
+Those of a table read by the native backend are the CPU time of the worker
+thread and the peak RSS of the process so far.
+
+The records of a database are saved in `<name>_run_report.json` in the output
+folder, next to the other outputs.
+
+Command line:
+
+	python3 run_report.py DATABASE TIMINGS REPORT
+
+saves the records written by `openfido.sh` in the TIMINGS file, one CSV line
+`stage,name,seconds,cpu_seconds,peak_rss_kb,rows` per record, to the REPORT file.
+"""
+
+import os, sys, time, json, resource
+import pandas as pd
+
+FIELDS = ["stage","name","seconds","cpu_seconds","peak_rss_kb","rows"]
+
+def rows_per_second(rows,seconds):
+	"""Get the rows per second of a record, or None if unknown"""
+	if rows is None or rows < 0 or not seconds:
+		return None
+	return round(rows/seconds,1)
+
+class Measure:
+	"""Measure the wall time, CPU time and peak RSS of a table export, postprocessor run or stage
+
+	With `scope="thread"` the CPU time is that of the calling thread and the
+	subprocess given to `wait()`, otherwise it is that of the process and all
+	the subprocesses it reaped in the meantime.
+	"""
+	def __init__(self,stage,name,scope="thread"):
+		self.stage = stage
+		self.name = name
+		self.scope = scope
+		self.child = None
+		self.start = time.time()
+		self.cpu = self.cpu_time()
+
+	def cpu_time(self):
+		if self.scope == "thread":
+			return time.thread_time()
+		own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+		return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+	def wait(self,proc):
+		"""Wait for a subprocess and add its CPU time and peak RSS, returns its exit code"""
+		pid, status, self.child = os.wait4(proc.pid,0)
+		proc.returncode = os.waitstatus_to_exitcode(status)
+		return proc.returncode
+
+	def result(self,rows=None,**fields):
+		"""Get the record of the measure"""
+		seconds = time.time() - self.start
+		cpu = self.cpu_time() - self.cpu
+		if self.child:
+			cpu += self.child.ru_utime + self.child.ru_stime
+			rss = self.child.ru_maxrss
+		elif self.scope == "thread":
+			rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		else:
+			rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+		return dict({
+			"stage" : self.stage,
+			"name" : self.name,
+			"seconds" : round(seconds,3),
+			"cpu_seconds" : round(cpu,3),
+			"peak_rss_kb" : rss,
+			"rows" : rows,
+			"rows_per_second" : rows_per_second(rows,seconds),
+			},**fields)
+
+def save_report(filename,database,records):
+	"""Save the records of a database to a JSON report"""
+	with open(filename,"w") as fh:
+		json.dump({"database":database,"created":time.strftime("%Y-%m-%dT%H:%M:%S%z"),"records":records},fh,indent=1)
+
+def read_timings(filename):
+	"""Read the records written by openfido.sh"""
+	timings = pd.read_csv(filename,names=FIELDS,dtype={"stage":str,"name":str})
+	records = []
+	for n, timing in timings.iterrows():
+		record = {name:(None if pd.isna(value) else value) for name, value in timing.items()}
+		for name in ["peak_rss_kb","rows"]:
+			record[name] = None if record[name] is None else int(record[name])
+		record["rows_per_second"] = rows_per_second(record["rows"],record["seconds"])
+		records.append(record)
+	return records
+
+if __name__ == "__main__":
+	if len(sys.argv) != 4:
+		print("Syntax: python3 run_report.py DATABASE TIMINGS REPORT",file=sys.stderr)
+		exit(1)
+	save_report(sys.argv[3],sys.argv[1],read_timings(sys.argv[2]))
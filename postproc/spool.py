@@ -0,0 +1,215 @@
+"""Shared-filesystem spool of network conversion units
+
+A conversion job is split into one self-contained unit per network and saved
+in a spool folder shared by several hosts, e.g., on an NFS mount:
+
+	<spool>/<job>/job.json               the output name and write_glm options
+	<spool>/<job>/input/                 the config files of the input folder
+	<spool>/<job>/shared/                the shared tables (e.g., equipment) and partition index
+	<spool>/<job>/units/<NetworkId>/tables/  the partitioned tables of one network
+	<spool>/<job>/units/<NetworkId>/result/  the files written by write_glm
+
+Any number of workers, started with `python3 spool.py SPOOL` on any host that
+mounts the spool, claim units by creating a `lease` file in the unit folder
+holding a token of their own.  The lease is renewed while the unit is
+converted, and a unit whose lease was not renewed for `lease` seconds is
+claimed again by another worker.  A worker that finds another token in the
+lease has lost the unit: it stops converting it and leaves the lease alone.
+A unit ends with a `done` or a `failed` file, and `merge()` copies the
+results of the units into the output folder once they have all ended.
+
+The tables are saved in the spool as CSV (or columnar) files, pickled tables
+being converted when the job is submitted, so that the workers never unpickle
+files of the shared folder.  The job still sets the options of write_glm, so
+the spool folder must only be writable by trusted users and hosts.
+
+Config settings:
+
+	SPOOL_FOLDER,[none|<folder>] --> convert the networks through the spool folder (default none)
+	SPOOL_WORKERS,<number> --> number of local workers started by the job (default 1)
+	SPOOL_LEASE,<seconds> --> time after which the unit of a silent worker is claimed again (default 300)
+
+Command line:
+
+	python3 spool.py [-w|--wait] [-l|--lease SECONDS] SPOOL
+
+converts the units of the jobs in the spool until none is left to claim, or
+keeps waiting for new jobs with `--wait`.
+"""
+
+import os, sys, getopt, json, time, shutil, socket, subprocess, tempfile, urllib.parse, uuid, shlex
+import table_store
+
+DEFAULT_WORKERS = 1
+DEFAULT_LEASE = 300 # seconds
+POLL_SECONDS = 5
+
+def unit_folder(job,network_id):
+	"""Get the folder of the unit of a network"""
+	return f"{job}/units/{urllib.parse.quote(str(network_id),safe='')}"
+
+def submit(spool,data_folder,input_folder,generated,flags="",networks=None,single=False):
+	"""Split the partitioned tables of the data folder into one unit per network in the spool, returns the job folder
+
+	The model of each network is written to `<generated>_<NetworkId>.glm`,
+	or to `<generated>.glm` when `single` is set (see the write_glm -s option).
+	"""
+	index = table_store.partition_index(data_folder)
+	if not index:
+		raise Exception(f"data folder '{data_folder}' is not partitioned by network (use EXTRACT_LAYOUT=networks)")
+	name = f"{os.path.basename(generated).split('.')[0]}-{uuid.uuid4().hex[0:8]}"
+	staging = f"{spool}/.{name}"
+	os.makedirs(f"{staging}/input")
+	for filename in os.listdir(input_folder):
+		if os.path.isfile(f"{input_folder}/{filename}") and not filename.lower().endswith(".mdb"):
+			shutil.copy(f"{input_folder}/{filename}",f"{staging}/input")
+	table_store.copy_csv(data_folder,f"{staging}/shared",skip=[table_store.PARTITION_FOLDER])
+	units = [network_id for network_id in index["networks"] if networks is None or network_id in networks]
+	for network_id in units:
+		table_store.copy_csv(table_store.partition_folder(data_folder,network_id),f"{unit_folder(staging,network_id)}/tables")
+	with open(f"{staging}/job.json","w") as fh:
+		json.dump({"database":os.path.basename(os.path.abspath(data_folder)),"generated":generated,"flags":flags,"networks":units,"single":single},fh)
+	os.rename(staging,f"{spool}/{name}") # workers only see complete jobs
+	return f"{spool}/{name}"
+
+def jobs(spool):
+	"""Get the job folders in the spool"""
+	return [f"{spool}/{name}" for name in sorted(os.listdir(spool))
+		if not name.startswith(".") and os.path.exists(f"{spool}/{name}/job.json")]
+
+def ended(unit):
+	"""Check whether a unit is done or failed"""
+	return os.path.exists(f"{unit}/done") or os.path.exists(f"{unit}/failed")
+
+def claim(unit,lease=DEFAULT_LEASE):
+	"""Claim a unit, returns the token written in its lease, or None if the unit has ended or is leased by another worker"""
+	if ended(unit):
+		return None
+	filename = f"{unit}/lease"
+	try:
+		if time.time() - os.path.getmtime(filename) < float(lease):
+			return None
+		os.rename(filename,f"{filename}.expired") # only one worker takes over an expired lease
+	except FileNotFoundError:
+		pass
+	try:
+		fd = os.open(filename,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+	except FileExistsError:
+		return None
+	token = f"{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}"
+	with os.fdopen(fd,"w") as fh:
+		fh.write(f"{token}\n")
+	return token
+
+def holds(unit,token):
+	"""Check whether the lease of a unit still holds the token of the worker"""
+	try:
+		with open(f"{unit}/lease","r") as fh:
+			return fh.read().strip() == token
+	except FileNotFoundError:
+		return False
+
+def run_unit(job,unit,token,lease=DEFAULT_LEASE):
+	"""Convert the network of a unit claimed with the token given, returns the exit code, or None if the lease was lost"""
+	with open(f"{job}/job.json","r") as fh:
+		config = json.load(fh)
+	network_id = urllib.parse.unquote(os.path.basename(unit))
+	workdir = tempfile.mkdtemp(prefix="cyme-extract-unit-")
+	try:
+		# the data folder references the shared tables and the tables of the unit (write_glm names the model after the folder)
+		data_folder = f"{workdir}/{config['database']}"
+		os.makedirs(f"{data_folder}/{table_store.PARTITION_FOLDER}")
+		for name in os.listdir(f"{job}/shared"):
+			if name == table_store.PICKLE_NAME: # never unpickled from the spool
+				continue
+			os.symlink(os.path.abspath(f"{job}/shared/{name}"),f"{data_folder}/{name}")
+		os.symlink(os.path.abspath(f"{unit}/tables"),table_store.partition_folder(data_folder,network_id))
+		os.makedirs(f"{workdir}/result")
+		input_folder = os.path.abspath(f"{job}/input")
+		command = ["python3",f"{os.path.dirname(os.path.abspath(__file__))}/write_glm.py",
+			"-i",input_folder,"-o",f"{workdir}/result","-c",f"{input_folder}/config.csv","-d",data_folder,
+			"-g",config["generated"]] + shlex.split(config["flags"]) + ["-n",network_id] + (["-s"] if config.get("single") else [])
+		proc = subprocess.Popen(command,cwd=input_folder)
+		while True:
+			try:
+				code = proc.wait(timeout=float(lease)/3)
+				break
+			except subprocess.TimeoutExpired:
+				if not holds(unit,token): # claimed again by another worker
+					proc.kill()
+					proc.wait()
+					return None
+				os.utime(f"{unit}/lease") # renew the lease
+		if not holds(unit,token):
+			return None
+		elif code == 0:
+			shutil.rmtree(f"{unit}/result",ignore_errors=True)
+			shutil.copytree(f"{workdir}/result",f"{unit}/result.{os.getpid()}")
+			os.rename(f"{unit}/result.{os.getpid()}",f"{unit}/result")
+			open(f"{unit}/done","w").close()
+		else:
+			with open(f"{unit}/failed","w") as fh:
+				fh.write(f"{socket.gethostname()} {os.getpid()} exit code {code}\n")
+		return code
+	finally:
+		shutil.rmtree(workdir,ignore_errors=True)
+		if holds(unit,token):
+			os.remove(f"{unit}/lease")
+
+def work(spool,lease=DEFAULT_LEASE,job=None):
+	"""Convert the units of the jobs in the spool, or of one job, until none can be claimed, returns the number of units converted"""
+	count = 0
+	while True:
+		claimed = False
+		for folder in [job] if job else jobs(spool):
+			if not os.path.isdir(f"{folder}/units"):
+				continue
+			for name in sorted(os.listdir(f"{folder}/units")):
+				unit = f"{folder}/units/{name}"
+				token = claim(unit,lease)
+				if token:
+					run_unit(folder,unit,token,lease)
+					claimed = True
+					count += 1
+		if not claimed:
+			return count
+
+def complete(job):
+	"""Check whether all the units of a job have ended"""
+	return all(ended(f"{job}/units/{name}") for name in os.listdir(f"{job}/units"))
+
+def merge(job,output_folder):
+	"""Copy the results of the units into the output folder, returns the exit code of each network (0 when done)"""
+	results = {}
+	for name in sorted(os.listdir(f"{job}/units")):
+		unit = f"{job}/units/{name}"
+		network_id = urllib.parse.unquote(name)
+		if os.path.exists(f"{unit}/done"):
+			for filename in os.listdir(f"{unit}/result"):
+				shutil.copy(f"{unit}/result/{filename}",output_folder)
+			results[network_id] = 0
+		else:
+			results[network_id] = 1
+	return results
+
+if __name__ == "__main__":
+	opts, args = getopt.getopt(sys.argv[1:],"hwl:",["help","wait","lease="])
+	wait, lease = False, DEFAULT_LEASE
+	for opt, arg in opts:
+		if opt in ("-h","--help"):
+			print(__doc__)
+			exit(0)
+		elif opt in ("-w","--wait"):
+			wait = True
+		elif opt in ("-l","--lease"):
+			lease = float(arg)
+	if len(args) != 1:
+		print("Syntax: python3 spool.py [-w|--wait] [-l|--lease SECONDS] SPOOL",file=sys.stderr)
+		exit(1)
+	while True:
+		count = work(args[0],lease)
+		if count or not wait:
+			print(f"CYME-extract spool worker: {count} units converted",flush=True)
+		if not wait:
+			break
+		time.sleep(POLL_SECONDS)
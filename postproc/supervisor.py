@@ -0,0 +1,106 @@
+"""Supervised conversion workers
+
+A network conversion runs in a worker process of its own session, whose wall
+time, CPU time and resident set size (those of the worker and of the
+processes it started) are checked every `POLL_SECONDS`.  The worker and its
+processes are killed as soon as one of them exceeds its limit, so that a
+pathological network, e.g., one that keeps restarting the link or voltage
+checks of write_glm.py, or one that grows without bound, does not stall the
+conversion of the other networks.
+
+The CPU time and RSS are read from `/proc`, so only the wall time is limited
+on systems without it.
+
+Config settings:
+
+	CONVERT_TIMEOUT,[none|<seconds>] --> wall time limit of each network conversion (default none)
+	CONVERT_CPU,[none|<seconds>] --> CPU time limit of each network conversion (default none)
+	CONVERT_MEMORY,[none|<megabytes>] --> RSS limit of each network conversion (default none)
+"""
+
+import os, signal, select, subprocess, time
+
+DEFAULT_LIMIT = "none"
+POLL_SECONDS = 0.5
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+
+def limit(value):
+	"""Get a limit from its setting, or None if there is no limit"""
+	if value in [None,"","none"]:
+		return None
+	return float(value)
+
+def process_stat(pid):
+	"""Get the process group, CPU seconds (including its reaped children) and RSS in kB of a process, or None if it is gone"""
+	try:
+		with open(f"/proc/{pid}/stat","r") as fh:
+			fields = fh.read().rsplit(")",1)[1].split() # the name may hold spaces
+		return int(fields[2]), sum(int(value) for value in fields[11:15])/CLOCK_TICKS, int(fields[21])*PAGE_KB
+	except (OSError,IndexError,ValueError):
+		return None
+
+def group_usage(pgid):
+	"""Get the CPU seconds and RSS in kB of the processes in a process group"""
+	cpu, rss = 0.0, 0
+	for pid in os.listdir("/proc") if os.path.isdir("/proc") else []:
+		if pid.isdigit():
+			stat = process_stat(pid)
+			if stat and stat[0] == pgid:
+				cpu, rss = cpu + stat[1], rss + stat[2]
+	return cpu, rss
+
+def wait_exit(pid,fd,seconds):
+	"""Wait at most `seconds` for a process to exit, using its pidfd if there is one"""
+	if fd is not None:
+		select.select([fd],[],[],seconds)
+	else:
+		time.sleep(seconds)
+
+def supervise(command,timeout=None,cpu=None,memory=None,**kwargs):
+	"""Run a command in a supervised worker with the wall time (s), CPU time (s) and RSS (MB) limits given
+
+	Returns a dict with the exit `code` of the worker, the limit it `exceeded`
+	(None if it was not killed), and its wall time, CPU time and peak RSS.
+	"""
+	start = time.time()
+	proc = subprocess.Popen(command,start_new_session=True,**kwargs)
+	try:
+		fd = os.pidfd_open(proc.pid) if hasattr(os,"pidfd_open") else None
+	except OSError:
+		fd = None
+	exceeded, used, peak = None, 0.0, 0
+	try:
+		while True:
+			pid, status, rusage = os.wait4(proc.pid,os.WNOHANG)
+			if pid:
+				break
+			used, rss = group_usage(proc.pid)
+			peak = max(peak,rss)
+			if timeout is not None and time.time() - start > timeout:
+				exceeded = f"wall time limit of {timeout:g} s"
+			elif cpu is not None and used > cpu:
+				exceeded = f"CPU time limit of {cpu:g} s"
+			elif memory is not None and rss > memory*1024:
+				exceeded = f"memory limit of {memory:g} MB"
+			if exceeded:
+				os.killpg(proc.pid,signal.SIGKILL)
+				pid, status, rusage = os.wait4(proc.pid,0)
+				break
+			wait_exit(proc.pid,fd,POLL_SECONDS)
+	finally:
+		if fd is not None:
+			os.close(fd)
+	if exceeded:
+		try:
+			os.killpg(proc.pid,signal.SIGKILL) # processes the worker left behind
+		except ProcessLookupError:
+			pass
+	proc.returncode = os.waitstatus_to_exitcode(status)
+	return {
+		"code" : proc.returncode,
+		"exceeded" : exceeded,
+		"seconds" : round(time.time()-start,3),
+		"cpu_seconds" : round(max(rusage.ru_utime+rusage.ru_stime,used),3),
+		"peak_rss_kb" : max(rusage.ru_maxrss,peak),
+		}
@@ -0,0 +1,451 @@
+"""CYME table store shared by the extractor and the postprocessors
+
+Tables extracted from a CYME database are kept in a data folder, either as
+one CSV file per table (`<name>.csv`, the table name without the `CYM`
+prefix in lowercase) or, when they were streamed into memory, as a single
+binary `tables.pickle` file holding all the tables.  The postprocessors load
+the tables with `load_tables()` or `load_table()`, which use whichever is
+available.
+
+The tables can also be partitioned by network.  In that layout the tables
+that have a `NetworkId` column (except the network table itself) are saved
+in one sub-folder per network, `networks/<NetworkId>/`, each holding the rows
+of one network in either of the formats above, and the other tables, e.g.,
+the equipment tables, are saved in the data folder.  The `partitions.json`
+file lists the partitioned tables and the networks.  `load_tables()` still
+returns whole tables, while `load_shared()` and `load_partition()` load only
+the shared tables and the tables of one network.  A `LazyTables` dict loads
+each table the first time it is used instead.
+
+The tables can also be saved to a single SQLite database with `save_sqlite()`
+for tools that query the tables by key instead of reading whole files, also
+from the command line:
+
+	python3 table_store.py [-i|--index CSV] SQLITE FOLDER
+
+saves the tables of the data folder, and the index file given (in the format
+of `index.csv`) as the `index` table.
+
+Finally the tables of a folder can also be saved in a columnar format in the
+`columnar/` sub-folder, which the loaders use in preference to the others
+for typed loads (`dtype=None`), whose numeric columns are saved already
+converted.  Loads of strings (the default) read the other formats, which is
+faster.  Each table is a folder holding a `meta.json` file and one file per
+column: integer and float columns whose text is exactly the Python
+formatting of their values are saved as numpy arrays, and the other columns
+as UTF-8 text, each value followed by a NUL byte, with an array of offsets.
+The files are memory-mapped when they are loaded.
+"""
+
+import os, sys, getopt, glob, pickle, json, urllib.parse, sqlite3, shutil, collections.abc
+import numpy as np
+import pandas as pd
+
+PICKLE_NAME = "tables.pickle"
+COLUMNAR_FOLDER = "columnar"
+PARTITION_FOLDER = "networks"
+PARTITION_INDEX = "partitions.json"
+PARTITION_COLUMN = "NetworkId"
+CHUNK_ROWS = 100000 # rows partitioned at a time
+SQLITE_KEYS = ["NetworkId","SectionId","DeviceNumber","EquipmentId"] # columns indexed in SQLite tables
+
+def table_name(table):
+	"""Get the data folder name of a CYME table, e.g., 'CYMNODE' -> 'node'"""
+	return table[3:].lower()
+
+def save_tables(folder,tables):
+	"""Save a dict of DataFrames of strings to the data folder"""
+	with open(f"{folder}/{PICKLE_NAME}","wb") as fh:
+		pickle.dump(tables,fh,protocol=pickle.HIGHEST_PROTOCOL)
+
+def save_csv(folder,tables):
+	"""Save a dict of DataFrames to CSV files in the data folder"""
+	for name, data in tables.items():
+		data.to_csv(f"{folder}/{name}.csv",index=False)
+
+def sql_name(name):
+	"""Quote a SQL identifier"""
+	return '"' + str(name).replace('"','""') + '"'
+
+def save_sqlite(filename,tables,index=None):
+	"""Save a dict of DataFrames to a SQLite database
+
+	All the tables are loaded in a single transaction with batched inserts,
+	and the columns listed in `SQLITE_KEYS` are indexed.  If `index` is given
+	it is saved as the `index` table.
+	"""
+	if os.path.exists(filename):
+		os.remove(filename)
+	if index is not None:
+		tables = dict(tables,index=index)
+	db = sqlite3.connect(filename,isolation_level=None)
+	try:
+		db.execute("PRAGMA journal_mode=OFF") # the file is discarded if the load fails
+		db.execute("PRAGMA synchronous=OFF")
+		db.execute("BEGIN")
+		for name, data in tables.items():
+			if len(data.columns) == 0:
+				continue
+			db.execute(f"CREATE TABLE {sql_name(name)} ({','.join(sql_name(column) for column in data.columns)})")
+			values = data.astype(object).where(data.notna(),None).itertuples(index=False,name=None)
+			db.executemany(f"INSERT INTO {sql_name(name)} VALUES ({','.join(['?']*len(data.columns))})",values)
+			for column in SQLITE_KEYS:
+				if column in data.columns:
+					db.execute(f"CREATE INDEX {sql_name(name+'_'+column)} ON {sql_name(name)} ({sql_name(column)})")
+		db.execute("COMMIT")
+	except:
+		db.close()
+		os.remove(filename)
+		raise
+	db.close()
+
+def typed(data):
+	"""Convert the numeric columns of a DataFrame of strings"""
+	return data.apply(pd.to_numeric,errors="ignore")
+
+def select_tables(tables,names=None,dtype=str,columns=None):
+	"""Get the tables of a dict of DataFrames of strings (see `load_shared()` for the options)"""
+	columns = columns if columns else {}
+	selected = {}
+	for name, data in tables.items():
+		if names is None or name in names:
+			if name in columns:
+				data = data[[column for column in data.columns if column in columns[name]]]
+			selected[name] = data if dtype is str else typed(data)
+	return selected
+
+def load_shared(folder,names=None,dtype=str,columns=None):
+	"""Load the tables saved in the data folder itself into a dict of DataFrames
+
+	If `names` is given only these tables are loaded.  With `dtype=None` the
+	numeric columns are converted like `pd.read_csv()` does by default.  If
+	`columns` is given, it maps table names to the only columns loaded from
+	these tables (columns that are not in the table are ignored).
+	"""
+	columns = columns if columns else {}
+	tables = {}
+	if dtype is not str and os.path.exists(f"{folder}/{COLUMNAR_FOLDER}"):
+		for name in os.listdir(f"{folder}/{COLUMNAR_FOLDER}"):
+			if names is None or name in names:
+				tables[name] = load_columnar(f"{folder}/{COLUMNAR_FOLDER}/{name}",dtype,columns.get(name))
+	elif os.path.exists(f"{folder}/{PICKLE_NAME}"):
+		with open(f"{folder}/{PICKLE_NAME}","rb") as fh:
+			tables = select_tables(pickle.load(fh),names,dtype,columns)
+	else:
+		for filename in glob.iglob(f"{folder}/*.csv"):
+			name = os.path.basename(filename)[0:-4].lower()
+			if names is None or name in names:
+				usecols = (lambda column: column in columns[name]) if name in columns else None
+				tables[name] = pd.read_csv(filename,dtype=dtype,usecols=usecols)
+	return tables
+
+def load_partition(folder,network_id,names=None,dtype=str,columns=None):
+	"""Load the partitioned tables of one network (see `load_shared()` for the options)"""
+	return load_shared(partition_folder(folder,network_id),names,dtype,columns)
+
+def load_tables(folder,names=None,dtype=str,columns=None):
+	"""Load the tables in the data folder into a dict of DataFrames
+
+	Partitioned tables are loaded whole by concatenating the partitions of all
+	the networks.  See `load_shared()` for the options.
+	"""
+	tables = load_shared(folder,names,dtype,columns)
+	index = partition_index(folder)
+	if index:
+		wanted = [name for name in index["tables"] if names is None or name in names]
+		if wanted:
+			parts = [load_partition(folder,network_id,wanted,dtype,columns) for network_id in index["networks"]]
+			for name in wanted:
+				tables[name] = pd.concat([part[name] for part in parts if name in part],ignore_index=True)
+	return tables
+
+def load_table(folder,name,dtype=str,columns=None):
+	"""Load one table from the data folder, optionally only the columns listed"""
+	tables = load_tables(folder,[name],dtype,{name:columns} if columns else None)
+	if name not in tables:
+		raise FileNotFoundError(f"table '{name}' not found in '{folder}'")
+	return tables[name]
+
+def table_names(folder):
+	"""Get the names of the tables saved in the data folder itself without loading them, or None if they are saved in one pickle file"""
+	if os.path.exists(f"{folder}/{PICKLE_NAME}"):
+		return None
+	elif os.path.exists(f"{folder}/{COLUMNAR_FOLDER}"):
+		return sorted(os.listdir(f"{folder}/{COLUMNAR_FOLDER}"))
+	return sorted(os.path.basename(filename)[0:-4].lower() for filename in glob.iglob(f"{folder}/*.csv"))
+
+class LazyTables(collections.abc.MutableMapping):
+	"""Dict of DataFrames loaded the first time they are used
+
+	The tables added with `add(names,load)` are loaded by `load(names)`, which
+	returns a dict of DataFrames like `load_shared()` does, and are then kept
+	until they are dropped.  Tables set in the dict are kept as they are.  The
+	tables listed in `empty` are given as empty DataFrames with the columns
+	listed instead of being loaded, e.g., the tables of the devices a network
+	does not have.
+	"""
+	def __init__(self):
+		self.sources = {}
+		self.tables = {}
+		self.empty = {}
+
+	def add(self,names,load):
+		for name in names:
+			self.sources[name] = load
+			self.tables.pop(name,None)
+
+	def drop(self,names):
+		for name in names:
+			self.sources.pop(name,None)
+			self.tables.pop(name,None)
+
+	def loaded(self):
+		"""Get the names of the tables loaded so far"""
+		return list(self.tables)
+
+	def __getitem__(self,name):
+		if name in self.tables:
+			return self.tables[name]
+		elif name not in self.sources:
+			raise KeyError(name)
+		elif name in self.empty:
+			return pd.DataFrame({column:pd.Series(dtype=object) for column in self.empty[name]})
+		data = self.sources[name]([name])
+		if name not in data:
+			raise KeyError(name)
+		self.tables[name] = data[name]
+		return self.tables[name]
+
+	def __setitem__(self,name,data):
+		self.sources[name] = None
+		self.tables[name] = data
+
+	def __delitem__(self,name):
+		if name not in self.sources:
+			raise KeyError(name)
+		self.drop([name])
+
+	def __iter__(self):
+		return iter(self.sources)
+
+	def __len__(self):
+		return len(self.sources)
+
+class MemoryTables:
+	"""Table loader serving the tables held in memory for a data folder
+
+	The tables of the data folder, e.g., streamed by `__init__.main`, are
+	given without being saved, and loaded at once like a pickle file.  The
+	tables of the other folders (e.g., the equipment tables) are loaded from
+	their files.  Used like a `glm_writer.TableCache` by write_glm.py.
+	"""
+	def __init__(self,folder,tables):
+		self.folder = os.path.abspath(folder)
+		self.tables = tables
+
+	def held(self,folder):
+		return os.path.abspath(folder) == self.folder
+
+	def table_names(self,folder):
+		return None if self.held(folder) else table_names(folder)
+
+	def load_tables(self,folder,names=None,dtype=str,columns=None):
+		return select_tables(self.tables,names,dtype,columns) if self.held(folder) else load_tables(folder,names,dtype,columns)
+
+	def load_shared(self,folder,names=None,dtype=str,columns=None):
+		return select_tables(self.tables,names,dtype,columns) if self.held(folder) else load_shared(folder,names,dtype,columns)
+
+	def load_partition(self,folder,network_id,names=None,dtype=str,columns=None):
+		return load_partition(folder,network_id,names,dtype,columns)
+
+def partition_folder(folder,network_id):
+	"""Get the folder holding the partitioned tables of a network"""
+	return f"{folder}/{PARTITION_FOLDER}/{urllib.parse.quote(str(network_id),safe='')}"
+
+def partition_index(folder):
+	"""Get the partition index of the data folder, or None if it is not partitioned"""
+	if not os.path.exists(f"{folder}/{PARTITION_INDEX}"):
+		return None
+	with open(f"{folder}/{PARTITION_INDEX}","r") as fh:
+		return json.load(fh)
+
+def save_index(folder,tables,networks):
+	"""Save the partition index of the data folder"""
+	with open(f"{folder}/{PARTITION_INDEX}","w") as fh:
+		json.dump({"tables":tables,"networks":networks},fh)
+
+def is_partitioned(name,columns):
+	"""Check whether a table is partitioned by network"""
+	return name != "network" and PARTITION_COLUMN in columns
+
+def network_ids(tables):
+	"""Get the network IDs of a dict of DataFrames, in network table order first"""
+	networks = list(tables["network"][PARTITION_COLUMN].dropna()) if "network" in tables else []
+	for name, data in tables.items():
+		if is_partitioned(name,data.columns):
+			networks.extend(network_id for network_id in data[PARTITION_COLUMN].dropna().unique() if network_id not in networks)
+	return networks
+
+def save_partitions(folder,tables):
+	"""Save a dict of DataFrames of strings to the data folder partitioned by network"""
+	shared = {name:data for name, data in tables.items() if not is_partitioned(name,data.columns)}
+	partitioned = {name:data for name, data in tables.items() if is_partitioned(name,data.columns)}
+	networks = network_ids(tables)
+	save_tables(folder,shared)
+	groups = {name:dict(list(data.groupby(PARTITION_COLUMN,sort=False))) for name, data in partitioned.items()}
+	for network_id in networks:
+		os.makedirs(partition_folder(folder,network_id),exist_ok=True)
+		save_tables(partition_folder(folder,network_id),{name:groups[name].get(network_id,data.iloc[0:0])
+			for name, data in partitioned.items()})
+	save_index(folder,list(partitioned),networks)
+
+def partition_csv(folder,names):
+	"""Partition the CSV files of the named tables in the data folder by network
+
+	The files are read a few rows at a time, so that the tables do not need
+	to fit in memory.
+	"""
+	partitioned = []
+	networks = []
+	if "network" in names:
+		networks = list(pd.read_csv(f"{folder}/network.csv",dtype=str,usecols=[PARTITION_COLUMN])[PARTITION_COLUMN].dropna())
+	headers = {}
+	for name in names:
+		csvname = f"{folder}/{name}.csv"
+		header = pd.read_csv(csvname,dtype=str,nrows=0).columns
+		if not is_partitioned(name,header):
+			continue
+		partitioned.append(name)
+		headers[name] = header
+		for data in pd.read_csv(csvname,dtype=str,keep_default_na=False,chunksize=CHUNK_ROWS):
+			for network_id, rows in data.groupby(PARTITION_COLUMN,sort=False):
+				if network_id == "": # rows without a network are dropped
+					continue
+				elif network_id not in networks:
+					networks.append(network_id)
+				os.makedirs(partition_folder(folder,network_id),exist_ok=True)
+				partname = f"{partition_folder(folder,network_id)}/{name}.csv"
+				rows.to_csv(partname,index=False,mode="a",header=not os.path.exists(partname))
+		os.remove(csvname)
+	for network_id in networks:
+		os.makedirs(partition_folder(folder,network_id),exist_ok=True)
+		for name in partitioned:
+			partname = f"{partition_folder(folder,network_id)}/{name}.csv"
+			if not os.path.exists(partname):
+				pd.DataFrame(columns=headers[name]).to_csv(partname,index=False)
+	save_index(folder,partitioned,networks)
+
+def encode_column(values):
+	"""Encode a column of strings, returns the kind of column and the arrays to save"""
+	nulls = values.isna().to_numpy()
+	text = values[~nulls].to_numpy(dtype=object)
+	try:
+		data = text.astype(np.int64)
+		if all(str(value) == string for value, string in zip(data.tolist(),text)):
+			result = np.zeros(len(values),dtype=np.int64)
+			result[~nulls] = data
+			return "int", {"values":result,"nulls":nulls}
+	except (ValueError,OverflowError):
+		pass
+	try:
+		data = text.astype(np.float64)
+		if all(str(value) == string for value, string in zip(data.tolist(),text)):
+			result = np.full(len(values),np.nan)
+			result[~nulls] = data
+			return "float", {"values":result}
+	except (ValueError,OverflowError):
+		pass
+	strings = [value.encode() + b"\0" if isinstance(value,str) else b"\0" for value in values.tolist()]
+	offsets = np.zeros(len(strings)+1,dtype=np.int64)
+	np.cumsum([len(string) for string in strings],out=offsets[1:])
+	return "str", {"offsets":offsets,"data":np.frombuffer(b"".join(strings),dtype=np.uint8),"nulls":nulls}
+
+def decode_column(offsets,text,rows):
+	"""Decode a text column, returns a list of strings"""
+	strings = str(text,"utf-8").split("\0")
+	if len(strings) == rows + 1:
+		return strings[0:rows]
+	return [str(text[offsets[row]:offsets[row+1]-1],"utf-8") for row in range(rows)] # some values hold NUL characters
+
+def save_columnar(folder,tables):
+	"""Save a dict of DataFrames of strings in the columnar format"""
+	for name, data in tables.items():
+		tablename = f"{folder}/{COLUMNAR_FOLDER}/{name}"
+		os.makedirs(tablename,exist_ok=True)
+		meta = {"rows":len(data),"columns":[]}
+		for n, column in enumerate(data.columns):
+			kind, arrays = encode_column(data[column])
+			for part, array in arrays.items():
+				np.save(f"{tablename}/{n}.{part}.npy",array)
+			meta["columns"].append({"name":column,"kind":kind})
+		with open(f"{tablename}/meta.json","w") as fh:
+			json.dump(meta,fh)
+
+def copy_csv(source,target,skip=[]):
+	"""Copy a data folder, except the sub-folders in skip, with its pickled tables saved as CSV files instead"""
+	shutil.copytree(source,target,dirs_exist_ok=True,
+		ignore=lambda folder, names: [name for name in names if name == PICKLE_NAME or (name in skip and os.path.samefile(folder,source))])
+	for folder, names, files in os.walk(source):
+		if os.path.samefile(folder,source):
+			names[:] = [name for name in names if name not in skip]
+		if PICKLE_NAME in files:
+			save_csv(f"{target}/{os.path.relpath(folder,source)}",load_shared(folder))
+
+def convert_columnar(folder):
+	"""Add the columnar format of the tables in the data folder and its partitions"""
+	folders = [folder]
+	index = partition_index(folder)
+	if index:
+		folders.extend(partition_folder(folder,network_id) for network_id in index["networks"])
+	for name in folders:
+		if os.path.exists(f"{name}/{COLUMNAR_FOLDER}"):
+			shutil.rmtree(f"{name}/{COLUMNAR_FOLDER}")
+		save_columnar(name,load_shared(name))
+
+def load_columnar(tablename,dtype=str,columns=None):
+	"""Load a table saved in the columnar format, optionally only the columns listed"""
+	with open(f"{tablename}/meta.json","r") as fh:
+		meta = json.load(fh)
+	data = {}
+	for n, column in enumerate(meta["columns"]):
+		name, kind = column["name"], column["kind"]
+		if columns is not None and name not in columns:
+			continue
+		load = lambda part: np.load(f"{tablename}/{n}.{part}.npy",mmap_mode="r")
+		if kind == "str":
+			values = np.array(decode_column(load("offsets"),memoryview(load("data")),meta["rows"]),dtype=object)
+			values[load("nulls")] = np.nan
+			values = pd.Series(values,dtype=object)
+			data[name] = values if dtype is str else pd.to_numeric(values,errors="ignore")
+		elif kind == "int":
+			values, nulls = load("values"), load("nulls")
+			if dtype is str:
+				values = values.astype(str).astype(object)
+				values[nulls] = np.nan
+				values = pd.Series(values,dtype=object)
+			elif nulls.any():
+				values = np.where(nulls,np.nan,values)
+			data[name] = values
+		else:
+			values = load("values")
+			if dtype is str:
+				nulls = np.isnan(values)
+				values = values.astype(str).astype(object)
+				values[nulls] = np.nan
+				values = pd.Series(values,dtype=object)
+			data[name] = values
+	return pd.DataFrame(data,copy=False)
+
+if __name__ == "__main__":
+	opts, args = getopt.getopt(sys.argv[1:],"hi:",["help","index="])
+	index = None
+	for opt, arg in opts:
+		if opt in ("-h","--help"):
+			print(__doc__)
+			exit(0)
+		elif opt in ("-i","--index"):
+			index = pd.read_csv(arg,dtype=str)
+	if len(args) != 2:
+		print("Syntax: python3 table_store.py [-i|--index CSV] SQLITE FOLDER",file=sys.stderr)
+		exit(1)
+	save_sqlite(args[0],load_tables(args[1]),index)
@@ -21,13 +21,14 @@ DEBUG = False
 QUIET = False
 VERBOSE = False
 
-opts, args = getopt.getopt(sys.argv[1:],"hc:i:o:d:tn:e:g:",["help","config=","input=","output=","data=","cyme-tables","network_ID=","equipment_file=","generated="])
+script_argv = globals().get("script_argv",sys.argv) # set when run in-process by glm_writer.run_script()
+opts, args = getopt.getopt(script_argv[1:],"hc:i:o:d:tn:e:g:",["help","config=","input=","output=","data=","cyme-tables","cyme-columns","network_ID=","equipment_file=","generated="])
 
 #
 # Warning/error/help handling
 #
 def help(exit_code=None,details=False):
-	print("Syntax: python3 -m voltage_profile.py -i|--input DIR -o|--output DIR -d|--data DIR [-h|--help] [-g|--generated 'file name'][-t|--cyme-tables] [-c|--config CSV] [-e|--equipment 'file name'] [-n|--network_ID 'ID1 ID2 ..']")
+	print("Syntax: python3 -m voltage_profile.py -i|--input DIR -o|--output DIR -d|--data DIR [-h|--help] [-g|--generated 'file name'][-t|--cyme-tables] [--cyme-columns] [-c|--config CSV] [-e|--equipment 'file name'] [-n|--network_ID 'ID1 ID2 ..']")
 	if details:
 		print(globals()[__name__].__doc__)
 	if type(exit_code) is int:
@@ -84,6 +85,9 @@ for opt, arg in opts:
 			print(config)
 	elif opt in ("-t","--cyme-tables"):
 		pass
+	elif opt == "--cyme-columns":
+		print(json.dumps({})) # no CYME tables are used
+		sys.exit(0)
 	elif opt in ("-i", "--input"):
 		input_folder = arg.strip()
 	elif opt in ("-o", "--output"):
@@ -0,0 +1,136 @@
+"""Warm conversion worker
+
+A long-lived local worker that keeps the interpreter, the modules imported by
+the postprocessors (pandas, networkx, matplotlib) and the table sets loaded by
+the last conversions in memory, so that converting the same tables again,
+e.g., after changing `modify.csv`, does not pay these startup costs.  The
+postprocessors run in-process (see `glm_writer.py`), one job at a time, and
+the table sets are kept in an LRU cache of `--tables` sets, which are loaded
+again when their files change.
+
+Jobs are sent to the Unix socket of the worker as one JSON object per line,
+and the worker replies with one JSON object per line:
+
+	{"job":"convert","input":DIR,"output":DIR,"data":DIR,["config":CSV,"generated":NAME,"networks":[ID,...],"settings":{NAME:VALUE},"options":[OPTION,...]]}
+	{"job":"graph",...} or {"job":"profile",...} run network_graph.py or voltage_profile.py with the same fields
+	{"job":"status"} gets the number of jobs run and table sets cached
+	{"job":"stop"} stops the worker
+
+The reply holds the exit `code` and the `seconds` taken by the job, and the
+GLM `files` written by a conversion.  Jobs run in their input folder.
+
+Command line:
+
+	python3 warm_worker.py [-s|--socket PATH] [-t|--tables N]   starts the worker
+	python3 warm_worker.py [-s|--socket PATH] JSON               sends a job to the worker and prints the reply
+"""
+
+import os, sys, getopt, json, time, socket, socketserver
+import glm_writer
+
+DEFAULT_SOCKET = f"/tmp/cyme-extract-worker-{os.getuid()}.sock"
+SCRIPTS = {
+	"graph" : "network_graph.py",
+	"profile" : "voltage_profile.py",
+	}
+
+def script_options(job):
+	"""Get the command line options of a postprocessor job"""
+	options = ["-i",job["input"],"-o",job["output"],"-d",job["data"]]
+	if job.get("config"):
+		options.extend(["-c",job["config"]])
+	if job.get("generated"):
+		options.extend(["-g",job["generated"]])
+	if job.get("networks"):
+		options.extend(["-n"," ".join(job["networks"])])
+	return options + list(job.get("options",[]))
+
+def run_job(job,tables):
+	"""Run a job with the table cache given, returns the reply"""
+	start = time.time()
+	if job["job"] == "status":
+		return {"code":0,"jobs":WarmWorker.jobs,"table_sets":len(tables.sets),"hits":tables.hits,"misses":tables.misses}
+	elif job["job"] not in ["convert"] + list(SCRIPTS):
+		return {"code":1,"error":f"job '{job['job']}' is not valid (must be 'convert', 'graph', 'profile', 'status' or 'stop')"}
+	cwd = os.getcwd()
+	os.chdir(job["input"])
+	try:
+		if job["job"] == "convert":
+			reply = glm_writer.convert(job["input"],job["output"],job["data"],
+				config_file=job.get("config"),
+				generated=job.get("generated"),
+				networks=job.get("networks"),
+				settings=job.get("settings"),
+				options=job.get("options",[]),
+				tables=tables)
+		else:
+			import matplotlib.pyplot as plt
+			code, namespace = glm_writer.run_script(os.path.join(os.path.dirname(os.path.abspath(__file__)),SCRIPTS[job["job"]]),script_options(job))
+			plt.close("all")
+			reply = {"code":code}
+	finally:
+		os.chdir(cwd)
+	WarmWorker.jobs += 1
+	return dict(reply,seconds=round(time.time()-start,3))
+
+class WarmWorker(socketserver.StreamRequestHandler):
+	"""Handle the jobs sent to the worker socket"""
+	jobs = 0
+	def handle(self):
+		for line in self.rfile:
+			try:
+				job = json.loads(line)
+				if job.get("job") == "stop":
+					self.server.stopping = True
+					reply = {"code":0}
+				else:
+					reply = run_job(job,self.server.tables)
+			except Exception as err:
+				reply = {"code":1,"error":f"{type(err).__name__}: {err}"}
+			self.wfile.write((json.dumps(reply) + "\n").encode())
+			self.wfile.flush()
+			if self.server.stopping:
+				return
+
+def serve(path=DEFAULT_SOCKET,size=glm_writer.DEFAULT_TABLE_SETS):
+	"""Run the worker until it receives a stop job"""
+	if os.path.exists(path):
+		os.remove(path)
+	import pandas, networkx, matplotlib
+	matplotlib.use("Agg")
+	import matplotlib.pyplot # warm up the modules the postprocessors import
+	with socketserver.UnixStreamServer(path,WarmWorker) as server:
+		server.tables = glm_writer.TableCache(size)
+		server.stopping = False
+		print(f"CYME-extract warm worker listening on '{path}'",flush=True)
+		try:
+			while not server.stopping:
+				server.handle_request()
+		finally:
+			os.remove(path)
+
+def submit(job,path=DEFAULT_SOCKET):
+	"""Send a job to the worker, returns its reply"""
+	with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+		sock.connect(path)
+		with sock.makefile("rwb") as fh:
+			fh.write((json.dumps(job) + "\n").encode())
+			fh.flush()
+			return json.loads(fh.readline())
+
+if __name__ == "__main__":
+	opts, args = getopt.getopt(sys.argv[1:],"hs:t:",["help","socket=","tables="])
+	path, size = DEFAULT_SOCKET, glm_writer.DEFAULT_TABLE_SETS
+	for opt, arg in opts:
+		if opt in ("-h","--help"):
+			print(__doc__)
+			exit(0)
+		elif opt in ("-s","--socket"):
+			path = arg
+		elif opt in ("-t","--tables"):
+			size = int(arg)
+	if args:
+		reply = submit(json.loads(args[0]),path)
+		print(json.dumps(reply))
+		exit(reply.get("code",1))
+	serve(path,size)
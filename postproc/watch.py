@@ -0,0 +1,210 @@
+"""Watch the input folder and convert the databases that change
+
+The watcher polls the input folder and runs `openfido.sh` on the databases
+(`.mdb` files, or compressed with gzip, zstd or zip, a zip archive being a
+database only when it holds an `.mdb` file) that are new or changed
+since they were last converted, together with the config files of the input
+folder.  A file is converted only after its size and modification time have
+not changed for `settle` seconds, so that files being copied are not read
+half-written, and a file converted whose content hash did not change (e.g.,
+it was only touched) is not converted again.  A file whose conversion failed
+is converted again when its content changes, otherwise only `retries` more
+times, after `backoff` seconds doubled at each attempt.  When a config file
+changes, all the databases are converted again.
+
+The state of the files converted is kept in `watch_state.json` in the output
+folder, so that the watcher can be restarted without converting everything
+again, and the rows of the other databases are kept in the output
+`index.csv`.
+
+Command line:
+
+	python3 watch.py [-i|--input DIR] [-o|--output DIR] [--interval SECONDS] [--settle SECONDS] [--retries NUMBER] [--backoff SECONDS] [--once]
+
+The input and output folders default to $OPENFIDO_INPUT and $OPENFIDO_OUTPUT.
+"""
+
+import os, sys, getopt, json, time, tempfile, shutil, subprocess, zipfile
+import pandas as pd
+import extract_cache
+
+DEFAULT_INTERVAL = 10 # seconds between polls
+DEFAULT_SETTLE = 30 # seconds a file must be left unchanged before it is converted
+DEFAULT_RETRIES = 2 # retries of a failed file whose content did not change
+DEFAULT_BACKOFF = 60 # seconds before the first retry, doubled for each retry
+STATE_NAME = "watch_state.json"
+DATABASE_EXTENSIONS = (".mdb",".mdb.gz",".mdb.zst",".zip")
+
+def is_database(input_folder,name):
+	"""Check whether an input file is a database, possibly compressed (a zip archive holding an .mdb file)"""
+	if not name.lower().endswith(DATABASE_EXTENSIONS):
+		return False
+	elif name.lower().endswith(".zip"):
+		try:
+			with zipfile.ZipFile(f"{input_folder}/{name}") as archive:
+				return any(member.lower().endswith(".mdb") for member in archive.namelist())
+		except (OSError,zipfile.BadZipFile):
+			return False
+	return True
+
+def database_name(name):
+	"""Get the name of the database extracted from an input file"""
+	for extension in (".gz",".zst",".zip"):
+		if name.lower().endswith(extension):
+			name = name[0:-len(extension)]
+	return name if name.lower().endswith(".mdb") else f"{name}.mdb"
+
+def signature(filename):
+	"""Get the size and modification time of a file"""
+	stat = os.stat(filename)
+	return [stat.st_size,stat.st_mtime_ns]
+
+def load_state(output_folder):
+	"""Load the state of the files converted"""
+	if not os.path.exists(f"{output_folder}/{STATE_NAME}"):
+		return {}
+	with open(f"{output_folder}/{STATE_NAME}","r") as fh:
+		return json.load(fh)
+
+def save_state(output_folder,state):
+	"""Save the state of the files converted"""
+	with open(f"{output_folder}/{STATE_NAME}.tmp","w") as fh:
+		json.dump(state,fh,indent=1)
+	os.replace(f"{output_folder}/{STATE_NAME}.tmp",f"{output_folder}/{STATE_NAME}")
+
+def converted(state,name,signature=None):
+	"""Check whether an input file was converted, with the signature given if any"""
+	return name in state and state[name]["status"] == "done" and (signature is None or state[name]["signature"] == signature)
+
+def retry_due(state,name,retries=DEFAULT_RETRIES,backoff=DEFAULT_BACKOFF):
+	"""Check whether the failed conversion of an input file with unchanged content is due for a retry"""
+	attempts = state[name].get("attempts",1)
+	return attempts <= int(retries) and time.time() >= state[name]["time"] + float(backoff) * 2**(attempts-1)
+
+def failed(state,name,signature=None,content=None):
+	"""Check whether the conversion of an input file failed, with the signature or content hash given if any"""
+	return (name in state and state[name]["status"] == "failed"
+		and (signature is None or state[name]["signature"] == signature)
+		and (content is None or state[name]["hash"] == content))
+
+def changes(input_folder,state,polled,settle=DEFAULT_SETTLE):
+	"""Get the input files that changed or failed and were left unchanged for `settle` seconds
+
+	`polled` holds the signatures seen at the previous poll and is updated.
+	"""
+	ready = []
+	now = time.time()
+	names = sorted(name for name in os.listdir(input_folder) if os.path.isfile(f"{input_folder}/{name}"))
+	for name in names:
+		try:
+			current = signature(f"{input_folder}/{name}")
+		except FileNotFoundError:
+			continue
+		previous = polled.get(name)
+		polled[name] = current
+		if converted(state,name,current):
+			continue
+		if previous == current and now - current[1]/1e9 >= float(settle):
+			ready.append(name)
+	for name in [name for name in polled if name not in names]:
+		del polled[name]
+	return ready
+
+def merge_index(output_folder,previous,databases):
+	"""Add the rows of the other databases in the previous index to the output index.csv"""
+	filename = f"{output_folder}/index.csv"
+	if previous is None or not os.path.exists(filename):
+		return
+	index = pd.read_csv(filename,dtype=str)
+	previous = previous[~previous["database"].isin(list(databases) + list(index["database"]))]
+	pd.concat([previous,index]).to_csv(filename,index=False)
+
+def convert(input_folder,output_folder,names,command):
+	"""Run openfido.sh on the named databases and the config files of the input folder, returns the exit code"""
+	staging = tempfile.mkdtemp(prefix="cyme-extract-watch-")
+	try:
+		for name in os.listdir(input_folder):
+			if name in names or (os.path.isfile(f"{input_folder}/{name}") and not is_database(input_folder,name)):
+				os.symlink(os.path.abspath(f"{input_folder}/{name}"),f"{staging}/{name}")
+		previous = pd.read_csv(f"{output_folder}/index.csv",dtype=str) if os.path.exists(f"{output_folder}/index.csv") else None
+		with open(f"{output_folder}/stderr","w") as stderr:
+			code = subprocess.run(command,env=dict(os.environ,OPENFIDO_INPUT=staging,OPENFIDO_OUTPUT=output_folder),stderr=stderr).returncode
+		if code == 0:
+			merge_index(output_folder,previous,[database_name(name) for name in names])
+		return code
+	finally:
+		shutil.rmtree(staging,ignore_errors=True)
+
+def watch(input_folder,output_folder,interval=DEFAULT_INTERVAL,settle=DEFAULT_SETTLE,once=False,command=None,retries=DEFAULT_RETRIES,backoff=DEFAULT_BACKOFF):
+	"""Poll the input folder and convert the databases that change
+
+	With `once`, the watcher returns when every input file is converted, its
+	conversion failed once, or it waits for a retry.
+	"""
+	input_folder, output_folder = os.path.abspath(input_folder), os.path.abspath(output_folder)
+	command = command if command else ["bash",f"{os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}/openfido.sh"]
+	state = load_state(output_folder)
+	polled = {}
+	attempted = set()
+	while True:
+		ready = changes(input_folder,state,polled,settle)
+		ready = [name for name in ready if not failed(state,name,polled[name]) or retry_due(state,name,retries,backoff)]
+		hashes = {}
+		for name in ready:
+			hashes[name] = extract_cache.file_hash(f"{input_folder}/{name}")
+			if (converted(state,name) or failed(state,name)) and state[name]["hash"] == hashes[name]: # only touched
+				state[name]["signature"] = polled[name]
+		ready = [name for name in ready if not (converted(state,name) and state[name]["hash"] == hashes[name])
+			and not (failed(state,name,content=hashes[name]) and not retry_due(state,name,retries,backoff))]
+		changed = [name for name in ready if not is_database(input_folder,name) and not failed(state,name,content=hashes[name])]
+		if [name for name in ready if not is_database(input_folder,name)]: # config changed or retried, convert everything
+			ready = sorted(set(ready) | set(name for name in state if name in polled and is_database(input_folder,name)))
+			for name in ready:
+				if name not in hashes:
+					hashes[name] = extract_cache.file_hash(f"{input_folder}/{name}")
+		databases = [name for name in ready if is_database(input_folder,name)]
+		if databases:
+			print(f"CYME-extract watch: converting {' '.join(databases)}",flush=True)
+			start = time.time()
+			code = convert(input_folder,output_folder,databases,command)
+			print(f"CYME-extract watch: {'converted' if code == 0 else 'failed to convert'} {' '.join(databases)} in {time.time()-start:.1f} s",flush=True)
+		else:
+			code = 0
+		attempted |= set(ready)
+		for name in ready:
+			attempts = state[name].get("attempts",1) + 1 if failed(state,name,content=hashes[name]) and not changed else 1
+			state[name] = {"signature":polled[name],"hash":hashes[name],"status":"done" if code == 0 else "failed","time":time.time(),"attempts":attempts}
+		if ready or hashes:
+			save_state(output_folder,state)
+		if once and not [name for name in polled if not converted(state,name,polled[name]) and name not in attempted
+				and (not failed(state,name,polled[name]) or retry_due(state,name,retries,backoff))]:
+			return
+		time.sleep(float(interval))
+
+if __name__ == "__main__":
+	opts, args = getopt.getopt(sys.argv[1:],"hi:o:",["help","input=","output=","interval=","settle=","retries=","backoff=","once"])
+	input_folder = os.getenv("OPENFIDO_INPUT")
+	output_folder = os.getenv("OPENFIDO_OUTPUT")
+	interval, settle, retries, backoff, once = DEFAULT_INTERVAL, DEFAULT_SETTLE, DEFAULT_RETRIES, DEFAULT_BACKOFF, False
+	for opt, arg in opts:
+		if opt in ("-h","--help"):
+			print(__doc__)
+			exit(0)
+		elif opt in ("-i","--input"):
+			input_folder = arg
+		elif opt in ("-o","--output"):
+			output_folder = arg
+		elif opt == "--interval":
+			interval = float(arg)
+		elif opt == "--settle":
+			settle = float(arg)
+		elif opt == "--retries":
+			retries = int(arg)
+		elif opt == "--backoff":
+			backoff = float(arg)
+		elif opt == "--once":
+			once = True
+	if not input_folder or not output_folder:
+		print("Syntax: python3 watch.py [-i|--input DIR] [-o|--output DIR] [--interval SECONDS] [--settle SECONDS] [--retries NUMBER] [--backoff SECONDS] [--once]",file=sys.stderr)
+		exit(1)
+	watch(input_folder,output_folder,interval,settle,once,retries=retries,backoff=backoff)
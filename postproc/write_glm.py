@@ -2,7 +2,7 @@
 """OpenFIDO write_glm post-processor script (version: develop)
 Syntax:
 	host% python3 -m write_glm.py -i|--input INPUTDIR -o|--output OUTPUTDIR -d|--data DATADIR [-c|--config [CONFIGCSV]] 
-	[-h|--help] [-t|--cyme-tables] [-s|--single] [-n|--network ID]
+	[-h|--help] [-t|--cyme-tables] [--cyme-columns] [-s|--single] [-n|--network ID]
 Concept of Operation
 --------------------
 Files are processed in the local folder, which must contain the required CSV files list in the `cyme_tables_required` 
@@ -33,18 +33,36 @@ import subprocess
 import glob
 import datetime as dt
 import pandas as pd
-import networkx as nx
-import matplotlib.pyplot as plt
 import math
 from math import sqrt, cos, sin, pi
 import re
 import hashlib
 import csv
+import json
 import pprint
 pp = pprint.PrettyPrinter(indent=4,compact=True)
 import traceback
 from copy import copy
 import numpy as np
+from table_store import load_tables, load_shared, load_partition, partition_index, partition_folder, table_names, save_tables, LazyTables
+import extract_cache
+from build_info import build_info
+
+#
+# Arguments and settings given by glm_writer.convert() when the script is run in-process
+#
+script_argv = globals().get("script_argv",sys.argv)
+script_settings = globals().get("script_settings",{})
+if "script_loader" in globals(): # e.g., a glm_writer.TableCache or table_store.MemoryTables
+	load_tables, load_shared, load_partition = script_loader.load_tables, script_loader.load_shared, script_loader.load_partition
+	table_names = getattr(script_loader,"table_names",table_names)
+glm_files = [] # GLM files written
+
+#
+# Equipment library saved in the extract cache (increment the version when the library content changes)
+#
+EQUIPMENT_LIBRARY_VERSION = 1
+EQUIPMENT_INDEX = "equipment_index.json"
 
 #
 # Required tables to operate properly
@@ -60,6 +78,50 @@ cyme_tables_required = [
 	"CYMCTYPEFILTER","CYMTRANSFORMERBYPHASE","CYMRECLOSER","CYMEQOVERHEADLINE",
 	"CYMSOURCE","CYMEQSHUNTCAPACITOR"]
 
+#
+# Columns used in the required tables (tables not listed are used entirely)
+#
+cyme_columns_required = {
+	"CYMNETWORK" : ["NetworkId","Version","CreationTime","LastChange","LoadFactor"],
+	"CYMHEADNODE" : ["NetworkId","NodeId"],
+	"CYMNODE" : ["NetworkId","NodeId","ComponentMask"],
+	"CYMNODETAG" : ["NetworkId","NodeId"],
+	"CYMSECTION" : ["NetworkId","SectionId","Phase","FromNodeId","ToNodeId"],
+	"CYMSECTIONDEVICE" : ["NetworkId","SectionId","DeviceNumber","DeviceType"],
+	"CYMSOURCE" : ["NetworkId","DesiredVoltage","EquipmentId"],
+	"CYMOVERHEADBYPHASE" : ["NetworkId","DeviceNumber","Length",
+		"PhaseConductorIdA","PhaseConductorIdB","PhaseConductorIdC","NeutralConductorId","ConductorSpacingId"],
+	"CYMOVERHEADLINEUNBALANCED" : ["NetworkId","DeviceNumber","Length","LineId"],
+	"CYMOVERHEADLINE" : ["NetworkId","DeviceNumber","Length","LineId"],
+	"CYMUNDERGROUNDLINE" : ["NetworkId","DeviceNumber","Length","CableId"],
+	"CYMCUSTOMERLOAD" : ["NetworkId","DeviceNumber","DeviceType","CustomerNumber","ConsumerClassId",
+		"Phase","LoadValueType","LoadValue1","LoadValue2"],
+	"CYMLOAD" : ["DeviceNumber","ConnectionConfiguration"],
+	"CYMSHUNTCAPACITOR" : ["NetworkId","DeviceNumber","EquipmentId","Phase","ByPhase","KVLN","ConnectionConfiguration",
+		"KVARA","KVARB","KVARC","SwitchedKVARA","SwitchedKVARB","SwitchedKVARC"],
+	"CYMTRANSFORMER" : ["NetworkId","DeviceNumber","DeviceType","EquipmentId"],
+	"CYMTRANSFORMERBYPHASE" : ["NetworkId","DeviceNumber","PhaseTransformerID1","PhaseTransformerID2","PhaseTransformerID3"],
+	"CYMREGULATOR" : ["NetworkId","DeviceNumber","EquipmentId","CTPrimaryRating","PTRatio","BandWidth",
+		"BoostPercent","BuckPercent","TapPositionA","TapPositionB","TapPositionC","ControlStatus",
+		"ReverseSensingMode","ReverseThreshold","X","Y","Status","Reversible"],
+	"CYMSWITCH" : ["NetworkId","DeviceNumber","ClosedPhase"],
+	"CYMBREAKER" : ["NetworkId","DeviceNumber","ClosedPhase"],
+	"CYMRECLOSER" : ["NetworkId","DeviceNumber","ClosedPhase"],
+	"CYMFUSE" : ["NetworkId","DeviceNumber","EquipmentId"],
+	"CYMEQCONDUCTOR" : ["EquipmentId","GMR","R25","Diameter","NominalRating","FirstRating"],
+	"CYMEQGEOMETRICALARRANGEMENT" : ["EquipmentId",
+		"ConductorA_Horizontal","ConductorA_Vertical","ConductorB_Horizontal","ConductorB_Vertical",
+		"ConductorC_Horizontal","ConductorC_Vertical","NeutralConductor_Horizontal","NeutralConductor_Vertical"],
+	"CYMEQOVERHEADLINE" : ["EquipmentId","PhaseConductorId","NeutralConductorId","ConductorSpacingId"],
+	"CYMEQOVERHEADLINEUNBALANCED" : ["EquipmentId",
+		"PhaseConductorIdA","PhaseConductorIdB","PhaseConductorIdC","NeutralConductorId","ConductorSpacingId"],
+	"CYMEQFUSE" : ["EquipmentId","FirstRatedCurrent"],
+	"CYMEQSHUNTCAPACITOR" : ["EquipmentId"],
+	"CYMEQTRANSFORMER" : ["EquipmentId","NominalRatingKVA","PrimaryVoltageKVLL","SecondaryVoltageKVLL",
+		"PosSeqImpedancePercent","XRRatio"],
+	"CYMEQREGULATOR" : ["EquipmentId","RatedKVA","RatedKVLN","NumberOfTaps"],
+	}
+
 #
 # Argument parsing
 #
@@ -71,6 +133,7 @@ config = {
 	"options" : {
 		"config" : "specify config.csv",
 		"cyme-tables" : "get required CYME tables",
+		"cyme-columns" : "get columns used in the required CYME tables",
 	},
 }
 input_folder = None
@@ -86,13 +149,13 @@ DEBUG = False
 QUIET = False
 VERBOSE = False
 
-opts, args = getopt.getopt(sys.argv[1:],"hc:i:o:d:tn:e:g:",["help","config=","input=","output=","data=","cyme-tables","network_ID=","equipment_file=","generated="])
+opts, args = getopt.getopt(script_argv[1:],"hc:i:o:d:tsn:e:g:",["help","config=","input=","output=","data=","cyme-tables","cyme-columns","single","network_ID=","equipment_file=","generated="])
 
 #
 # Warning/error/help handling
 #
 def help(exit_code=None,details=False):
-	print("Syntax: python3 -m write_glm.py -i|--input DIR -o|--output DIR -d|--data DIR [-h|--help] [-g|--generated 'file name'][-t|--cyme-tables] [-c|--config CSV] [-e|--equipment 'file name'] [-n|--network_ID 'ID1 ID2 ..']")
+	print("Syntax: python3 -m write_glm.py -i|--input DIR -o|--output DIR -d|--data DIR [-h|--help] [-g|--generated 'file name'][-t|--cyme-tables] [--cyme-columns] [-s|--single] [-c|--config CSV] [-e|--equipment 'file name'] [-n|--network_ID 'ID1 ID2 ..']")
 	if details:
 		print(globals()[__name__].__doc__)
 	if type(exit_code) is int:
@@ -155,12 +218,18 @@ for opt, arg in opts:
 	elif opt in ("-t","--cyme-tables"):
 		print(" ".join(cyme_tables_required))
 		sys.exit(0)
+	elif opt == "--cyme-columns":
+		print(json.dumps(cyme_columns_required))
+		sys.exit(0)
 	elif opt in ("-i", "--input"):
 		input_folder = arg.strip()
 	elif opt in ("-o", "--output"):
 		output_folder = arg.strip()
 	elif opt in ("-d", "--data"):
 		data_folder = arg.strip()
+	elif opt in ("-s", "--single"):
+		# write the selected networks to the generated file instead of one file per network
+		single_file = True
 	elif opt in ("-n", "--network_ID"):
 		# only extract the selected network
 		network_select = arg.split(" ")
@@ -184,22 +253,17 @@ if not network_select:
 #
 # Application information
 #
-app_command = os.path.abspath(sys.argv[0])
+app_command = os.path.abspath(script_argv[0])
 app_workdir = os.getenv("PWD")
 app_path = "/"+"/".join(app_command.split("/")[0:-1])
 
 #
-# Git information
-#
-# TODO: change this to use gitpython module
+# Git information (saved at install time or read from the .git folder, see build_info.py)
 #
-def command(cmd,lang="utf-8"):
-	return subprocess.run(cmd.split(),stdout=subprocess.PIPE).stdout.decode(lang).strip()
-os.chdir(app_path)
-git_project = command("git config --local remote.origin.url")
-git_commit = command("git rev-parse HEAD")
-git_branch = command("git rev-parse --abbrev-ref HEAD")
-os.chdir(app_workdir)
+git_info = build_info(app_path)
+git_project = git_info["project"]
+git_commit = git_info["commit"]
+git_branch = git_info["branch"]
 
 #
 # CYME model information
@@ -227,6 +291,10 @@ config = pd.DataFrame({
 	"GLM_VOLTAGE_FIX" : ["false"],
 	"GLM_PHASE_FIX" : ["false"],
 	"GLM_DISTRIBUTED_LOAD_CONFIG" : ["to"],
+	"EXTRACT_BACKEND" : ["mdbtools"],
+	"EXTRACT_CACHE" : ["none"],
+	"EXTRACT_COLUMNS" : ["all"],
+	"EXTRACT_CACHE_SIZE" : [str(extract_cache.DEFAULT_SIZE)],
 	"GLM_OUTPUT" : "/dev/stdout",
 	"ERROR_OUTPUT" : "/dev/stderr",
 	"WARNING_OUTPUT" : "/dev/stderr",
@@ -256,6 +324,9 @@ else:
 for name, values in settings.iterrows():
 	if name in config.index:
 		config["value"][name] = values[0]
+for name, value in script_settings.items():
+	if name in config.index:
+		config["value"][name] = value
 settings = config["value"]
 
 output_file = open(settings["GLM_OUTPUT"],"w")
@@ -362,6 +433,22 @@ glm_devices = {
 	23 : "overhead_line",
 	38 : "single_transformer",
 }
+cyme_device_tables = { # network tables of the devices of each type (not loaded when the networks have none)
+	"undergroundline" : [1],
+	"overheadline" : [2],
+	"overheadbyphase" : [3],
+	"regulator" : [4],
+	"transformer" : [5],
+	"breaker" : [8],
+	"recloser" : [10],
+	"switch" : [13],
+	"fuse" : [14],
+	"shuntcapacitor" : [17],
+	"customerload" : [20,21],
+	"load" : [20,21],
+	"overheadlineunbalanced" : [23],
+	"transformerbyphase" : [38],
+}
 
 #
 # CYME database access tools
@@ -374,6 +461,14 @@ def table_find(table,**kwargs):
 		result = result[result[key]==value]
 	return result
 
+# build the lookup index of the rows of a table by id (the first row with an id is used like table_get does)
+def table_index(table,id_column):
+	index = {}
+	for position, value in enumerate(table[id_column]):
+		if not pd.isna(value) and value not in index:
+			index[value] = position
+	return index
+
 # get the value in a table using a certain id or index
 def table_get(table,id,column=None,id_column=None):
 	if id_column == None or id_column == '*':
@@ -382,6 +477,14 @@ def table_get(table,id,column=None,id_column=None):
 		else:
 			return table.loc[index][column]
 	else:
+		for indexed_table, indexed_column, index in cyme_table_index:
+			if indexed_table is table and indexed_column == id_column:
+				if id not in index:
+					return None
+				elif column == None or column == "*":
+					return table.iloc[index[id]]
+				else:
+					return table.iloc[index[id]][column]
 		for index, row in table.iterrows():
 			if row[id_column] == id:
 				if column == None or column == "*":
@@ -487,33 +590,68 @@ def clean_phases(phases):
 	return p
 
 #
-# Load all the model tables (table names have an "s" appended)
+# Load the model tables the first time they are used
 #
-cyme_table = {}
+if settings["EXTRACT_COLUMNS"] == "used":
+	cyme_columns = {table[3:].lower():columns for table, columns in cyme_columns_required.items()}
+else:
+	cyme_columns = None
+cyme_partitions = partition_index(data_folder)
+cyme_table = LazyTables()
+if table_names(data_folder) is None: # tables saved in one file are loaded at once
+	cyme_table.update(load_shared(data_folder,columns=cyme_columns))
+else:
+	cyme_table.add(table_names(data_folder),lambda names: load_shared(data_folder,names,columns=cyme_columns))
+if cyme_partitions: # network tables are loaded one network at a time
+	cyme_tables_found = list(cyme_table.keys()) + cyme_partitions["tables"]
+else:
+	cyme_tables_found = list(cyme_table.keys())
 cyme_equipment_table = {}
-for filename in glob.iglob(f"{data_folder}/*.csv"):
-	data = pd.read_csv(filename, dtype=str)
-	# index = data.columns[0]
-	name = os.path.basename(filename)[0:-4].lower()
-	# cyme_table[name] = data.set_index(index)
-	cyme_table[name] = data
+cyme_table_index = [] # lookup indexes (table, id column, {id: row}) used by table_get
 for filename in cyme_tables_required:
-	if filename[3:].lower() not in cyme_table.keys():
+	if filename[3:].lower() not in cyme_tables_found:
 		glm_output_print(f"Table needed but missing: {filename[3:].lower()}")
 if equipment_file != None:
-	if not os.path.exists(f'{data_folder}/cyme_equipment_tables'):
-		os.system(f"mkdir -p {data_folder}/cyme_equipment_tables")
-	for table in cyme_tables_required:
-		csvname = table[3:].lower()
-		os.system(f"mdb-export {input_folder}/{equipment_file} {table} > {data_folder}/cyme_equipment_tables/{csvname}.csv")
-		row_count = os.popen(f"wc -l {data_folder}/cyme_equipment_tables/{csvname}.csv").read()
-		if int(row_count.strip().split(" ")[0]) == 1:
-			os.remove(f"{data_folder}/cyme_equipment_tables/{csvname}.csv")
-
-	for filename in glob.iglob(f"{data_folder}/cyme_equipment_tables/*.csv"):
-		data = pd.read_csv(filename, dtype=str)
-		name = os.path.basename(filename)[0:-4].lower()
-		cyme_equipment_table[name] = data
+	equipment_folder = f"{data_folder}/cyme_equipment_tables"
+	cache_folder = extract_cache.cache_folder(settings["EXTRACT_CACHE"])
+	equipment_library = None
+	if cache_folder:
+		cache_key = extract_cache.cache_key(f"{input_folder}/{equipment_file}",
+			library=EQUIPMENT_LIBRARY_VERSION,
+			tables=cyme_tables_required)
+		equipment_library = extract_cache.entry(cache_folder,cache_key)
+	if equipment_library:
+		glm_output_print(f"Using equipment library '{equipment_library}'")
+		equipment_folder = equipment_library
+	elif settings["EXTRACT_BACKEND"] == "native":
+		from mdb_reader import read_tables
+		if not os.path.exists(equipment_folder):
+			os.system(f"mkdir -p {equipment_folder}")
+		equipment_tables = {}
+		for table, data in read_tables(f"{input_folder}/{equipment_file}",cyme_tables_required).items():
+			if len(data) > 0:
+				equipment_tables[table[3:].lower()] = data
+		save_tables(equipment_folder,equipment_tables)
+	else:
+		if not os.path.exists(equipment_folder):
+			os.system(f"mkdir -p {equipment_folder}")
+		for table in cyme_tables_required:
+			csvname = table[3:].lower()
+			os.system(f"mdb-export {input_folder}/{equipment_file} {table} > {equipment_folder}/{csvname}.csv")
+			row_count = os.popen(f"wc -l {equipment_folder}/{csvname}.csv").read()
+			if int(row_count.strip().split(" ")[0]) == 1:
+				os.remove(f"{equipment_folder}/{csvname}.csv")
+	if not equipment_library:
+		with open(f"{equipment_folder}/{EQUIPMENT_INDEX}","w") as fh:
+			json.dump({name:table_index(data,"EquipmentId") for name, data in load_tables(equipment_folder).items()
+				if "EquipmentId" in data.columns},fh)
+		if cache_folder:
+			extract_cache.store(cache_folder,cache_key,equipment_folder,os.listdir(equipment_folder),settings["EXTRACT_CACHE_SIZE"])
+	cyme_equipment_table = load_tables(equipment_folder,columns=cyme_columns)
+	with open(f"{equipment_folder}/{EQUIPMENT_INDEX}","r") as fh:
+		for name, index in json.load(fh).items():
+			if name in cyme_equipment_table:
+				cyme_table_index.append((cyme_equipment_table[name],"EquipmentId",index))
 	glm_output_print(f'Equipment tables: {cyme_equipment_table.keys()}')
 
 #
@@ -1645,6 +1783,7 @@ class GLM:
 					pass
 
 	def section_checks(self): # remove parallel section between two nodes
+		import networkx as nx
 		multi_g = nx.MultiGraph()
 		for name in list(self.objects.keys()):
 			try:
@@ -1935,6 +2074,7 @@ def cyme_extract_5020(network_id,network):
 		glmname = os.path.abspath(f"{output_folder}/{generated_name}_{network_id}.glm")
 
 	glm = GLM(glmname,"w")
+	glm_files.append(glmname)
 	glm.comment(
 		f"Automatically generated by {git_project}/postproc/write_glm.py",
 		)
@@ -2168,6 +2308,7 @@ def cyme_extract_4700(network_id,network):
 		glmname = os.path.abspath(f"{output_folder}/{generated_name}_{network_id}.glm")
 
 	glm = GLM(glmname,"w")
+	glm_files.append(glmname)
 	glm.comment(
 		f"Automatically generated by {git_project}/postproc/write_glm.py",
 		)
@@ -2363,6 +2504,28 @@ def cyme_extract_4700(network_id,network):
 	glm.close()
 
 
+#
+# Plan the tables loaded for the networks
+#
+def load_network(network_id):
+	"""Add the partitioned tables of a network, loaded the first time they are used unless they are saved in one file"""
+	names = table_names(partition_folder(data_folder,network_id))
+	if names is None:
+		cyme_table.update(load_partition(data_folder,network_id,columns=cyme_columns))
+	else:
+		cyme_table.add(names,lambda names: load_partition(data_folder,network_id,names,columns=cyme_columns))
+
+def absent_devices(network_ids):
+	"""Get the columns of the device tables of the device types the networks do not have, from the DeviceType histogram of their section devices"""
+	try:
+		devices = cyme_table["sectiondevice"]
+	except KeyError:
+		return {}
+	devices = devices[devices["NetworkId"].isin(network_ids)]
+	histogram = pd.to_numeric(devices["DeviceType"],errors="coerce").value_counts().to_dict()
+	return {name:list(dict.fromkeys(["NetworkId","DeviceNumber"] + cyme_columns_required.get(f"CYM{name.upper()}",[])))
+		for name, device_types in cyme_device_tables.items() if not [device_type for device_type in device_types if histogram.get(device_type)]}
+
 #
 # Process cyme_table["network"]
 #
@@ -2372,6 +2535,10 @@ cyme_extract = {
 }
 cyme_extract["-1"] = cyme_extract[str(default_cyme_extractor)]
 network_count = 0
+if not cyme_partitions:
+	cyme_table.empty = absent_devices([network_id for network_id in cyme_table["network"]["NetworkId"]
+		if re.match(settings["GLM_NETWORK_MATCHES"],network_id) and (network_select == None or network_id in network_select)])
+	debug(f"Device tables not loaded: {' '.join(cyme_table.empty)}")
 for index, network in cyme_table["network"].iterrows():
 	network_id = network['NetworkId']
 	if not re.match(settings["GLM_NETWORK_MATCHES"],network_id):
@@ -2387,8 +2554,14 @@ for index, network in cyme_table["network"].iterrows():
 			if re.match(key,version):
 				if version == "-1":
 					warning(f"CYME model version is not specified (version=-1), using default extractor for version '{default_cyme_extractor}*'")
+				if cyme_partitions:
+					load_network(network_id)
+					cyme_table.empty = absent_devices([network_id])
+					debug(f"{cyme_mdbname}@{network_id}: device tables not loaded: {' '.join(cyme_table.empty)}")
 				# try:
 				extractor(network_id,network)
+				if cyme_partitions:
+					cyme_table.drop(cyme_partitions["tables"])
 				# except:
 				# 	warning(f"connot convert feeder {network_id}.")
 				found = True